@@ -0,0 +1,159 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from django.utils.timezone import now
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("infographics")
+
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+class SparqlOverloaded(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails fast after `threshold` consecutive failures, letting a single
+    request through again once `cooldown` seconds have passed. The others
+    still fail fast until that request succeeds, or until another `cooldown`
+    when it never reports back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= settings.SPARQL_CIRCUIT_COOLDOWN:
+                # half open: only this request goes through, the next failure
+                # opens it again
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= settings.SPARQL_CIRCUIT_THRESHOLD:
+                if self.opened_at is None:
+                    logger.warning("sparql endpoint circuit opened")
+                self.opened_at = time.monotonic()
+
+
+class SparqlClient:
+    """
+    HTTP client for the SPARQL endpoint, kept for the lifetime of the worker so
+    connections are reused between queries.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=settings.SPARQL_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {"User-agent": "Wiki-Infographics 1.0", "Accept-Encoding": "gzip, deflate"}
+        )
+        self.breaker = CircuitBreaker()
+
+    def get(self, params, headers):
+        """
+        Sends a GET request to the endpoint, retrying rate limited, unavailable
+        and unreachable responses with jittered exponential backoff.
+
+        Timeouts, server errors and unreachable endpoints count as failures of
+        the circuit breaker. The response is streamed, so timeouts while its
+        body is read are recorded by the caller, see `api.sparql.fetch_df`.
+
+        # Raises
+
+        - `SparqlOverloaded` while the endpoint is failing or asks to wait too long.
+        - `requests.Timeout` if the endpoint takes too long to answer.
+        - `requests.ConnectionError` if it can't be reached after all retries.
+        """
+        if not self.breaker.allow():
+            raise SparqlOverloaded()
+        timeout = (settings.SPARQL_CONNECT_TIMEOUT, settings.SPARQL_READ_TIMEOUT)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(
+                    settings.SPARQL_ENDPOINT,
+                    params=params,
+                    headers=headers,
+                    timeout=timeout,
+                    stream=True,
+                )
+            except requests.ConnectionError:
+                if attempt >= settings.SPARQL_RETRIES:
+                    self.breaker.record_failure()
+                    raise
+                delay = self.backoff(attempt)
+            except requests.Timeout:
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS:
+                    if response.status_code >= 500:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    return response
+                if attempt >= settings.SPARQL_RETRIES:
+                    self.breaker.record_failure()
+                    return response
+                delay = max(self.backoff(attempt), retry_after(response))
+                response.close()
+                if delay > settings.SPARQL_MAX_BACKOFF:
+                    self.breaker.record_failure()
+                    raise SparqlOverloaded()
+            attempt += 1
+            logger.info(f"retrying sparql request in {delay:.1f}s (attempt {attempt})")
+            time.sleep(delay)
+
+    def backoff(self, attempt):
+        return random.uniform(0, settings.SPARQL_BACKOFF * 2**attempt)
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to the `Retry-After` header, which is either a
+    number of seconds or an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return 0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - now()).total_seconds())
+    except (TypeError, ValueError):
+        return 0
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = SparqlClient()
+    return _client
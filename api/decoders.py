@@ -0,0 +1,260 @@
+import io
+import re
+import csv
+import json
+import codecs
+
+import pandas as pd
+from pandas.errors import ParserError
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+COMPACT_AFTER = 1024 * 1024
+# Errors appended by the query service to a partial result, such as
+# "java.util.concurrent.TimeoutException", and the lines of their stack traces
+SERVICE_ERROR = re.compile(rb"\bjava\.[\w.$]+(?:Exception|Error)\b|^\s*at (?:java|com\.bigdata)\.", re.MULTILINE)
+
+TSV_LITERAL = r'^"(.*)"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?$'
+TSV_ESCAPE = r"\\(?:u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)"
+TSV_ESCAPES = {
+    "t": "\t",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "f": "\f",
+    '"': '"',
+    "'": "'",
+    "\\": "\\",
+}
+
+
+class ResultTooLarge(Exception):
+    pass
+
+
+class ResultDecodeError(Exception):
+    def __init__(self, text=""):
+        self.text = text
+        return super().__init__("failed to decode query result")
+
+
+class JsonStream:
+    """
+    Incremental reader over chunks of a JSON document.
+
+    Only the value currently being read is kept decoded, so arrays can be
+    consumed item by item while the rest of the document is still downloading.
+    """
+
+    def __init__(self, chunks, max_bytes=None):
+        self.chunks = iter(chunks)
+        self.max_bytes = max_bytes
+        self.utf8 = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.bytes_read = 0
+        self.exhausted = False
+
+    def fill(self):
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            self.buffer += self.utf8.decode(b"", final=True)
+            return False
+        self.bytes_read += len(chunk)
+        if self.max_bytes is not None and self.bytes_read > self.max_bytes:
+            raise ResultTooLarge()
+        if self.pos > COMPACT_AFTER:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += self.utf8.decode(chunk)
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or "" at the end.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ResultDecodeError(self.buffer[self.pos:])
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.exhausted:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise ResultDecodeError(self.buffer[self.pos:])
+            self.fill()
+
+    def members(self):
+        """
+        Iterates over the keys of an object. The caller must read each value.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    def items(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+
+def decode_json_bindings(chunks, max_rows=None, max_bytes=None):
+    """
+    Decodes a SPARQL JSON result straight into one list per variable.
+
+    :param chunks: iterable of bytes of the response body
+    :param max_rows: maximum number of bindings accepted
+    :param max_bytes: maximum number of bytes accepted
+    :raises ResultTooLarge: when a limit is exceeded
+    :raises ResultDecodeError: when the body is not a valid result
+    :return: DataFrame with one column per variable
+    """
+    stream = JsonStream(chunks, max_bytes)
+    variables = None
+    columns = {}
+    rows = 0
+    for key in stream.members():
+        if key == "head":
+            variables = stream.value().get("vars", [])
+        elif key == "results":
+            for key in stream.members():
+                if key != "bindings":
+                    stream.value()
+                    continue
+                for binding in stream.items():
+                    for var, term in binding.items():
+                        column = columns.get(var)
+                        if column is None:
+                            column = columns[var] = [None] * rows
+                        column.append(term.get("value"))
+                    rows += 1
+                    if max_rows is not None and rows > max_rows:
+                        raise ResultTooLarge()
+                    for column in columns.values():
+                        if len(column) < rows:
+                            column.append(None)
+        else:
+            stream.value()
+    if variables is None:
+        raise ResultDecodeError()
+    if rows == 0:
+        return pd.DataFrame()
+    return pd.DataFrame({var: columns.get(var, [None] * rows) for var in variables})
+
+
+def read_limited(chunks, max_bytes=None):
+    body = bytearray()
+    for chunk in chunks:
+        body += chunk
+        if max_bytes is not None and len(body) > max_bytes:
+            raise ResultTooLarge()
+    return bytes(body)
+
+
+def read_delimited(chunks, max_rows=None, max_bytes=None, **kwargs):
+    body = read_limited(chunks, max_bytes)
+    tail = body[-4096:]
+    if not body.strip() or SERVICE_ERROR.search(tail):
+        # errors such as timeouts are appended to the partial result
+        raise ResultDecodeError(tail.decode("utf-8", errors="replace"))
+    try:
+        df = pd.read_csv(
+            io.BytesIO(body),
+            dtype=str,
+            keep_default_na=False,
+            na_values=[""],
+            nrows=None if max_rows is None else max_rows + 1,
+            engine="c",
+            **kwargs,
+        )
+    except (ValueError, ParserError, UnicodeDecodeError):
+        raise ResultDecodeError(tail.decode("utf-8", errors="replace"))
+    if max_rows is not None and df.shape[0] > max_rows:
+        raise ResultTooLarge()
+    return df
+
+
+def unbound_to_none(df):
+    if df.shape[0] == 0:
+        return pd.DataFrame()
+    return df.astype(object).where(df.notna(), None)
+
+
+def decode_csv(chunks, max_rows=None, max_bytes=None):
+    """
+    Decodes a SPARQL CSV result, where every term is already its plain value.
+    Empty strings and unbound variables can't be told apart and become None.
+    """
+    df = read_delimited(chunks, max_rows, max_bytes)
+    return unbound_to_none(df)
+
+
+def decode_tsv(chunks, max_rows=None, max_bytes=None):
+    """
+    Decodes a SPARQL TSV result into the same values the JSON result has.
+
+    Terms are written in Turtle syntax, so `<...>` IRIs are unwrapped, literals
+    lose their quotes, language tags and datatypes, and blank nodes lose `_:`.
+    """
+    df = read_delimited(chunks, max_rows, max_bytes, sep="\t", quoting=csv.QUOTE_NONE)
+    df.columns = [column.lstrip("?$") for column in df.columns]
+    for column in df.columns:
+        df[column] = unwrap_terms(df[column])
+    return unbound_to_none(df)
+
+
+def unwrap_terms(terms):
+    terms = terms.copy()
+    iris = terms.str.startswith("<", na=False) & terms.str.endswith(">", na=False)
+    terms[iris] = terms[iris].str.slice(1, -1)
+    blanks = terms.str.startswith("_:", na=False)
+    terms[blanks] = terms[blanks].str.slice(2)
+    literals = terms.str.startswith('"', na=False)
+    if literals.any():
+        lexical = terms[literals].str.extract(TSV_LITERAL, expand=False)
+        escaped = lexical.str.contains("\\", regex=False, na=False)
+        lexical[escaped] = lexical[escaped].str.replace(TSV_ESCAPE, unescape, regex=True)
+        terms[literals] = lexical
+    return terms
+
+
+def unescape(match):
+    escape = match.group(0)
+    if len(escape) > 2:
+        return chr(int(escape[2:], 16))
+    return TSV_ESCAPES.get(escape[1], escape)
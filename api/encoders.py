@@ -0,0 +1,80 @@
+import orjson
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from graphs.bar_chart_race import Series
+
+LIST_BATCH = 1000  # items of a long list encoded at a time
+BUFFER_SIZE = 64 * 1024
+
+OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+django_encoder = DjangoJSONEncoder()
+
+
+def default(value):
+    if isinstance(value, Series):
+        return value.to_data()
+    return django_encoder.default(value)
+
+
+def dumps(value):
+    """
+    Encodes a value as JSON bytes, with NumPy arrays and scalars, the types
+    supported by `DjangoJSONEncoder` and `Series`. NaN and infinity are
+    encoded as null.
+    """
+    return orjson.dumps(value, default=default, option=OPTIONS)
+
+
+def iter_json(value):
+    """
+    Generator of the JSON encoding of a value in parts, the same as
+    `dumps(value)`. Dictionaries are encoded key by key, lists longer than
+    `LIST_BATCH` in batches of items and `Series` in batches of frames, so
+    the encoding is never held in memory at once.
+    """
+    if isinstance(value, Series):
+        yield from value.iter_json(dumps)
+    elif isinstance(value, dict):
+        separator = b"{"
+        for key, item in value.items():
+            yield separator + dumps(str(key)) + b":"
+            yield from iter_json(item)
+            separator = b","
+        yield b"}" if value else b"{}"
+    elif isinstance(value, list) and len(value) > LIST_BATCH:
+        separator = b"["
+        for start in range(0, len(value), LIST_BATCH):
+            yield separator + dumps(value[start : start + LIST_BATCH])[1:-1]
+            separator = b","
+        yield b"]"
+    else:
+        yield dumps(value)
+
+
+def buffered(parts, size=BUFFER_SIZE):
+    """
+    Joins small parts of a stream into chunks of at least `size` bytes.
+    """
+    chunk = []
+    length = 0
+    for part in parts:
+        chunk.append(part)
+        length += len(part)
+        if length >= size:
+            yield b"".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+class StreamingJsonResponse(StreamingHttpResponse):
+    """
+    Response with the JSON encoding of a value, written while it is encoded.
+    """
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(buffered(iter_json(data)), **kwargs)
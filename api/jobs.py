@@ -0,0 +1,142 @@
+import logging
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.timezone import now
+
+from api.encoders import dumps
+from api.models import QueryJob
+from api.queries import charts_from_query
+from graphs.table import Table
+from infographics.timing import collect
+from infographics.timing import log_timings
+
+logger = logging.getLogger("infographics")
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.QUERY_JOB_WORKERS,
+            thread_name_prefix="query-job",
+        )
+    return _executor
+
+
+def submit_job(
+    query,
+    use_cache=True,
+    chunk_size=None,
+    order_key=None,
+    granularity=None,
+    encoding="records",
+    precision=None,
+):
+    """
+    Creates a job for the query and runs it in the background pool, or right
+    away when `QUERY_JOB_WORKERS` is 0.
+
+    When fetched in chunks, the table of the first chunk is saved in the job as
+    soon as it arrives so it can be shown while the rest is fetched.
+
+    :return: the created QueryJob
+    """
+    QueryJob.objects.cull()
+    job = QueryJob.objects.create(
+        query=query,
+        use_cache=use_cache,
+        chunk_size=chunk_size,
+        order_key=order_key,
+        granularity=granularity or "",
+        encoding=encoding,
+        precision=precision,
+    )
+    if settings.QUERY_JOB_WORKERS == 0:
+        run_job(job.id)
+        job.refresh_from_db()
+    else:
+        get_executor().submit(run_background_job, job.id)
+    return job
+
+
+def expire_job(job):
+    """
+    Fails the job when it is still pending or running and there was no sign
+    of progress, its heartbeat or else its creation, for `QUERY_JOB_TIMEOUT`
+    seconds, as happens when the worker running it was restarted.
+
+    :return: the job, updated
+    """
+    if job.status not in (QueryJob.PENDING, QueryJob.RUNNING):
+        return job
+    if (job.heartbeat or job.created) > now() - timedelta(seconds=settings.QUERY_JOB_TIMEOUT):
+        return job
+    expired = QueryJob.objects.filter(id=job.id, status=job.status, heartbeat=job.heartbeat).update(
+        status=QueryJob.FAILED, error="preview-error-timeout", finished=now()
+    )
+    if expired:
+        logger.warning(f"[{job}] expired")
+    job.refresh_from_db()
+    return job
+
+
+def run_background_job(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def run_job(job_id):
+    """
+    Runs a pending job. The job is only updated while it is running, so a job
+    failed by `expire_job` in the meantime stays failed.
+    """
+    timestamp = now()
+    running = QueryJob.objects.filter(id=job_id, status=QueryJob.PENDING).update(
+        status=QueryJob.RUNNING, started=timestamp, heartbeat=timestamp
+    )
+    if not running:
+        return
+    job = QueryJob.objects.get(id=job_id)
+
+    def on_chunk(chunk, rows):
+        update = {"rows": rows, "heartbeat": now()}
+        if rows == chunk.shape[0]:
+            update["partial"] = dumps({"table": Table(chunk).page()}).decode()
+        QueryJob.objects.filter(id=job_id, status=QueryJob.RUNNING).update(**update)
+
+    try:
+        with collect() as timings:
+            result = charts_from_query(
+                job.query,
+                use_cache=job.use_cache,
+                chunk_size=job.chunk_size,
+                order_key=job.order_key,
+                on_chunk=on_chunk,
+                granularity=job.granularity or None,
+                encoding=job.encoding,
+                precision=job.precision,
+            )
+        log_timings(timings, job=str(job.id))
+    except Exception:
+        logger.exception(f"[{job}] failed")
+        job.status = QueryJob.FAILED
+        job.error = "preview-error-general"
+    else:
+        if "error" in result:
+            job.status = QueryJob.FAILED
+            job.error = result["error"]
+        else:
+            job.status = QueryJob.DONE
+            job.result = dumps(result).decode()
+    finished = QueryJob.objects.filter(id=job_id, status=QueryJob.RUNNING).update(
+        status=job.status, error=job.error, result=job.result, finished=now()
+    )
+    if not finished:
+        logger.warning(f"[{job}] expired before it finished")
@@ -0,0 +1,160 @@
+"""
+Load test driver for a running instance of the tool.
+
+Each scenario is a sequence of requests made by one virtual user. Scenarios are
+repeated by `concurrency` threads until `iterations` of them have finished, and
+the latency of every request is recorded under the name of its endpoint, with
+the stages of its Server-Timing header when the instance runs with
+SERVER_TIMING set.
+"""
+
+import time
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100"><circle r="45" cx="50" cy="50"/></svg>"""
+
+
+def percentile(values, p):
+    """
+    Percentile with linear interpolation between the closest ranks.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def parse_server_timing(header):
+    """
+    Durations in seconds of the stages of a Server-Timing header, by name.
+    """
+    stages = {}
+    for part in header.split(","):
+        name, *params = [param.strip() for param in part.split(";")]
+        for param in params:
+            key, _, value = param.partition("=")
+            if key == "dur" and name:
+                stages[name] = stages.get(name, 0.0) + float(value) / 1000
+    return stages
+
+
+class LoadTest:
+    def __init__(self, base_url, queries, concurrency=4, iterations=20, frames=10, use_cache=True):
+        self.base_url = base_url.rstrip("/")
+        self.queries = queries
+        self.concurrency = concurrency
+        self.iterations = iterations
+        self.frames = frames
+        self.use_cache = use_cache
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.stages = defaultdict(lambda: defaultdict(list))
+        self.errors = defaultdict(int)
+        self.local = threading.local()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def request(self, name, method, path, expected, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = self.session().request(method, self.base_url + path, **kwargs)
+            ok = res.status_code in expected
+        except requests.RequestException:
+            res = None
+            ok = False
+        elapsed = time.perf_counter() - start
+        stages = parse_server_timing(res.headers.get("Server-Timing", "")) if res is not None else {}
+        with self.lock:
+            self.latencies[name].append(elapsed)
+            for stage, duration in stages.items():
+                self.stages[name][stage].append(duration)
+            if not ok:
+                self.errors[name] += 1
+        return res if ok else None
+
+    def scenario_query(self, i):
+        query = self.queries[i % len(self.queries)]
+        params = {"query": query}
+        if not self.use_cache:
+            params["cache"] = "false"
+        self.request("query", "GET", "/api/query/", (200,), params=params)
+
+    def scenario_shortlink(self, i):
+        query = self.queries[i % len(self.queries)]
+        res = self.request(
+            "shortlink generate", "POST", "/api/shortlink/generate/", (201,), data={"query": query}
+        )
+        if res is not None:
+            url = res.json()["url"]
+            self.request("shortlink redirect", "GET", url, (302,), allow_redirects=False)
+
+    def scenario_video(self, i):
+        res = self.request("video create", "POST", "/api/video/create/", (201,))
+        if res is None:
+            return
+        id = res.json()["id"]
+        for ordering in range(self.frames):
+            self.request(
+                "video frame",
+                "POST",
+                f"/api/video/{id}/frame/",
+                (201,),
+                data={"ordering": ordering, "svg": SVG},
+            )
+        self.request("video generate", "GET", f"/api/video/{id}/generate/?framerate=36", (200,))
+
+    def run(self, scenarios):
+        """
+        Runs the scenarios, given by name, and returns the report.
+        """
+        functions = [getattr(self, f"scenario_{name}") for name in scenarios]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(functions[i % len(functions)], i)
+                for i in range(self.iterations)
+            ]
+            for future in futures:
+                future.result()
+        return self.report(time.perf_counter() - start)
+
+    def report(self, duration):
+        endpoints = {}
+        for name, latencies in sorted(self.latencies.items()):
+            endpoints[name] = {
+                "requests": len(latencies),
+                "errors": self.errors[name],
+                "throughput": len(latencies) / duration if duration else None,
+                "p50": percentile(latencies, 50),
+                "p95": percentile(latencies, 95),
+                "p99": percentile(latencies, 99),
+                "stages": {
+                    stage: percentile(durations, 50) for stage, durations in self.stages[name].items()
+                },
+            }
+        return {"duration": duration, "concurrency": self.concurrency, "endpoints": endpoints}
+
+
+def format_report(report):
+    lines = [
+        f"duration {report['duration']:.2f}s, concurrency {report['concurrency']}",
+        f"{'endpoint':<20}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}",
+    ]
+    for name, stats in report["endpoints"].items():
+        lines.append(
+            f"{name:<20}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput']:>9.2f}"
+            f"{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}"
+        )
+        for stage, p50 in stats.get("stages", {}).items():
+            lines.append(f"  {stage:<18}{'':>35}{p50:>9.3f}")
+    return "\n".join(lines)
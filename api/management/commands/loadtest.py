@@ -0,0 +1,57 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.loadtest import format_report
+from api.loadtest import LoadTest
+
+DEFAULT_QUERY = """#standin: entities=50 years=30
+SELECT ?item ?itemLabel ?population ?date WHERE {
+  ?item wdt:P31 wd:Q3184121.
+  ?item p:P1082 ?population_node.
+  ?population_node ps:P1082 ?population.
+  ?population_node pq:P585 ?date.
+  SERVICE wikibase:label { bd:serviceParam wikibase:language "pt-br". }
+}
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Load tests a running instance, reporting throughput and p50/p95/p99 "
+        "latency per endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=["query", "shortlink", "video"],
+            help="can be repeated, defaults to all",
+        )
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--frames", type=int, default=10, help="frames per video")
+        parser.add_argument("--query-file", action="append", help="can be repeated")
+        parser.add_argument("--no-cache", action="store_true", help="bypass the query cache")
+        parser.add_argument("--output", help="also write the report as JSON to this file")
+
+    def handle(self, *args, **options):
+        queries = []
+        for path in options["query_file"] or []:
+            with open(path) as f:
+                queries.append(f.read())
+        load_test = LoadTest(
+            options["url"],
+            queries or [DEFAULT_QUERY],
+            concurrency=options["concurrency"],
+            iterations=options["iterations"],
+            frames=options["frames"],
+            use_cache=not options["no_cache"],
+        )
+        report = load_test.run(options["scenario"] or ["query", "shortlink", "video"])
+        self.stdout.write(format_report(report))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
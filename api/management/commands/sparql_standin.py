@@ -0,0 +1,67 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from api.sparql import get_response
+from api.standin import StandinServer
+from api.utils import query_key
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves a local stand-in for the SPARQL endpoint. "
+        "Point SPARQL_ENDPOINT to it to run the tool without Wikidata."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+        parser.add_argument("--jitter", type=float, default=0.0, help="standard deviation of the latency")
+        parser.add_argument("--records", help="directory of recorded responses")
+        parser.add_argument(
+            "--record",
+            metavar="QUERY_FILE",
+            help="fetch the query from SPARQL_ENDPOINT into the records directory and exit",
+        )
+        parser.add_argument("--entities", type=int, default=10)
+        parser.add_argument("--years", type=int, default=10)
+        parser.add_argument("--per-year", type=int, default=1)
+        parser.add_argument("--category", action="store_true")
+        parser.add_argument("--sparse", type=float, default=0.0)
+
+    def handle(self, *args, **options):
+        if options["record"]:
+            return self.record(options["record"], options["records"])
+        server = StandinServer(
+            (options["host"], options["port"]),
+            latency=options["latency"],
+            jitter=options["jitter"],
+            records=options["records"],
+            entities=options["entities"],
+            years=options["years"],
+            per_year=options["per_year"],
+            category=options["category"],
+            sparse=options["sparse"],
+        )
+        self.stdout.write(f"serving SPARQL stand-in at {server.endpoint}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+
+    def record(self, query_file, records):
+        if not records:
+            self.stderr.write("--records is required to record a query")
+            return
+        os.makedirs(records, exist_ok=True)
+        with open(query_file) as f:
+            query = f.read()
+        for transport, extension in (("json", "json"), ("tsv", "tsv")):
+            with get_response(query, transport) as response:
+                response.raise_for_status()
+                path = os.path.join(records, f"{query_key(query)}.{extension}")
+                with open(path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+            self.stdout.write(f"recorded {path}")
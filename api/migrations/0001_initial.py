@@ -0,0 +1,27 @@
+# Generated by Django 5.1.8 on 2026-10-18 07:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Hash of the normalized query', max_length=64, unique=True)),
+                ('query', models.TextField()),
+                ('payload', models.TextField(help_text='Columns and rows of the result as JSON')),
+                ('size', models.PositiveIntegerField()),
+                ('fetched', models.DateTimeField()),
+                ('accessed', models.DateTimeField(db_index=True)),
+                ('refreshing', models.BooleanField(default=False)),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.8 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_query_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryjob',
+            name='chunk_size',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryjob',
+            name='order_key',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryjob',
+            name='partial',
+            field=models.TextField(blank=True, help_text='Table of the first chunk as JSON'),
+        ),
+        migrations.AddField(
+            model_name='queryjob',
+            name='rows',
+            field=models.PositiveIntegerField(default=0, help_text='Rows fetched so far'),
+        ),
+    ]
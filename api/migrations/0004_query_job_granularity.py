@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_query_job_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryjob',
+            name='granularity',
+            field=models.CharField(blank=True, help_text='Bar chart race series to build', max_length=8),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.8 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_query_job_granularity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryjob',
+            name='encoding',
+            field=models.CharField(default='records', help_text='Encoding of the bar chart race series', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='queryjob',
+            name='precision',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
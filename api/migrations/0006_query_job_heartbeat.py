@@ -0,0 +1,18 @@
+# Generated by Django 5.1.8 on 2026-10-18 09:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_query_job_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, help_text='Last progress of the running job', null=True),
+        ),
+    ]
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import threading
+import uuid
+from datetime import timedelta
+
+import pandas as pd
+from django.conf import settings
+from django.db import models
+from django.utils.timezone import now
+
+from api.utils import query_key
+
+# Each worker evicts the least recently accessed results after storing this
+# fraction of QUERY_CACHE_MAX_BYTES, so the cache grows beyond it by at most
+# that much per worker.
+CULL_FRACTION = 16
+
+_lock = threading.Lock()
+# bytes stored by this worker since the last cull, and whether it culled yet
+_stored = 0
+_culled = False
+
+
+class QueryResultManager(models.Manager):
+    def lookup(self, sparql_string):
+        """
+        Returns the cached result for the query, or None if there is none or it is too old
+        to be served even as stale. Its access time is only updated once it is older than
+        `QUERY_CACHE_TOUCH_INTERVAL`, so most hits don't write to the database.
+        """
+        key = query_key(sparql_string)
+        timestamp = now()
+        oldest = timestamp - timedelta(
+            seconds=settings.QUERY_CACHE_TTL + settings.QUERY_CACHE_STALE
+        )
+        result = self.filter(key=key, fetched__gte=oldest).first()
+        if result is not None:
+            touched = timestamp - timedelta(seconds=settings.QUERY_CACHE_TOUCH_INTERVAL)
+            if result.accessed < touched:
+                self.filter(pk=result.pk, accessed__lt=touched).update(accessed=timestamp)
+        return result
+
+    def store(self, sparql_string, df):
+        key = query_key(sparql_string)
+        payload = json.dumps(
+            {"columns": list(df.columns), "data": df.values.tolist()},
+            ensure_ascii=False,
+        )
+        timestamp = now()
+        result, created = self.update_or_create(
+            key=key,
+            defaults={
+                "query": sparql_string,
+                "payload": payload,
+                "size": len(payload),
+                "fetched": timestamp,
+                "accessed": timestamp,
+                "refreshing": False,
+            },
+        )
+        self.stored(result.size)
+        return result
+
+    def stored(self, size):
+        """
+        Counts the bytes stored by this worker, culling the cache once they reach
+        `1 / CULL_FRACTION` of `QUERY_CACHE_MAX_BYTES`, and on its first store.
+        """
+        global _stored, _culled
+        with _lock:
+            _stored += size
+            if _culled and _stored < settings.QUERY_CACHE_MAX_BYTES / CULL_FRACTION:
+                return
+            _stored = 0
+            _culled = True
+        self.cull()
+
+    def cull(self):
+        """
+        Evicts the least recently accessed results until the cache fits in
+        `QUERY_CACHE_MAX_BYTES`.
+        """
+        total = 0
+        evict = []
+        for id, size in self.order_by("-accessed").values_list("id", "size"):
+            total += size
+            if total > settings.QUERY_CACHE_MAX_BYTES:
+                evict.append(id)
+        if evict:
+            self.filter(id__in=evict).delete()
+
+    def claim_refresh(self, result):
+        """
+        Marks a stale result as being refreshed. Returns False when some other
+        worker already claimed it.
+        """
+        return self.filter(pk=result.pk, refreshing=False).update(refreshing=True) == 1
+
+    def release_refresh(self, sparql_string):
+        self.filter(key=query_key(sparql_string)).update(refreshing=False)
+
+
+class QueryResult(models.Model):
+    """
+    Result of a SPARQL query, shared between all workers through the database.
+    """
+
+    key = models.CharField(max_length=64, unique=True, help_text="Hash of the normalized query")
+    query = models.TextField()
+    payload = models.TextField(help_text="Columns and rows of the result as JSON")
+    size = models.PositiveIntegerField()
+    fetched = models.DateTimeField()
+    accessed = models.DateTimeField(db_index=True)
+    refreshing = models.BooleanField(default=False)
+
+    objects = QueryResultManager()
+
+    def __str__(self):
+        return f"query result {self.key[:8]}"
+
+    def is_stale(self):
+        return self.fetched < now() - timedelta(seconds=settings.QUERY_CACHE_TTL)
+
+    def digest(self):
+        """
+        Hash of the content of the result, which keys the charts saved from it.
+        """
+        return hashlib.sha256(self.payload.encode("utf-8")).hexdigest()
+
+    def to_df(self):
+        """
+        The result as a DataFrame, with its digest in the "digest" attribute.
+        """
+        data = json.loads(self.payload)
+        df = pd.DataFrame(data["data"], columns=data["columns"])
+        df.attrs["digest"] = self.digest()
+        return df
+
+
+class QueryJobManager(models.Manager):
+    def cull(self):
+        oldest = now() - timedelta(seconds=settings.QUERY_JOB_RETENTION)
+        self.filter(created__lt=oldest).delete()
+
+
+class QueryJob(models.Model):
+    """
+    Query and charts computation running in the background.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    query = models.TextField()
+    use_cache = models.BooleanField(default=True)
+    chunk_size = models.PositiveIntegerField(blank=True, null=True)
+    order_key = models.CharField(max_length=255, blank=True, null=True)
+    granularity = models.CharField(max_length=8, blank=True, help_text="Bar chart race series to build")
+    encoding = models.CharField(max_length=8, default="records", help_text="Encoding of the bar chart race series")
+    precision = models.PositiveSmallIntegerField(blank=True, null=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    result = models.TextField(blank=True, help_text="Response of the query as JSON")
+    error = models.TextField(blank=True)
+    rows = models.PositiveIntegerField(default=0, help_text="Rows fetched so far")
+    partial = models.TextField(blank=True, help_text="Table of the first chunk as JSON")
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True, help_text="Last progress of the running job")
+    finished = models.DateTimeField(blank=True, null=True)
+
+    objects = QueryJobManager()
+
+    def __str__(self):
+        return f"query job {self.id}"
+
+    def to_dict(self):
+        data = {
+            "id": str(self.id),
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "rows": self.rows,
+        }
+        if self.error:
+            data["error"] = self.error
+        if self.partial and self.status == self.RUNNING:
+            data["partial"] = json.loads(self.partial)
+        return data
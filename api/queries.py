@@ -0,0 +1,188 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from api.models import QueryResult
+from api.sparql import df_from_query
+from api.singleflight import SingleFlight
+from api.utils import query_key
+from graphs.bar_chart_race import BaseDfException
+from graphs.bar_chart_race import FRAME_BARS
+from graphs.bar_chart_race import bar_chart_race_series
+from graphs.bar_chart_race import prepared_base_df
+from graphs.bar_chart_race import select_time_units
+from graphs.budget import plan_time_units
+from graphs.table import Table
+from graphs.utils import charts_from_df
+
+flights = SingleFlight()
+
+
+class MemoryCache:
+    """
+    Data built from query results, kept in memory by each worker so that the
+    requests following the first response skip fetching and preparing the
+    result again. Above the number of entries in the `size_setting` setting
+    the least recently used one is dropped.
+    """
+
+    def __init__(self, size_setting):
+        self.size_setting = size_setting
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > getattr(settings, self.size_setting):
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Prepared bar chart race data, to build the series of other granularities
+prepared = MemoryCache("CHART_PREPARED_CACHE_SIZE")
+# Query results served as table pages
+tables = MemoryCache("TABLE_CACHE_SIZE")
+
+
+def charts_from_query(
+    query,
+    use_cache=True,
+    chunk_size=None,
+    order_key=None,
+    on_chunk=None,
+    granularity=None,
+    encoding="records",
+    precision=None,
+    charts=None,
+):
+    """
+    Runs the query and builds the data for all charts, or the requested ones.
+
+    Identical queries running at the same time, in this or other workers, are
+    executed only once. The result must not be modified, since it can be shared.
+
+    :param query: SPARQL query string
+    :param use_cache: when False the query result cache is bypassed and refreshed
+    :param chunk_size: fetch the query in pages of this many rows, see `df_from_query`
+    :param order_key: variable used to order the pages
+    :param on_chunk: called with each page as it arrives
+    :param granularity: bar chart race series to build, see `process_bar_chart_race`
+    :param encoding: encoding of the bar chart race series, see `bar_chart_race_series`
+    :param precision: significant digits of the values in the compact format
+    :param charts: names of the charts to build, all of them when None, see `graphs.registry`
+    :return: dictionary with the charts data, or with an "error" key
+    """
+    def run():
+        return _charts_from_query(
+            query, use_cache, chunk_size, order_key, on_chunk, granularity, encoding, precision, charts
+        )
+
+    if not use_cache:
+        return run()
+    key = query_key(query)
+    if chunk_size:
+        key = f"{key}-{chunk_size}-{order_key}"
+    if granularity:
+        key = f"{key}-{granularity}"
+    if encoding != "records":
+        key = f"{key}-{encoding}-{precision}"
+    if charts is not None:
+        key = f"{key}-{','.join(charts)}"
+    return flights.do(key, run)
+
+
+def _charts_from_query(
+    query,
+    use_cache=True,
+    chunk_size=None,
+    order_key=None,
+    on_chunk=None,
+    granularity=None,
+    encoding="records",
+    precision=None,
+    charts=None,
+):
+    df = df_from_query(
+        query,
+        use_cache=use_cache,
+        chunk_size=chunk_size,
+        order_key=order_key,
+        on_chunk=on_chunk,
+    )
+    if isinstance(df, dict) and "error" in df:
+        return df
+    key = query_key(query)
+    tables.put(key, Table(df))
+    charts = charts_from_df(
+        df, granularity, lambda bdf: prepared.put(key, bdf), encoding, precision, charts
+    )
+    if "table" in charts:
+        charts["table"]["key"] = key
+    return {"msg": "Successful", "data": charts}
+
+
+def series_from_query(query, granularity, encoding="records", precision=None):
+    """
+    Builds the bar chart race series of a granularity for a query, usually one
+    already run, from its prepared data or else from the query result cache.
+
+    # Raises
+
+    - `ValueError` if the granularity is not available for the query result.
+
+    :return: dictionary with the series, or with an "error" key
+    """
+    key = query_key(query)
+    bdf = prepared.get(key)
+    if bdf is None:
+        df = df_from_query(query)
+        if isinstance(df, dict) and "error" in df:
+            return df
+        try:
+            bdf = prepared_base_df(df)
+        except BaseDfException as e:
+            return {"msg": "Successful", "data": {"failed": e.message}}
+        prepared.put(key, bdf)
+    observations = bdf.observations()
+    plan = plan_time_units(observations, encoding, FRAME_BARS)
+    time_units = select_time_units(granularity, observations, plan)
+    if not time_units:
+        raise ValueError(f"{granularity} series not available")
+    series = bar_chart_race_series(bdf, time_units, encoding, precision, plan)
+    series["plan"] = {time_unit: plan[time_unit].to_dict() for time_unit in time_units}
+    return {"msg": "Successful", "data": series}
+
+
+def table_from_key(key):
+    """
+    Table of the query result with the key, see `query_key`, from memory or
+    else from the query result cache.
+
+    :return: Table, None when no query with the key was run, or a dictionary
+        with an "error" key
+    """
+    table = tables.get(key)
+    if table is not None:
+        return table
+    result = QueryResult.objects.filter(key=key).first()
+    if result is None:
+        return None
+    df = df_from_query(result.query)
+    if isinstance(df, dict) and "error" in df:
+        return df
+    table = Table(df)
+    tables.put(key, table)
+    return table
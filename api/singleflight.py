@@ -0,0 +1,80 @@
+import os
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+from django.conf import settings
+
+logger = logging.getLogger("infographics")
+
+
+class SingleFlight:
+    """
+    Runs a function only once for concurrent calls with the same key.
+
+    Calls in the same process wait for the running one and share its result.
+    Calls in other workers wait on a lock file, so they start only after the
+    first one finished and can find its results in the caches.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            logger.debug(f"waiting for running call {key[:8]}")
+            return call.result()
+        try:
+            with file_lock(key):
+                result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+@contextmanager
+def file_lock(key):
+    """
+    Holds an exclusive lock on the file of the key, waiting at most
+    `QUERY_LOCK_TIMEOUT` seconds for it before going on without the lock.
+
+    Keys are hashed into `QUERY_LOCK_SLOTS` files, so a few different keys
+    share a lock and rarely wait for each other.
+    """
+    os.makedirs(settings.QUERY_LOCK_DIR, exist_ok=True)
+    slot = int(hashlib.sha256(key.encode()).hexdigest(), 16) % settings.QUERY_LOCK_SLOTS
+    path = os.path.join(settings.QUERY_LOCK_DIR, f"{slot}.lock")
+    with open(path, "a") as f:
+        deadline = time.monotonic() + settings.QUERY_LOCK_TIMEOUT
+        locked = False
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    logger.warning(f"timed out waiting for lock {key[:8]}")
+                    break
+                time.sleep(0.05)
+        try:
+            yield locked
+        finally:
+            if locked:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -1,48 +1,212 @@
+import logging
+import threading
+
 import requests
 import pandas as pd
 import re
 
-from requests.exceptions import JSONDecodeError
+from django.conf import settings
+from django.db import close_old_connections
+
+from api.client import get_client
+from api.client import SparqlOverloaded
+from api.models import QueryResult
+from api.utils import normalize_query
+from api.decoders import decode_csv
+from api.decoders import decode_json_bindings
+from api.decoders import decode_tsv
+from api.decoders import ResultDecodeError
+from api.decoders import ResultTooLarge
+from infographics.timing import counted
+from infographics.timing import stage
+
+logger = logging.getLogger("infographics")
+
+CHUNK_SIZE = 64 * 1024
+
+ACCEPT = {
+    "json": "application/json",
+    "tsv": "text/tab-separated-values",
+    "csv": "text/csv",
+}
 
-def df_from_query(sparql_string):
+DECODERS = {
+    "text/tab-separated-values": decode_tsv,
+    "text/csv": decode_csv,
+}
+
+
+def df_from_query(sparql_string, use_cache=True, chunk_size=None, order_key=None, on_chunk=None):
     """
     Query the Wikidata SPARQL endpoint and return the results as a DataFrame.
 
+    Results are cached for all workers. A result older than `QUERY_CACHE_TTL` is
+    still served for `QUERY_CACHE_STALE` more seconds while it is refreshed in
+    the background.
+
     :param sparql_string: SPARQL query string
+    :param use_cache: when False the cache is bypassed and refreshed with a new result
+    :param chunk_size: when given with `order_key`, the query is fetched in pages
+        of this many rows
+    :param order_key: variable, without "?", used to order the pages
+    :param on_chunk: called with each page and the number of rows fetched so far
     :return: DataFrame containing the results
     """
-    response = get_response(sparql_string)
+    if use_cache:
+        with stage("cache") as record:
+            cached = QueryResult.objects.lookup(sparql_string)
+            if cached is not None:
+                record["bytes"] = cached.size
+        if cached is not None:
+            if cached.is_stale() and QueryResult.objects.claim_refresh(cached):
+                revalidate_in_background(sparql_string)
+            with stage("cache_decode", bytes=cached.size) as record:
+                df = cached.to_df()
+                record["rows"] = df.shape[0]
+            return df
+
+    if chunk_size:
+        df = fetch_df_chunked(sparql_string, chunk_size, order_key, on_chunk)
+    else:
+        df = fetch_df(sparql_string)
+    if not isinstance(df, dict):
+        with stage("cache_store", rows=df.shape[0]) as record:
+            result = QueryResult.objects.store(sparql_string, df)
+            df.attrs["digest"] = result.digest()
+            record["bytes"] = result.size
+    return df
 
-    if response.status_code != 200:
-        error_response = extract_error_message(response.text)
-        return {"error": error_response}
 
-    if "java.util.concurrent.TimeoutException" in response.text:
-        return {"error": "preview-error-timeout"}
+def fetch_df_chunked(sparql_string, chunk_size, order_key=None, on_chunk=None):
+    """
+    Query the endpoint in pages using LIMIT and OFFSET, so that each request is
+    small enough to finish before the query service timeout.
+
+    The pages are ordered by `order_key`, since the endpoint doesn't keep the
+    order of unordered results between requests, which would repeat or skip
+    rows. Queries without an order key, or that already use LIMIT, OFFSET or
+    ORDER BY, are fetched in one go.
 
+    :return: DataFrame with all pages or a dictionary with an error
+    """
+    if not can_be_paged(sparql_string, order_key):
+        df = fetch_df(sparql_string)
+        if on_chunk is not None and not isinstance(df, dict):
+            on_chunk(df, df.shape[0])
+        return df
+    chunks = []
+    rows = 0
+    while True:
+        chunk = fetch_df(paged_query(sparql_string, chunk_size, rows, order_key))
+        if isinstance(chunk, dict):
+            return chunk
+        chunks.append(chunk)
+        rows += chunk.shape[0]
+        if rows > settings.QUERY_MAX_ROWS:
+            return {"error": "preview-error-too-large"}
+        if on_chunk is not None:
+            on_chunk(chunk, rows)
+        if chunk.shape[0] < chunk_size:
+            break
+    return pd.concat(chunks, ignore_index=True)
+
+
+def can_be_paged(sparql_string, order_key=None):
+    if order_key is None or not re.fullmatch(r"\w+", order_key):
+        return False
+    modifiers = r"\b(LIMIT|OFFSET|ORDER\s+BY)\b"
+    return re.search(modifiers, normalize_query(sparql_string), re.IGNORECASE) is None
+
+
+def paged_query(sparql_string, limit, offset, order_key):
+    return f"{sparql_string.rstrip()}\nORDER BY ?{order_key}\nLIMIT {limit}\nOFFSET {offset}"
+
+
+def revalidate_in_background(sparql_string):
+    thread = threading.Thread(target=revalidate, args=(sparql_string,), daemon=True)
+    thread.start()
+
+
+def revalidate(sparql_string):
     try:
-        data = response.json()
-    except JSONDecodeError:
-        return {"error": "preview-error-general"}
+        df = fetch_df(sparql_string)
+        if isinstance(df, dict):
+            logger.warning(f"failed to refresh cached query: {df['error']}")
+            QueryResult.objects.release_refresh(sparql_string)
+        else:
+            QueryResult.objects.store(sparql_string, df)
+    except Exception:
+        # the stale result is refreshed again by the next request
+        logger.exception("failed to refresh cached query")
+        QueryResult.objects.release_refresh(sparql_string)
+    finally:
+        close_old_connections()
+
+
+def fetch_df(sparql_string, transport=None):
+    """
+    Query the Wikidata SPARQL endpoint, skipping the cache.
 
-    results = data["results"]["bindings"]
-    variables = data["head"]["vars"]
+    The result is requested in the `QUERY_TRANSPORT` format. TSV and CSV are
+    parsed much faster than JSON; if they can't be parsed the query is repeated
+    asking for JSON.
 
-    df = pd.DataFrame(
-        [
-            {var: binding.get(var, {}).get("value", None) for var in variables}
-            for binding in results
-        ]
-    )
+    :param sparql_string: SPARQL query string
+    :param transport: one of "json", "tsv" or "csv"
+    :return: DataFrame containing the results or a dictionary with an error
+    """
+    transport = transport or settings.QUERY_TRANSPORT
+    try:
+        with stage("sparql"):
+            response = get_response(sparql_string, transport)
+    except SparqlOverloaded:
+        return {"error": "preview-error-overloaded"}
+    except requests.Timeout:
+        return {"error": "preview-error-timeout"}
+    except requests.ConnectionError:
+        return {"error": "preview-error-fetching-data"}
+
+    with response:
+        if response.status_code == 429:
+            return {"error": "preview-error-overloaded"}
+        if response.status_code != 200:
+            error_response = extract_error_message(response.text)
+            return {"error": error_response}
+
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        decode = DECODERS.get(content_type, decode_json_bindings)
+        try:
+            # the body is downloaded while it is decoded
+            with stage("decode") as record:
+                df = decode(
+                    counted(response.iter_content(chunk_size=CHUNK_SIZE), record),
+                    max_rows=settings.QUERY_MAX_ROWS,
+                    max_bytes=settings.QUERY_MAX_BYTES,
+                )
+                record["rows"] = df.shape[0]
+        except ResultTooLarge:
+            return {"error": "preview-error-too-large"}
+        except requests.RequestException:
+            # the endpoint stopped sending the body
+            get_client().breaker.record_failure()
+            return {"error": "preview-error-timeout"}
+        except ResultDecodeError as e:
+            if "java.util.concurrent.TimeoutException" in e.text:
+                return {"error": "preview-error-timeout"}
+            if decode is not decode_json_bindings:
+                logger.warning(f"failed to decode {content_type} result, retrying with json")
+                return fetch_df(sparql_string, transport="json")
+            return {"error": "preview-error-general"}
 
     return df
 
 
-def get_response(sparql_string):
-    url = "https://query.wikidata.org/sparql"
-    params = {"query": sparql_string, "format": "json"}
-    headers = {"User-agent": "Wiki-Infographics 1.0", "Accept": "application/json"}
-    return requests.get(url, headers=headers, params=params)
+def get_response(sparql_string, transport="json"):
+    params = {"query": sparql_string}
+    if transport == "json":
+        params["format"] = "json"
+    headers = {"Accept": ACCEPT[transport]}
+    return get_client().get(params, headers)
 
 
 def extract_error_message(error_str):
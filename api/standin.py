@@ -0,0 +1,157 @@
+"""
+Local stand-in for the Wikidata SPARQL endpoint, to measure the tool offline.
+
+Queries are answered with a recorded response, looked up by the key of the
+normalized query in the records directory, or with a synthetic result. The
+synthetic result size can be set per query with a comment such as
+
+    #standin: entities=500 years=30 per_year=12 category=1 latency=2
+"""
+
+import os
+import re
+import json
+import time
+import random
+import logging
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from api.utils import query_key
+from graphs.synthetic import synthetic_result
+
+logger = logging.getLogger("infographics")
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+SIZE_OPTIONS = {
+    "entities": int,
+    "years": int,
+    "per_year": int,
+    "category": lambda v: v not in ("0", "false"),
+    "url": lambda v: v not in ("0", "false"),
+    "sparse": float,
+    "seed": int,
+}
+
+
+def term_type(column, value):
+    if column == "date":
+        return {"type": "literal", "datatype": XSD + "dateTime", "value": value}
+    if column == "value":
+        return {"type": "literal", "datatype": XSD + "decimal", "value": value}
+    if value.startswith("http://") or value.startswith("https://"):
+        return {"type": "uri", "value": value}
+    return {"type": "literal", "xml:lang": "en", "value": value}
+
+
+def to_sparql_json(df):
+    """
+    Serializes a result DataFrame as a SPARQL JSON result.
+    """
+    columns = list(df.columns)
+    bindings = [
+        {col: term_type(col, value) for col, value in zip(columns, row) if value is not None}
+        for row in df.itertuples(index=False)
+    ]
+    result = {"head": {"vars": columns}, "results": {"bindings": bindings}}
+    return json.dumps(result).encode("utf-8")
+
+
+def tsv_term(column, value):
+    if value is None:
+        return ""
+    term = term_type(column, value)
+    if term["type"] == "uri":
+        return f"<{value}>"
+    if column == "value":
+        return value
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+    escaped = escaped.replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+    if "datatype" in term:
+        return f'"{escaped}"^^<{term["datatype"]}>'
+    return f'"{escaped}"@{term["xml:lang"]}'
+
+
+def to_sparql_tsv(df):
+    """
+    Serializes a result DataFrame as a SPARQL TSV result.
+    """
+    columns = list(df.columns)
+    lines = ["\t".join(f"?{col}" for col in columns)]
+    for row in df.itertuples(index=False):
+        lines.append("\t".join(tsv_term(col, value) for col, value in zip(columns, row)))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def options_from_query(query):
+    """
+    Reads the `#standin:` comment of a query.
+    """
+    options = {}
+    match = re.search(r"#\s*standin:(.*)", query)
+    if match:
+        for name, value in re.findall(r"(\w+)=([\w.]+)", match.group(1)):
+            options[name] = value
+    return options
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server_version = "SparqlStandin/1.0"
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        query = params.get("query", [""])[0]
+        options = options_from_query(query)
+        latency = float(options.get("latency", self.server.latency))
+        time.sleep(max(0.0, random.gauss(latency, self.server.jitter)))
+
+        accept = self.headers.get("Accept", "")
+        tsv = "text/tab-separated-values" in accept and params.get("format") != ["json"]
+        body = self.recorded(query, tsv)
+        if body is None:
+            size = dict(self.server.size)
+            for name, cast in SIZE_OPTIONS.items():
+                if name in options:
+                    size[name] = cast(options[name])
+            df = synthetic_result(**size)
+            body = to_sparql_tsv(df) if tsv else to_sparql_json(df)
+
+        self.send_response(200)
+        if tsv:
+            self.send_header("Content-Type", "text/tab-separated-values; charset=UTF-8")
+        else:
+            self.send_header("Content-Type", "application/sparql-results+json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def recorded(self, query, tsv):
+        if not self.server.records:
+            return None
+        extension = "tsv" if tsv else "json"
+        path = os.path.join(self.server.records, f"{query_key(query)}.{extension}")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def log_message(self, format, *args):
+        logger.debug(f"standin: {format % args}")
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, records=None, **size):
+        super().__init__(address, StandinHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.records = records
+        self.size = size
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/sparql"
@@ -1,12 +1,63 @@
+import io
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+import requests
 import requests_mock
+from django.db import DatabaseError
+from django.test import LiveServerTestCase
 from django.test import TestCase
+from django.test import override_settings
+from django.utils.timezone import now
 
+from api.client import get_client
+from api.client import SparqlClient
+from api.client import SparqlOverloaded
+from api.decoders import decode_csv
+from api.decoders import decode_json_bindings
+from api.decoders import decode_tsv
+from api.decoders import ResultDecodeError
+from api.decoders import ResultTooLarge
+from api.encoders import dumps
+from api.encoders import iter_json
+from api.jobs import run_job
+from api.loadtest import format_report
+from api.loadtest import LoadTest
+from api.loadtest import parse_server_timing
+from api.loadtest import percentile
+from api.models import QueryJob
+from api.models import QueryResult
+from api.queries import prepared
+from api.queries import tables
+from api.sparql import can_be_paged
 from api.sparql import df_from_query
+from api.sparql import fetch_df
+from api.sparql import paged_query
+from api.sparql import revalidate
+from api.singleflight import file_lock
+from api.singleflight import SingleFlight
+from api.standin import StandinServer
+from api.standin import to_sparql_json
+from api.standin import to_sparql_tsv
+from api.utils import normalize_query
+from graphs.bar_chart_race import process_bar_chart_race
+from graphs.synthetic import synthetic_result
 from video.models import Video
 from shortlink.models import ShortLink
 
 
 class TestHelper:
+    @staticmethod
+    def streamed_json(res):
+        return json.loads(b"".join(res.streaming_content))
+
     @staticmethod
     def mock_query_table(mocker):
         result = {
@@ -55,6 +106,767 @@ class QueryTests(TestCase):
         self.assertEqual(df["item"].count(), 2)
 
 
+class DecoderTests(TestCase):
+    RESULT = """{
+  "head" : { "vars" : [ "item", "itemLabel", "population" ] },
+  "results" : { "bindings" : [ {
+    "item" : { "type" : "uri", "value" : "http://www.wikidata.org/entity/Q174" },
+    "itemLabel" : { "xml:lang" : "pt", "type" : "literal", "value" : "São Paulo" },
+    "population" : { "datatype" : "http://www.w3.org/2001/XMLSchema#decimal", "type" : "literal", "value" : "12325232" }
+  }, {
+    "itemLabel" : { "xml:lang" : "pt", "type" : "literal", "value" : "Porto Alegre" }
+  } ] }
+}"""
+
+    def chunks(self, size):
+        body = self.RESULT.encode("utf-8")
+        return [body[i:i + size] for i in range(0, len(body), size)]
+
+    def test_decode_chunks(self):
+        for size in (1, 7, 64, 100000):
+            df = decode_json_bindings(self.chunks(size))
+            self.assertEqual(list(df.columns), ["item", "itemLabel", "population"])
+            self.assertEqual(list(df["itemLabel"]), ["São Paulo", "Porto Alegre"])
+            self.assertEqual(list(df["item"]), ["http://www.wikidata.org/entity/Q174", None])
+            self.assertEqual(list(df["population"]), ["12325232", None])
+
+    def test_service_errors(self):
+        df = decode_tsv([b'?a\n"NullPointerException in Java"\n'])
+        self.assertEqual(list(df["a"]), ["NullPointerException in Java"])
+        for error in [b"java.util.concurrent.TimeoutException", b"\tat com.bigdata.rdf.sail.Foo(Foo.java:1)"]:
+            with self.assertRaises(ResultDecodeError):
+                decode_tsv([b"?a\n\"1\"\n" + error])
+
+    def test_limits(self):
+        with self.assertRaises(ResultTooLarge):
+            decode_json_bindings(self.chunks(64), max_rows=1)
+        with self.assertRaises(ResultTooLarge):
+            decode_json_bindings(self.chunks(64), max_bytes=100)
+        df = decode_json_bindings(self.chunks(64), max_rows=2, max_bytes=len(self.RESULT) * 2)
+        self.assertEqual(df.shape, (2, 3))
+
+    def test_invalid(self):
+        with self.assertRaises(ResultDecodeError):
+            decode_json_bindings([self.RESULT[:-20].encode("utf-8")])
+        with self.assertRaises(ResultDecodeError):
+            decode_json_bindings([b'{"results": {"bindings": []}}'])
+
+    @requests_mock.Mocker()
+    def test_query_errors(self, mocker):
+        body = self.RESULT[:300] + "java.util.concurrent.TimeoutException"
+        mocker.get("https://query.wikidata.org/sparql", text=body)
+        self.assertEqual(df_from_query("timeout"), {"error": "preview-error-timeout"})
+        with override_settings(QUERY_MAX_ROWS=1):
+            mocker.get("https://query.wikidata.org/sparql", text=self.RESULT)
+            self.assertEqual(df_from_query("large"), {"error": "preview-error-too-large"})
+
+
+class TransportTests(TestCase):
+    TSV = (
+        "?item\t?itemLabel\t?population\t?date\n"
+        "<http://www.wikidata.org/entity/Q174>\t\"São Paulo\"@pt\t12325232"
+        "\t\"2020-07-01T00:00:00Z\"^^<http://www.w3.org/2001/XMLSchema#dateTime>\n"
+        "<http://www.wikidata.org/.well-known/genid/0123abc>\t\"Say \\\"hi\\\"\\tnow\"\t"
+        "\"42\"^^<http://www.w3.org/2001/XMLSchema#decimal>\t\n"
+        "_:t1\t\"\"\t\t\n"
+    )
+    CSV = (
+        "item,itemLabel\r\n"
+        "http://www.wikidata.org/entity/Q174,\"São Paulo, SP\"\r\n"
+        "http://www.wikidata.org/entity/Q40269,\r\n"
+    )
+
+    def test_decode_tsv(self):
+        df = decode_tsv([self.TSV.encode("utf-8")])
+        self.assertEqual(list(df.columns), ["item", "itemLabel", "population", "date"])
+        self.assertEqual(
+            list(df["item"]),
+            [
+                "http://www.wikidata.org/entity/Q174",
+                "http://www.wikidata.org/.well-known/genid/0123abc",
+                "t1",
+            ],
+        )
+        self.assertEqual(list(df["itemLabel"]), ["São Paulo", 'Say "hi"\tnow', ""])
+        self.assertEqual(list(df["population"]), ["12325232", "42", None])
+        self.assertEqual(list(df["date"]), ["2020-07-01T00:00:00Z", None, None])
+
+    def test_decode_csv(self):
+        df = decode_csv([self.CSV.encode("utf-8")])
+        self.assertEqual(list(df.columns), ["item", "itemLabel"])
+        self.assertEqual(list(df["itemLabel"]), ["São Paulo, SP", None])
+        with self.assertRaises(ResultTooLarge):
+            decode_csv([self.CSV.encode("utf-8")], max_rows=1)
+
+    @override_settings(QUERY_TRANSPORT="tsv")
+    @requests_mock.Mocker()
+    def test_tsv_query(self, mocker):
+        mocker.get(
+            "https://query.wikidata.org/sparql",
+            text=self.TSV,
+            headers={"Content-Type": "text/tab-separated-values; charset=UTF-8"},
+        )
+        df = df_from_query("SELECT")
+        self.assertEqual(mocker.last_request.headers["Accept"], "text/tab-separated-values")
+        self.assertEqual(df["itemLabel"][0], "São Paulo")
+
+    @override_settings(QUERY_TRANSPORT="tsv")
+    @requests_mock.Mocker()
+    def test_json_fallback(self, mocker):
+        mocker.get(
+            "https://query.wikidata.org/sparql",
+            request_headers={"Accept": "text/tab-separated-values"},
+            text="?a\n1\njava.lang.RuntimeException",
+            headers={"Content-Type": "text/tab-separated-values"},
+        )
+        mocker.get(
+            "https://query.wikidata.org/sparql",
+            request_headers={"Accept": "application/json"},
+            json={"head": {"vars": ["a"]}, "results": {"bindings": [{"a": {"value": "1"}}]}},
+        )
+        df = df_from_query("SELECT")
+        self.assertEqual(mocker.call_count, 2)
+        self.assertEqual(list(df["a"]), ["1"])
+
+
+@override_settings(SPARQL_RETRIES=2, SPARQL_CIRCUIT_THRESHOLD=2)
+class ClientTests(TestCase):
+    URL = "https://query.wikidata.org/sparql"
+
+    @requests_mock.Mocker()
+    def test_retry(self, mocker):
+        client = SparqlClient()
+        mocker.get(
+            self.URL,
+            [
+                {"status_code": 429, "headers": {"Retry-After": "3"}},
+                {"status_code": 503},
+                {"status_code": 200, "text": "ok"},
+            ],
+        )
+        with mock.patch("api.client.time.sleep") as sleep:
+            res = client.get({"query": ""}, {})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(mocker.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertGreaterEqual(sleep.call_args_list[0].args[0], 3)
+
+    @requests_mock.Mocker()
+    def test_retry_after_too_long(self, mocker):
+        client = SparqlClient()
+        mocker.get(self.URL, status_code=429, headers={"Retry-After": "3600"})
+        with self.assertRaises(SparqlOverloaded):
+            client.get({"query": ""}, {})
+        self.assertEqual(mocker.call_count, 1)
+
+    @requests_mock.Mocker()
+    def test_circuit_breaker(self, mocker):
+        client = SparqlClient()
+        mocker.get(self.URL, exc=requests.exceptions.ConnectionError)
+        with mock.patch("api.client.time.sleep"):
+            for i in range(2):
+                with self.assertRaises(requests.exceptions.ConnectionError):
+                    client.get({"query": ""}, {})
+            self.assertEqual(mocker.call_count, 6)
+            with self.assertRaises(SparqlOverloaded):
+                client.get({"query": ""}, {})
+            self.assertEqual(mocker.call_count, 6)
+        mocker.get(self.URL, text="ok")
+        with override_settings(SPARQL_CIRCUIT_COOLDOWN=0):
+            self.assertEqual(client.get({"query": ""}, {}).status_code, 200)
+        self.assertEqual(client.breaker.failures, 0)
+
+    @requests_mock.Mocker()
+    def test_circuit_breaker_failures(self, mocker):
+        client = SparqlClient()
+        mocker.get(self.URL, exc=requests.exceptions.ReadTimeout)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            client.get({"query": ""}, {})
+        self.assertEqual(mocker.call_count, 1)
+        mocker.get(self.URL, status_code=500, text="java.util.concurrent.TimeoutException")
+        self.assertEqual(client.get({"query": ""}, {}).status_code, 500)
+        with self.assertRaises(SparqlOverloaded):
+            client.get({"query": ""}, {})
+
+    @override_settings(SPARQL_CIRCUIT_COOLDOWN=60)
+    def test_circuit_breaker_half_open(self):
+        breaker = SparqlClient().breaker
+        for i in range(2):
+            breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    @requests_mock.Mocker()
+    def test_body_timeout(self, mocker):
+        class Body(io.BytesIO):
+            def read(self, *args, **kwargs):
+                raise requests.exceptions.ReadTimeout()
+
+        mocker.get(self.URL, body=Body())
+        breaker = get_client().breaker
+        self.assertEqual(fetch_df("slow"), {"error": "preview-error-timeout"})
+        self.assertEqual(breaker.failures, 1)
+        breaker.record_success()
+
+    @requests_mock.Mocker()
+    def test_query_errors(self, mocker):
+        mocker.get(self.URL, exc=requests.exceptions.ReadTimeout)
+        self.assertEqual(df_from_query("slow"), {"error": "preview-error-timeout"})
+        mocker.get(self.URL, status_code=429)
+        with mock.patch("api.client.time.sleep"):
+            self.assertEqual(df_from_query("limited"), {"error": "preview-error-overloaded"})
+        get_client().breaker.record_success()
+
+
+class ChunkedQueryTests(TestCase):
+    QUERY = "SELECT ?item WHERE { ?item wdt:P31 wd:Q5 }"
+
+    def mock_pages(self, mocker, rows):
+        def page(request, context):
+            query = request.qs["query"][0]
+            limit = int(re.search(r"limit (\d+)", query).group(1))
+            offset = int(re.search(r"offset (\d+)", query).group(1))
+            bindings = [
+                {"item": {"type": "literal", "value": str(i)}}
+                for i in range(offset, min(offset + limit, rows))
+            ]
+            return {"head": {"vars": ["item"]}, "results": {"bindings": bindings}}
+
+        mocker.get("https://query.wikidata.org/sparql", json=page)
+
+    @requests_mock.Mocker()
+    def test_chunks(self, mocker):
+        self.mock_pages(mocker, 25)
+        chunks = []
+        df = df_from_query(
+            self.QUERY,
+            chunk_size=10,
+            order_key="item",
+            on_chunk=lambda chunk, rows: chunks.append((chunk.shape[0], rows)),
+        )
+        self.assertEqual(list(df["item"]), [str(i) for i in range(25)])
+        self.assertEqual(chunks, [(10, 10), (10, 20), (5, 25)])
+        self.assertEqual(mocker.call_count, 3)
+        self.assertIn("order by ?item", mocker.request_history[0].qs["query"][0])
+        cached = df_from_query(self.QUERY)
+        self.assertTrue(df.equals(cached))
+        self.assertEqual(mocker.call_count, 3)
+
+    @requests_mock.Mocker()
+    def test_unordered_query(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        df = df_from_query(self.QUERY, chunk_size=1)
+        self.assertEqual(df.shape[0], 2)
+        self.assertEqual(mocker.call_count, 1)
+        self.assertNotIn("limit", mocker.request_history[0].qs["query"][0])
+
+    def test_paged_query(self):
+        self.assertEqual(
+            paged_query("SELECT ?a\n# comment", 10, 20, "a"),
+            "SELECT ?a\n# comment\nORDER BY ?a\nLIMIT 10\nOFFSET 20",
+        )
+        self.assertTrue(can_be_paged(self.QUERY, "item"))
+        self.assertFalse(can_be_paged(self.QUERY))
+        self.assertFalse(can_be_paged(self.QUERY + " LIMIT 10"))
+        self.assertFalse(can_be_paged(self.QUERY + " order  by ?item"))
+        self.assertFalse(can_be_paged(self.QUERY, "item }"))
+
+    @override_settings(QUERY_JOB_WORKERS=0)
+    @requests_mock.Mocker()
+    def test_job_partial(self, mocker):
+        self.mock_pages(mocker, 15)
+        res = self.client.post("/api/jobs/", {"query": self.QUERY, "chunk_size": 10, "order_by": "item"})
+        job = QueryJob.objects.get(id=res.json()["id"])
+        self.assertEqual(job.status, QueryJob.DONE)
+        self.assertEqual(job.rows, 15)
+        partial = json.loads(job.partial)["table"]
+        self.assertEqual(partial["total"], 10)
+        self.assertEqual(len(partial["data"]["item"]), 10)
+        res = self.client.get(f"/api/jobs/{job.id}/result/")
+        table = res.json()["data"]["table"]
+        self.assertEqual(table["total"], 15)
+        self.assertEqual(len(table["data"]["item"]), 10)
+        res = self.client.post("/api/jobs/", {"query": self.QUERY, "chunk_size": "abc"})
+        self.assertEqual(res.status_code, 400)
+
+
+class CacheTests(TestCase):
+    QUERY = "#title: test\nSELECT ?item ?itemLabel\n  WHERE { }\n"
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query(self.QUERY), "SELECT ?item ?itemLabel\nWHERE { }")
+        self.assertEqual(
+            normalize_query(self.QUERY),
+            normalize_query("SELECT ?item ?itemLabel   \n\n# comment\nWHERE { }"),
+        )
+
+    @requests_mock.Mocker()
+    def test_cached_query(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        df = df_from_query(self.QUERY)
+        self.assertEqual(mocker.call_count, 1)
+        cached = df_from_query("SELECT ?item ?itemLabel\nWHERE { }")
+        self.assertEqual(mocker.call_count, 1)
+        self.assertTrue(df.equals(cached))
+        self.assertEqual(len(df.attrs["digest"]), 64)
+        self.assertEqual(cached.attrs["digest"], df.attrs["digest"])
+        df_from_query(self.QUERY, use_cache=False)
+        self.assertEqual(mocker.call_count, 2)
+        self.assertEqual(QueryResult.objects.count(), 1)
+
+    @requests_mock.Mocker()
+    def test_stale_query(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        df_from_query(self.QUERY)
+        QueryResult.objects.update(fetched=now() - timedelta(hours=2))
+        with mock.patch("api.sparql.revalidate_in_background") as revalidate:
+            df = df_from_query(self.QUERY)
+            df_from_query(self.QUERY)
+        revalidate.assert_called_once_with(self.QUERY)
+        self.assertEqual(df["item"].count(), 2)
+        self.assertEqual(mocker.call_count, 1)
+        QueryResult.objects.update(fetched=now() - timedelta(days=2))
+        df_from_query(self.QUERY)
+        self.assertEqual(mocker.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_failed_revalidation(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        df_from_query(self.QUERY)
+        QueryResult.objects.update(refreshing=True)
+        with (
+            mock.patch("api.sparql.close_old_connections"),
+            mock.patch.object(QueryResult.objects, "store", side_effect=DatabaseError("database is locked")),
+            self.assertLogs("infographics", "ERROR"),
+        ):
+            revalidate(self.QUERY)
+        self.assertFalse(QueryResult.objects.get().refreshing)
+
+    @override_settings(QUERY_CACHE_MAX_BYTES=1000)
+    @requests_mock.Mocker()
+    def test_cull(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        for i in range(10):
+            df_from_query(f"SELECT {i}")
+        self.assertLess(QueryResult.objects.count(), 10)
+        self.assertTrue(QueryResult.objects.filter(query="SELECT 9").exists())
+        self.assertFalse(QueryResult.objects.filter(query="SELECT 0").exists())
+
+    @requests_mock.Mocker()
+    def test_touch_interval(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        df_from_query(self.QUERY)
+        accessed = now() - timedelta(minutes=1)
+        QueryResult.objects.update(accessed=accessed)
+        df_from_query(self.QUERY)
+        self.assertEqual(QueryResult.objects.get().accessed, accessed)
+        accessed = now() - timedelta(hours=1)
+        QueryResult.objects.update(accessed=accessed)
+        df_from_query(self.QUERY)
+        self.assertGreater(QueryResult.objects.get().accessed, accessed)
+
+    @requests_mock.Mocker()
+    def test_cull_threshold(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        with (
+            mock.patch("api.models._stored", 0),
+            mock.patch("api.models._culled", True),
+            mock.patch.object(QueryResult.objects, "cull") as cull,
+        ):
+            for i in range(10):
+                df_from_query(f"SELECT {i}")
+            cull.assert_not_called()
+            with override_settings(QUERY_CACHE_MAX_BYTES=1000):
+                df_from_query("SELECT 10")
+            cull.assert_called_once()
+
+
+class SingleFlightTests(TestCase):
+    def test_concurrent_calls(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {"value": len(calls)}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do("key", fn)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(flights.do("key", fn)))
+            for i in range(4)
+        ]
+        for thread in followers:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"value": 1}] * 5)
+        self.assertEqual(flights.do("key", fn), {"value": 2})
+
+    @override_settings(QUERY_LOCK_TIMEOUT=0.1)
+    def test_file_lock(self):
+        with file_lock("abc") as locked:
+            self.assertTrue(locked)
+            with file_lock("abc") as locked_again:
+                self.assertFalse(locked_again)
+            with file_lock("def") as other:
+                self.assertTrue(other)
+        with file_lock("abc") as locked:
+            self.assertTrue(locked)
+
+    def test_file_lock_slots(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(QUERY_LOCK_DIR=directory, QUERY_LOCK_SLOTS=2, QUERY_LOCK_TIMEOUT=0.1):
+                for i in range(20):
+                    with file_lock(f"query {i}"):
+                        pass
+                self.assertEqual(len(os.listdir(directory)), 2)
+                # keys of the same slot share its lock
+                with file_lock("abc"), file_lock("ghi") as locked:
+                    self.assertFalse(locked)
+
+    @requests_mock.Mocker()
+    def test_run_query(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        res = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel"})
+        self.assertEqual(res.status_code, 200)
+        data = TestHelper.streamed_json(res)["data"]
+        self.assertEqual(data["table"]["columns"], ["item", "itemLabel"])
+        self.assertIn("failed", data["bar_chart_race"])
+        res = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel", "charts": "table"})
+        self.assertEqual(list(TestHelper.streamed_json(res)["data"]), ["table"])
+        res = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel", "charts": "table,pie"})
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get("/api/query/")
+        self.assertEqual(res.status_code, 400)
+
+
+class GranularityTests(TestCase):
+    QUERY = "SELECT ?item ?itemLabel ?value ?date"
+
+    def setUp(self):
+        prepared.clear()
+
+    def mock_query(self, mocker):
+        df = synthetic_result(entities=5, years=3, per_year=2)
+        mocker.get(
+            "https://query.wikidata.org/sparql",
+            content=to_sparql_json(df),
+            headers={"Content-Type": "application/sparql-results+json"},
+        )
+
+    @requests_mock.Mocker()
+    def test_granularity(self, mocker):
+        self.mock_query(mocker)
+        res = self.client.get("/api/query/", {"query": self.QUERY, "granularity": "year"})
+        self.assertEqual(res.status_code, 200)
+        race = TestHelper.streamed_json(res)["data"]["bar_chart_race"]
+        self.assertIn("values_by_date", race)
+        self.assertNotIn("values_by_date_monthly", race)
+        self.assertNotIn("values_by_date_daily", race)
+        self.assertEqual(race["time_units"], ["year", "month", "day"])
+        res = self.client.get("/api/query/", {"query": self.QUERY, "granularity": "week"})
+        self.assertEqual(res.status_code, 400)
+        res = self.client.get("/api/query/", {"query": self.QUERY, "granularity": "auto"})
+        race = TestHelper.streamed_json(res)["data"]["bar_chart_race"]
+        self.assertEqual([key for key in race if key.startswith("values")], ["values_by_date_daily"])
+
+    @requests_mock.Mocker()
+    def test_series(self, mocker):
+        self.mock_query(mocker)
+        self.client.get("/api/query/", {"query": self.QUERY, "granularity": "year"})
+        self.assertEqual(mocker.call_count, 1)
+        QueryResult.objects.all().delete()
+        res = self.client.get("/api/query/series/", {"query": self.QUERY, "granularity": "month"})
+        self.assertEqual(res.status_code, 200)
+        data = TestHelper.streamed_json(res)["data"]
+        self.assertEqual(list(data), ["values_by_date_monthly", "plan"])
+        self.assertEqual(len(data["values_by_date_monthly"]), 31)
+        self.assertEqual(data["plan"]["month"]["decision"], "compute")
+        self.assertEqual(mocker.call_count, 1)
+        prepared.clear()
+        res = self.client.get("/api/query/series/", {"query": self.QUERY, "granularity": "day"})
+        self.assertEqual(list(TestHelper.streamed_json(res)["data"]), ["values_by_date_daily", "plan"])
+        self.assertEqual(mocker.call_count, 2)
+        res = self.client.get("/api/query/series/", {"query": self.QUERY})
+        self.assertEqual(res.status_code, 400)
+
+    @requests_mock.Mocker()
+    def test_unbound_dates(self, mocker):
+        df = synthetic_result(entities=5, years=3)
+        df["date"] = None
+        mocker.get("https://query.wikidata.org/sparql", content=to_sparql_json(df))
+        res = self.client.get("/api/query/", {"query": self.QUERY})
+        self.assertEqual(res.status_code, 200)
+        data = TestHelper.streamed_json(res)["data"]
+        self.assertEqual(data["table"]["total"], 15)
+        self.assertIn("failed", data["bar_chart_race"])
+        prepared.clear()
+        res = self.client.get("/api/query/series/", {"query": self.QUERY, "granularity": "year"})
+        self.assertIn("failed", TestHelper.streamed_json(res)["data"])
+
+    @requests_mock.Mocker()
+    def test_compact_format(self, mocker):
+        self.mock_query(mocker)
+        params = {"query": self.QUERY, "granularity": "year", "format": "compact", "precision": "3"}
+        res = self.client.get("/api/query/", params)
+        series = TestHelper.streamed_json(res)["data"]["bar_chart_race"]["values_by_date"]
+        self.assertEqual(series["format"], "compact")
+        self.assertEqual(series["names"], [f"Item {i}" for i in range(1, 6)])
+        self.assertEqual(series["dates"], ["2000-01-01", "2001-01-01", "2002-01-01"])
+        self.assertEqual(series["rank"][0], [1, 2, 3, 4, 5])
+        params["granularity"] = "month"
+        res = self.client.get("/api/query/series/", params)
+        self.assertEqual(TestHelper.streamed_json(res)["data"]["values_by_date_monthly"]["format"], "compact")
+        params["format"] = "delta"
+        res = self.client.get("/api/query/series/", params)
+        series = TestHelper.streamed_json(res)["data"]["values_by_date_monthly"]
+        self.assertEqual(series["format"], "delta")
+        self.assertEqual(sorted(series["frames"][0]["index"]), [0, 1, 2, 3, 4])
+        params["format"] = "columns"
+        res = self.client.get("/api/query/", params)
+        self.assertEqual(res.status_code, 400)
+
+
+class TableTests(TestCase):
+    QUERY = "SELECT ?item ?itemLabel"
+
+    def setUp(self):
+        tables.clear()
+
+    @requests_mock.Mocker()
+    def test_query_table(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        res = self.client.get("/api/query/", {"query": self.QUERY})
+        key = TestHelper.streamed_json(res)["data"]["table"]["key"]
+
+        res = self.client.get("/api/query/table/", {"key": key, "limit": 1, "offset": 1})
+        page = TestHelper.streamed_json(res)["data"]
+        self.assertEqual(page["total"], 2)
+        self.assertEqual(page["data"]["itemLabel"], ["Lomba do Pinheiro"])
+
+        res = self.client.get("/api/query/table/", {"key": key, "sort": "itemLabel", "order": "desc"})
+        page = TestHelper.streamed_json(res)["data"]
+        self.assertEqual(page["data"]["itemLabel"], ["Lomba do Pinheiro", "Campo Novo"])
+
+        params = {"key": key, "search": "campo", "columns": "itemLabel"}
+        page = TestHelper.streamed_json(self.client.get("/api/query/table/", params))["data"]
+        self.assertEqual(page["filtered"], 1)
+        self.assertEqual(page["data"], {"itemLabel": ["Campo Novo"]})
+
+        res = self.client.get("/api/query/table/", {**params, "format": "csv"})
+        self.assertEqual(res["Content-Type"], "text/csv")
+        self.assertEqual(res.content.decode().splitlines(), ["itemLabel", "Campo Novo"])
+
+        # the table is read back from the query cache once evicted
+        tables.clear()
+        res = self.client.get("/api/query/table/", {"query": self.QUERY})
+        self.assertEqual(TestHelper.streamed_json(res)["data"]["total"], 2)
+        self.assertEqual(mocker.call_count, 1)
+
+        for params in [{"limit": 0}, {"offset": -1}, {"limit": "abc"}, {"sort": "value"}, {"order": "up"}]:
+            res = self.client.get("/api/query/table/", {"key": key, **params})
+            self.assertEqual(res.status_code, 400)
+        res = self.client.get("/api/query/table/", {"key": "abc"})
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get("/api/query/table/")
+        self.assertEqual(res.status_code, 400)
+
+
+@override_settings(QUERY_JOB_WORKERS=0)
+class QueryJobTests(TestCase):
+    @requests_mock.Mocker()
+    def test_job(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        res = self.client.post("/api/jobs/", {"query": "SELECT ?item ?itemLabel"})
+        self.assertEqual(res.status_code, 202)
+        id = res.json()["id"]
+        job = QueryJob.objects.get(id=id)
+        self.assertEqual(job.status, QueryJob.DONE)
+        res = self.client.get(f"/api/jobs/{id}/")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["status"], "done")
+        res = self.client.get(f"/api/jobs/{id}/result/")
+        self.assertEqual(res.status_code, 200)
+        sync = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel"})
+        self.assertEqual(res.json(), TestHelper.streamed_json(sync))
+
+    @requests_mock.Mocker()
+    def test_failed_job(self, mocker):
+        mocker.get("https://query.wikidata.org/sparql", status_code=400, text="bad")
+        res = self.client.post("/api/jobs/", {"query": "SELEC"})
+        id = res.json()["id"]
+        self.assertEqual(res.json()["status"], "failed")
+        res = self.client.get(f"/api/jobs/{id}/result/")
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(res.json(), {"error": "bad"})
+
+    def test_pending_job(self):
+        job = QueryJob.objects.create(query="SELECT")
+        res = self.client.get(f"/api/jobs/{job.id}/result/")
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json()["status"], "pending")
+        self.assertEqual(self.client.post("/api/jobs/").status_code, 400)
+        res = self.client.get("/api/jobs/00000000-0000-0000-0000-000000000000/")
+        self.assertEqual(res.status_code, 404)
+
+    def test_lost_job(self):
+        job = QueryJob.objects.create(query="SELECT", status=QueryJob.RUNNING)
+        QueryJob.objects.filter(id=job.id).update(created=now() - timedelta(hours=1))
+        with self.assertLogs("infographics", "WARNING"):
+            res = self.client.get(f"/api/jobs/{job.id}/result/")
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(res.json(), {"error": "preview-error-timeout"})
+        # a job with a recent heartbeat is still running in some worker
+        job = QueryJob.objects.create(query="SELECT", status=QueryJob.RUNNING)
+        QueryJob.objects.filter(id=job.id).update(created=now() - timedelta(hours=1), heartbeat=now())
+        res = self.client.get(f"/api/jobs/{job.id}/")
+        self.assertEqual(res.json()["status"], "running")
+
+    def test_expired_job(self):
+        job = QueryJob.objects.create(query="SELECT ?item ?itemLabel")
+
+        def expire(*args, **kwargs):
+            QueryJob.objects.filter(id=job.id).update(status=QueryJob.FAILED, error="preview-error-timeout")
+            return {}
+
+        with mock.patch("api.jobs.charts_from_query", side_effect=expire), self.assertLogs("infographics", "WARNING"):
+            run_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (QueryJob.FAILED, "preview-error-timeout"))
+        # an expired job is never started
+        with mock.patch("api.jobs.charts_from_query") as charts:
+            run_job(job.id)
+        charts.assert_not_called()
+
+
+class StandinTests(LiveServerTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.standin = StandinServer(("127.0.0.1", 0), entities=5, years=4)
+        threading.Thread(target=cls.standin.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.standin.shutdown()
+        cls.standin.server_close()
+        super().tearDownClass()
+
+    def test_serializers(self):
+        df = synthetic_result(entities=3, years=2, category=True, sparse=0.2)
+        df.loc[0, "itemLabel"] = 'quote " tab \t'
+        decoded = decode_json_bindings([to_sparql_json(df)])
+        self.assertTrue(decoded.equals(df))
+        decoded = decode_tsv([to_sparql_tsv(df)])
+        self.assertTrue(decoded.equals(df))
+
+    def test_standin_query(self):
+        with override_settings(SPARQL_ENDPOINT=self.standin.endpoint):
+            df = df_from_query("#standin: entities=3 years=2 category=1\nSELECT")
+            self.assertEqual(df.shape, (6, 5))
+            with override_settings(QUERY_TRANSPORT="tsv"):
+                df = fetch_df("SELECT")
+            self.assertEqual(df.shape, (20, 4))
+
+    def test_load_test(self):
+        with override_settings(SPARQL_ENDPOINT=self.standin.endpoint, SERVER_TIMING=True):
+            load_test = LoadTest(self.live_server_url, ["SELECT"], concurrency=2, iterations=4)
+            report = load_test.run(["query", "shortlink"])
+        endpoints = report["endpoints"]
+        self.assertEqual(
+            set(endpoints), set(["query", "shortlink generate", "shortlink redirect"])
+        )
+        self.assertEqual(endpoints["query"]["requests"], 2)
+        self.assertEqual(endpoints["query"]["errors"], 0)
+        self.assertEqual(endpoints["shortlink redirect"]["errors"], 0)
+        self.assertIn("sparql", endpoints["query"]["stages"])
+        self.assertIn("shortlink redirect", format_report(report))
+
+    def test_parse_server_timing(self):
+        header = 'sparql;dur=120.5;desc="cpu=1.0ms", decode;dur=30;desc="rows=2", total;dur=151'
+        self.assertEqual(parse_server_timing(header), {"sparql": 0.1205, "decode": 0.03, "total": 0.151})
+        self.assertEqual(parse_server_timing(""), {})
+
+    def test_percentile(self):
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+        self.assertEqual(percentile(list(range(101)), 95), 95)
+        self.assertIsNone(percentile([], 99))
+
+
+class TimingTests(TestCase):
+    def setUp(self):
+        prepared.clear()
+
+    @override_settings(SERVER_TIMING=True)
+    @requests_mock.Mocker()
+    def test_server_timing(self, mocker):
+        TestHelper.mock_query_table(mocker)
+        with self.assertLogs("infographics", "INFO") as logs:
+            res = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel", "cache": "false"})
+            header = res["Server-Timing"]
+            self.assertIn("sparql;dur=", header)
+            self.assertIn('decode;dur=', header)
+            self.assertIn("total;dur=", header)
+            stages = res.timings.summary()
+            self.assertEqual(stages["decode"]["rows"], 2)
+            self.assertGreater(stages["decode"]["bytes"], 0)
+            self.assertEqual(stages["chart.table"]["count"], 1)
+            self.assertNotIn("encode", stages)
+            TestHelper.streamed_json(res)
+        self.assertGreater(res.timings.summary()["encode"]["bytes"], 0)
+        [line] = [line for line in logs.output if "timings" in line]
+        logged = json.loads(line.split("timings ", 1)[1])
+        self.assertEqual((logged["path"], logged["status"]), ("/api/query/", 200))
+        self.assertIn("encode", logged["stages"])
+
+        res = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel"})
+        self.assertIn("cache_decode", res.timings.summary())
+        with override_settings(SERVER_TIMING=False), self.assertLogs("infographics", "INFO") as logs:
+            res = self.client.get("/api/query/", {"query": "SELECT ?item ?itemLabel"})
+            TestHelper.streamed_json(res)
+        self.assertNotIn("Server-Timing", res)
+        self.assertIn("cache", res.timings.summary())
+        self.assertTrue(any("timings" in line for line in logs.output))
+
+
+class EncoderTests(TestCase):
+    def test_iter_json(self):
+        value = {"a": list(range(2500)), "b": {}, "c": np.array([1.5, np.nan]), 1: "x"}
+        encoded = b"".join(iter_json(value))
+        self.assertEqual(encoded, dumps(value))
+        self.assertEqual(json.loads(encoded)["c"], [1.5, None])
+
+    def test_series(self):
+        df = synthetic_result(entities=8, years=3, per_year=2, category=True)
+        for encoding in ["records", "compact", "delta"]:
+            data = process_bar_chart_race(df.copy(), encoding=encoding, precision=3)
+            series = data["values_by_date_monthly"]
+            expected = json.loads(dumps(series.to_data()))
+            for batch in [1, 5, 1000]:
+                encoded = b"".join(series.iter_json(dumps, batch))
+                self.assertEqual(json.loads(encoded), expected)
+            self.assertEqual(json.loads(b"".join(iter_json(data))), json.loads(dumps(data)))
+
+
 class VideoTests(TestCase):
     TEST_SVG = """<svg><circle r="45" cx="50" cy="50"/></svg>"""
 
@@ -1,13 +1,23 @@
 from django.urls import path
 
 from .views import run_query
+from .views import query_series
+from .views import query_table
 from .views import post_video_frame
 from .views import create_video
 from .views import generate_video
 from .views import generate_short_link
+from .views import submit_query_job
+from .views import query_job_status
+from .views import query_job_result
 
 urlpatterns = [
     path("query/", run_query, name="run_query"),
+    path("query/series/", query_series, name="query_series"),
+    path("query/table/", query_table, name="query_table"),
+    path("jobs/", submit_query_job, name="submit_query_job"),
+    path("jobs/<uuid:id>/", query_job_status, name="query_job_status"),
+    path("jobs/<uuid:id>/result/", query_job_result, name="query_job_result"),
     path("video/create/", create_video, name="create_video"),
     path("video/<int:id>/frame/", post_video_frame, name="post_video_frame"),
     path("video/<int:id>/generate/", generate_video, name="generate_video"),
@@ -0,0 +1,31 @@
+import hashlib
+
+
+def normalize_query(sparql_string):
+    """
+    Normalizes a SPARQL query so that cosmetic differences do not change its identity.
+
+    Surrounding whitespace, blank lines and full line comments (such as `#title:`)
+    are removed. Whitespace inside a line is kept, since it can be part of a literal.
+
+    :param sparql_string: SPARQL query string
+    :return: normalized query string
+    """
+    lines = []
+    for line in sparql_string.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def query_key(sparql_string):
+    """
+    Returns a stable key for the normalized form of a SPARQL query.
+
+    :param sparql_string: SPARQL query string
+    :return: hex digest of the normalized query
+    """
+    normalized = normalize_query(sparql_string)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
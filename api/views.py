@@ -1,6 +1,7 @@
 import logging
 from subprocess import CalledProcessError
 
+from django.conf import settings
 from django.http import JsonResponse
 from django.http import HttpResponse
 from django.views.decorators.http import require_safe
@@ -11,8 +12,17 @@ from django.shortcuts import get_object_or_404
 from django.shortcuts import reverse
 from django.utils.datastructures import MultiValueDictKeyError
 
-from api.sparql import df_from_query
-from graphs.utils import charts_from_df
+from api.encoders import StreamingJsonResponse
+from api.jobs import expire_job
+from api.jobs import submit_job
+from api.models import QueryJob
+from api.queries import charts_from_query
+from api.queries import series_from_query
+from api.queries import table_from_key
+from api.utils import query_key
+from graphs.bar_chart_race import ENCODINGS
+from graphs.bar_chart_race import GRANULARITIES
+from graphs.registry import CHARTS
 from video.models import Video
 from video.models import VideoFrame
 from shortlink.models import ShortLink
@@ -20,6 +30,101 @@ from shortlink.models import ShortLink
 logger = logging.getLogger("infographics")
 
 
+def chunking_from_params(params):
+    """
+    Reads `chunk_size` and `order_by` to fetch a query in pages, which is only
+    done when both are given.
+
+    # Raises
+
+    - `ValueError` if chunk_size is not a positive integer.
+    """
+    chunk_size = params.get("chunk_size") or settings.QUERY_CHUNK_SIZE
+    chunk_size = int(chunk_size)
+    if chunk_size < 0:
+        raise ValueError("chunk_size must be positive")
+    order_key = params.get("order_by") or None
+    return chunk_size or None, order_key
+
+
+def granularity_from_params(params):
+    """
+    Reads `granularity`, the bar chart race series to build.
+
+    # Raises
+
+    - `ValueError` if it is not one of `GRANULARITIES`.
+    """
+    granularity = params.get("granularity") or None
+    if granularity is not None and granularity not in GRANULARITIES:
+        raise ValueError(f"unknown granularity {granularity}")
+    return granularity
+
+
+def encoding_from_params(params):
+    """
+    Reads `format`, one of `ENCODINGS`, the encoding of the bar chart race
+    series, and `precision`, the significant digits of the compact values.
+
+    # Raises
+
+    - `ValueError` if the format is unknown or precision is not between 1 and 17.
+    """
+    encoding = params.get("format") or "records"
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unknown format {encoding}")
+    precision = params.get("precision") or None
+    if precision is not None:
+        precision = int(precision)
+        if not 1 <= precision <= 17:
+            raise ValueError("precision must be between 1 and 17")
+    return encoding, precision
+
+
+def charts_from_params(params):
+    """
+    Reads `charts`, a comma separated list of the charts to build, all of them
+    when missing.
+
+    # Raises
+
+    - `ValueError` if a chart is not in `CHARTS`.
+    """
+    charts = params.get("charts") or None
+    if charts is None:
+        return None
+    charts = charts.split(",")
+    unknown = [name for name in charts if name not in CHARTS]
+    if unknown:
+        raise ValueError(f"unknown charts {', '.join(unknown)}")
+    return charts
+
+
+def table_params_from_params(params):
+    """
+    Reads the page of a table to serve: `offset`, `limit`, `sort`, `order`,
+    `search` and `columns`, a comma separated list, see `Table.page`.
+
+    # Raises
+
+    - `ValueError` if offset or limit are not positive integers, or limit is
+      above `TABLE_MAX_PAGE_SIZE`.
+    """
+    offset = int(params.get("offset") or 0)
+    limit = int(params.get("limit") or settings.TABLE_PAGE_SIZE)
+    if offset < 0 or not 0 < limit <= settings.TABLE_MAX_PAGE_SIZE:
+        raise ValueError("invalid offset or limit")
+    columns = params.get("columns") or None
+    return {
+        "offset": offset,
+        "limit": limit,
+        "sort": params.get("sort") or None,
+        "order": params.get("order") or "asc",
+        "search": params.get("search") or None,
+        "columns": None if columns is None else columns.split(","),
+    }
+
+
 @require_safe
 def run_query(request):
     query = request.GET.get("query")
@@ -28,15 +133,135 @@ def run_query(request):
 
     query_inline = query.replace("\n", "\\n")
     logger.debug(f"running query: {query_inline}")
-    df = df_from_query(query)
+    use_cache = request.GET.get("cache") != "false"
+    try:
+        chunk_size, order_key = chunking_from_params(request.GET)
+    except ValueError:
+        return JsonResponse({"msg": "invalid chunk_size"}, status=400)
+    try:
+        granularity = granularity_from_params(request.GET)
+    except ValueError:
+        return JsonResponse({"msg": "invalid granularity"}, status=400)
+    try:
+        encoding, precision = encoding_from_params(request.GET)
+    except ValueError:
+        return JsonResponse({"msg": "invalid format"}, status=400)
+    try:
+        charts = charts_from_params(request.GET)
+    except ValueError:
+        return JsonResponse({"msg": "invalid charts"}, status=400)
+    result = charts_from_query(
+        query,
+        use_cache=use_cache,
+        chunk_size=chunk_size,
+        order_key=order_key,
+        granularity=granularity,
+        encoding=encoding,
+        precision=precision,
+        charts=charts,
+    )
+
+    if "error" in result:
+        return JsonResponse(result, status=500)
+
+    return StreamingJsonResponse(result)
+
 
-    if isinstance(df, dict) and "error" in df:
-        return JsonResponse(df, status=500)
-    logger.debug(f"obtained successful df: {df}")
+@require_safe
+def query_series(request):
+    query = request.GET.get("query")
+    granularity = request.GET.get("granularity")
+    if not query or not granularity:
+        return HttpResponse(status=400)
+    if granularity not in GRANULARITIES:
+        return JsonResponse({"msg": "invalid granularity"}, status=400)
+    try:
+        encoding, precision = encoding_from_params(request.GET)
+    except ValueError:
+        return JsonResponse({"msg": "invalid format"}, status=400)
+    try:
+        result = series_from_query(query, granularity, encoding=encoding, precision=precision)
+    except ValueError:
+        return JsonResponse({"msg": "granularity not available"}, status=400)
+
+    if "error" in result:
+        return JsonResponse(result, status=500)
+
+    return StreamingJsonResponse(result)
+
+
+@require_safe
+def query_table(request):
+    key = request.GET.get("key")
+    query = request.GET.get("query")
+    if not key and not query:
+        return HttpResponse(status=400)
+    try:
+        params = table_params_from_params(request.GET)
+    except ValueError:
+        return JsonResponse({"msg": "invalid page"}, status=400)
+    table = table_from_key(key or query_key(query))
+    if table is None:
+        return JsonResponse({"msg": "table not found"}, status=404)
+    if isinstance(table, dict):
+        return JsonResponse(table, status=500)
+    try:
+        if request.GET.get("format") == "csv":
+            del params["offset"], params["limit"]
+            res = HttpResponse(table.to_csv(**params), content_type="text/csv")
+            res["Content-Disposition"] = 'attachment; filename="data.csv"'
+            return res
+        page = table.page(**params)
+    except ValueError:
+        return JsonResponse({"msg": "invalid page"}, status=400)
+    return StreamingJsonResponse({"msg": "Successful", "data": page})
 
-    charts_data = charts_from_df(df)
 
-    return JsonResponse({"msg": "Successful", "data": charts_data})
+@csrf_exempt
+@require_POST
+def submit_query_job(request):
+    query = request.POST.get("query")
+    if not query:
+        return HttpResponse(status=400)
+    use_cache = request.POST.get("cache") != "false"
+    try:
+        chunk_size, order_key = chunking_from_params(request.POST)
+    except ValueError:
+        return JsonResponse({"msg": "invalid chunk_size"}, status=400)
+    try:
+        granularity = granularity_from_params(request.POST)
+    except ValueError:
+        return JsonResponse({"msg": "invalid granularity"}, status=400)
+    try:
+        encoding, precision = encoding_from_params(request.POST)
+    except ValueError:
+        return JsonResponse({"msg": "invalid format"}, status=400)
+    job = submit_job(
+        query,
+        use_cache=use_cache,
+        chunk_size=chunk_size,
+        order_key=order_key,
+        granularity=granularity,
+        encoding=encoding,
+        precision=precision,
+    )
+    return JsonResponse(job.to_dict(), status=202)
+
+
+@require_safe
+def query_job_status(request, id):
+    job = expire_job(get_object_or_404(QueryJob, id=id))
+    return JsonResponse(job.to_dict())
+
+
+@require_safe
+def query_job_result(request, id):
+    job = expire_job(get_object_or_404(QueryJob, id=id))
+    if job.status == QueryJob.FAILED:
+        return JsonResponse({"error": job.error}, status=500)
+    if job.status != QueryJob.DONE:
+        return JsonResponse(job.to_dict(), status=202)
+    return HttpResponse(job.result, content_type="application/json")
 
 
 @csrf_exempt
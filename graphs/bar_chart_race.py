@@ -1,83 +1,152 @@
 import re
 import logging
-from datetime import datetime
-from datetime import timedelta
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 
+import numpy as np
 import pandas as pd
 from pandas.errors import ParserError
 
+from graphs.budget import SKIP
+from graphs.budget import plan_time_units
+from graphs import store
+from graphs.engine import Observations
+from graphs.workers import compute_frames
+from infographics.timing import stage
+
 logger = logging.getLogger("django")
 
 MAX_ELEMENTS_SCREEN = 12
+FRAME_BARS = MAX_ELEMENTS_SCREEN * 2  # times 2 to be safe
+GRANULARITIES = ("year", "month", "day", "auto", "all")
+ENCODINGS = ("records", "compact", "delta")
+SERIES = {"year": "values_by_date", "month": "values_by_date_monthly", "day": "values_by_date_daily"}
+FRAME_BATCH = 64  # frames encoded at a time when streaming a series
+CHECK_ROWS = 100  # first rows of a result checked before preparing it
 
 
 class BaseDf:
+    """
+    Bar chart race data prepared from a query result.
+
+    `prepare` builds a new frame with the name, category and url columns as
+    categoricals, and value and date columns, leaving the query result as it
+    is. The prepared frame is shared by every series, cache and thread, so it
+    must not be modified.
+
+    Data loaded from the chart store has its observations and elements but no
+    frame, see `prepared_base_df`. The `digest` of the query result, taken from
+    the "digest" attribute of its frame, keys the data saved in the store, as
+    does `ENGINE_VERSION`, which must change when preparing a result, or
+    rejecting it, changes.
+    """
+
     UNKNOWN = "http://www.wikidata.org/.well-known/genid"
+    IDENTIFIERS = ["name", "category", "url"]
 
-    def __init__(self, df: pd.DataFrame):
+    def __init__(self, df: pd.DataFrame, digest=None, observations=None, elements=None):
         self.df = df
+        if digest is None and df is not None:
+            digest = df.attrs.get("digest")
+        self.digest = digest
+        self._observations = observations
+        self._elements = elements
 
     def prepare(self) -> "BaseDf":
         self.verify_column_count()
-        self.remove_uknowns()
-        self.prepare_date_column()
-        self.prepare_value_column()
-        self.prepare_identifier_columns()
-        self.drop_other_columns()
-        self.drop_duplicates()
+        df = self.df
+        known = self.known_rows()
+        if not known.all():
+            df = df[known]
+        date = self.prepare_date_column(df.iloc[:, -1])
+        value = self.prepare_value_column(df.iloc[:, -2])
+        identifiers = self.prepare_identifier_columns(df.iloc[:, :-2])
+        prepared = pd.DataFrame({**identifiers, "value": value, "date": date})
+        duplicated = prepared.duplicated(["name", "date"])
+        if duplicated.any():
+            prepared = prepared[~duplicated]
+        self.df = prepared
         return self
 
     def verify_column_count(self):
         if not (3 <= self.df.shape[1] <= 5):
             raise BaseDfException("number of columns must be between 3 and 5")
 
-    def remove_uknowns(self):
-        for col in self.df.columns:
-            unknowns = self.df[col].astype(str).str.startswith(self.UNKNOWN)
-            if unknowns.sum() > 0:
-                self.df = self.df[~unknowns]
+    def known_rows(self):
+        """
+        Mask of the rows without unknown values in any column. Only the
+        distinct values of each text column are compared with `UNKNOWN`.
+        """
+        unknowns = np.zeros(len(self.df), dtype=bool)
+        for _, column in self.df.items():
+            if column.dtype == object or pd.api.types.is_string_dtype(column.dtype):
+                codes, uniques = pd.factorize(column)
+                unknown = [str(value).startswith(self.UNKNOWN) for value in uniques]
+                unknown.append(False)  # missing values, coded as -1
+                unknowns |= np.array(unknown)[codes]
+        return ~unknowns
 
-    def prepare_date_column(self):
-        original_name = self.df.columns[-1]
+    def prepare_date_column(self, column):
         try:
-            self.df[original_name] = pd.to_datetime(
-                self.df[original_name], format="ISO8601"
-            )
+            return pd.to_datetime(column, format="ISO8601")
         except (ValueError, ParserError):
             raise BaseDfException("last column must be a date column")
-        self.df.rename(columns={original_name: "date"}, inplace=True)
 
-    def prepare_value_column(self):
-        original_name = self.df.columns[-2]
+    def prepare_value_column(self, column):
         try:
-            self.df[original_name] = self.df[original_name].astype("float")
+            return column.astype("float")
         except ValueError:
             raise BaseDfException("second to last column must be a quantity column")
-        self.df.rename(columns={original_name: "value"}, inplace=True)
-
-    def prepare_identifier_columns(self):
-        renamer = {}
-        for column in self.df.columns[:-2]:
-            first = self.df[column][0]
-            if re.match(r"^https?://.*", first) and "url" not in renamer.values():
-                renamer[column] = "url"
-                continue
-            if "name" in renamer.values():
-                renamer[column] = "category"
-            else:
-                renamer[column] = "name"
-        if list(renamer.values()) == ["url"] or len(renamer) == 0:
+
+    def prepare_identifier_columns(self, df):
+        """
+        The first url column as url, the next label as name and the one after
+        it as category, as categoricals.
+        """
+        identifiers = {}
+        for _, column in df.items():
+            first = column.iloc[0] if len(column) else ""
+            if isinstance(first, str) and re.match(r"^https?://.*", first) and "url" not in identifiers:
+                identifiers["url"] = column
+            elif "name" not in identifiers:
+                identifiers["name"] = column
+            elif "category" not in identifiers:
+                identifiers["category"] = column
+        if "name" not in identifiers:
             raise BaseDfException("there should be at least one label")
-        self.df.rename(columns=renamer, inplace=True)
+        return {key: column.astype("category") for key, column in identifiers.items()}
+
+    def verify_observations(self):
+        """
+        Checks that some row has both a name and a date, since every row may be
+        missing them, such as when all dates are unbound.
+        """
+        if not (self.observations().codes >= 0).any():
+            raise BaseDfException("there should be at least one value with a name and a date")
 
-    def drop_other_columns(self):
-        keep = ["name", "category", "url", "value", "date"]
-        drop = [col for col in self.df.columns if col not in keep]
-        self.df.drop(columns=drop, inplace=True)
+    def observations(self) -> Observations:
+        if self._observations is None:
+            self._observations = Observations.from_df(self.df)
+        return self._observations
 
-    def drop_duplicates(self):
-        self.df.drop_duplicates(["name", "date"], inplace=True)
+    def elements(self):
+        """
+        Name of each entity with its url and category, when there are.
+        """
+        if self._elements is None:
+            identifiers = [col for col in ["url", "category"] if col in self.df.columns]
+            if not identifiers:
+                self._elements = [{"name": name for name in self.df["name"].unique()}]
+            else:
+                agg = {col: "first" for col in identifiers}
+                self._elements = (
+                    self.df[["name", *identifiers]]
+                    .groupby("name", observed=True)
+                    .agg(agg)
+                    .reset_index()
+                    .to_dict("records")
+                )
+        return self._elements
 
 
 class BaseDfException(Exception):
@@ -86,164 +155,233 @@ class BaseDfException(Exception):
         return super().__init__(message)
 
 
+def prepared_base_df(df):
+    """
+    BaseDf of a query result, loaded from the chart store when it was already
+    prepared, else prepared and saved to it, see `graphs.store`.
+
+    # Raises
+
+    - `BaseDfException` if the query result can't be a bar chart race.
+    """
+    bdf = BaseDf(df)
+    with stage("chart_cache"):
+        saved = store.load_prepared(bdf.digest)
+    if saved is not None:
+        if "failed" in saved:
+            raise BaseDfException(saved["failed"])
+        return BaseDf(None, bdf.digest, saved["observations"], saved["elements"])
+    try:
+        with stage("prepare", rows=df.shape[0]):
+            bdf.prepare()
+            bdf.verify_observations()
+    except BaseDfException as e:
+        store.save_prepared(bdf.digest, failed=e.message)
+        raise
+    if store.entry_path(bdf.digest) is not None:
+        with stage("chart_cache_save"):
+            store.save_prepared(bdf.digest, bdf.observations(), bdf.elements())
+    return bdf
+
+
+def check_bar_chart_race(df):
+    """
+    Why a query result can't be a bar chart race, found from its number of
+    columns and the dates and values of its first rows, or None when it can
+    be one. A result rejected here would also fail to prepare.
+    """
+    bdf = BaseDf(df.head(CHECK_ROWS))
+    try:
+        bdf.verify_column_count()
+        rows = bdf.df[bdf.known_rows()]
+        bdf.prepare_date_column(rows.iloc[:, -1])
+        bdf.prepare_value_column(rows.iloc[:, -2])
+    except BaseDfException as e:
+        return e.message
+    return None
+
+
 class DfProcessor:
-    def __init__(self, bdf: BaseDf, time_unit: str = "year"):
-        self.df = bdf.df.copy()
+    def __init__(self, bdf: BaseDf, time_unit: str = "year", observations: Observations = None):
+        self.bdf = bdf
+        self.df = bdf.df
         self.time_unit = time_unit
-        if self.time_unit == "year":
-            self.df["date"] = self.df["date"].dt.strftime("%Y-01-01")
-        elif self.time_unit == "month":
-            self.df["date"] = self.df["date"].dt.strftime("%Y-%m-01")
-        else:
-            self.df["date"] = self.df["date"].dt.strftime("%Y-%m-%d")
+        self.observations = observations if observations is not None else bdf.observations()
 
     def elements(self):
-        identifiers = [col for col in ["url", "category"] if col in self.df.columns]
-        if not identifiers:
-            return [{"name": name for name in self.df["name"].unique()}]
-        agg = {col: "first" for col in identifiers}
-        return (
-            self.df[["name", *identifiers]]
-            .groupby("name")
-            .agg(agg)
-            .reset_index()
-            .to_dict("records")
-        )
-
-    def name_to_category(self):
-        if "category" in self.df.columns:
-            return self.df[["name", "category"]].drop_duplicates().set_index("name")["category"].to_dict()
-        else:
-            return {}
+        return self.bdf.elements()
 
     def year_count(self):
-        min_year = int(self.df["date"].min()[:4])
-        max_year = int(self.df["date"].max()[:4])
-        return max_year - min_year + 1
+        return self.observations.year_count()
 
     def interpolated_df(self):
-        df = self.df
-        names = df["name"].unique()
-        time_units = self.all_time_units()
-        mux = pd.MultiIndex.from_product(
-            [names, time_units],
-            names=["name", "date"],
-        )
-        df = (
-            df.drop_duplicates(["name", "date"])
-            .set_index(["name", "date"])
-            .reindex(mux)
-            .reset_index()
-            .pivot(index="date", columns=["name"], values="value")
-            .interpolate()
-            .melt(ignore_index=False)
-            .reset_index()
-        )
-        df["value"] = df["value"].fillna(0)
-        df["rank"] = df.groupby("date")["value"].rank(method="first", ascending=False)
-        if "category" in self.df.columns:
-            mapper = self.name_to_category()
-            df["category"] = df["name"].apply(lambda name: mapper.get(name))
-        return df
-
-    def all_time_units(self):
-        min_year = int(self.df["date"].min()[:4])
-        max_year = int(self.df["date"].max()[:4])
-        year_range = range(min_year, max_year + 1)
-        if self.time_unit == "year":
-            year_range = range(min_year, max_year + 1)
-            return [f"{y}-01-01" for y in year_range]
-        elif self.time_unit == "month":
-            start_month = int(self.df["date"].min()[5:7])
-            start = [f"{min_year}-{m:02d}-01" for m in range(start_month, 13)]
-            year_range = list(year_range)
-            year_range.pop(0)
-            if len(year_range) == 0:
-                return start
-            year_range.pop(-1)
-            between = [
-                f"{y}-{m}"
-                for m in [
-                    "01-01",
-                    "02-01",
-                    "03-01",
-                    "04-01",
-                    "05-01",
-                    "06-01",
-                    "07-01",
-                    "08-01",
-                    "09-01",
-                    "10-01",
-                    "11-01",
-                    "12-01",
-                ]
-                for y in year_range
-            ]
-            end_month = int(self.df["date"].max()[5:7])
-            end = [f"{max_year}-{m:02d}-01" for m in range(1, end_month + 1)]
-            return [*start, *between, *end]
-        else:
-            start_date = datetime.strptime(self.df["date"].min(), "%Y-%m-%d").date()
-            end_date = datetime.strptime(self.df["date"].max(), "%Y-%m-%d").date()
-            days = (end_date - start_date).days + 1
-            days_index = []
-            for n in range(days):
-                date = start_date + timedelta(days=n)
-                days_index.append(date.strftime("%Y-%m-%d"))
-            return days_index
+        return self.dense_timeline().to_long_df()
+
+    def dense_timeline(self):
+        return self.observations.timeline(self.time_unit).interpolate()
 
     def original_time_units(self):
-        units = list(self.df["date"].unique())
-        units.reverse()
-        return units
+        return self.observations.original_time_units(self.time_unit)
 
     def values_by_date(self):
-        ip = self.interpolated_df()
-        head = MAX_ELEMENTS_SCREEN * 2  # times 2 to be safe
-        vl = []
-        last = None
-        for date, grouped in (
-            ip.sort_values(["date", "rank"], ascending=[False, True])
-            .groupby("date", sort=False)
-            .head(head)
-            .groupby("date", sort=False)
-        ):
-            if last is not None:
-                last = last[~last.name.isin(grouped["name"])]
-                if last.shape[0] > 0:
-                    last["rank"] = (
-                        last["value"].rank(method="first", ascending=False)
-                        + grouped[grouped["value"] > 0 ]["rank"].max()
-                    )
-                    last["value"] = 0.0
-                    grouped = pd.concat([grouped, last])
-            values = grouped.to_dict(orient="records")
-            vl.append({"date": date, "values": values})
-            last = grouped[grouped["value"] > 0]
-        vl.reverse()
-        return vl
-
-
-def process_bar_chart_race(df):
-    bdf = BaseDf(df)
+        return self.observations.frames(self.time_unit, FRAME_BARS).to_records()
+
+
+def available_time_units(plan):
+    """
+    Time units whose series are not skipped by the plan, see `plan_time_units`.
+    """
+    return [time_unit for time_unit, series in plan.items() if series.decision != SKIP]
+
+
+def select_time_units(granularity, observations, plan):
+    """
+    Time units to compute for the requested granularity: all available ones
+    when it is None or "all", the resolution of the observations for "auto",
+    and none when the requested one is not available.
+    """
+    available = available_time_units(plan)
+    if granularity is None or granularity == "all":
+        return available
+    if granularity == "auto":
+        resolution = observations.resolution()
+        return [resolution if resolution in available else available[-1]] if available else []
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"unknown granularity {granularity}")
+    return [granularity] if granularity in available else []
+
+
+class Series:
+    """
+    Values by date of a time unit, kept as frames until they are encoded, so
+    that a response can write them a batch of frames at a time.
+    """
+
+    def __init__(self, frames, encoding="records", precision=None):
+        self.frames = frames
+        self.encoding = encoding
+        self.precision = precision
+
+    def to_data(self):
+        if self.encoding == "delta":
+            return self.frames.to_delta()
+        if self.encoding == "compact":
+            return self.frames.to_compact(self.precision)
+        return self.frames.to_records()
+
+    def iter_json(self, dumps, batch=FRAME_BATCH):
+        """
+        Generator of the JSON encoding of the series in parts, the same as
+        `dumps(self.to_data())`.
+
+        :param dumps: function encoding a value as JSON bytes
+        :param batch: frames encoded by each call to `dumps`
+        """
+        frames = self.frames
+        batches = range(0, len(frames), batch)
+        if self.encoding == "delta":
+            yield dumps(frames.delta_header())[:-1] + b',"frames":'
+            delta_frames = frames.delta_frames()
+            yield from join_json(dumps(list(islice(delta_frames, batch))) for _ in batches)
+            yield b"}"
+        elif self.encoding == "compact":
+            yield dumps(frames.compact_header())[:-1]
+            columns = {
+                "index": frames.compact_indexes,
+                "value": partial(frames.compact_values, self.precision),
+                "rank": frames.compact_ranks,
+            }
+            for key, rows in columns.items():
+                yield f',"{key}":'.encode()
+                yield from join_json(dumps(rows(start, start + batch)) for start in batches)
+            yield b"}"
+        else:
+            yield from join_json(dumps(frames.to_records(start, start + batch)) for start in batches)
+
+
+def join_json(lists):
+    """
+    Generator of the JSON encoding of the concatenation of JSON encoded lists.
+    """
+    yield b"["
+    first = True
+    for encoded in lists:
+        if len(encoded) > 2:
+            yield encoded[1:-1] if first else b"," + encoded[1:-1]
+            first = False
+    yield b"]"
+
+
+def bar_chart_race_series(bdf, time_units, encoding="records", precision=None, plan=None):
+    """
+    Values by date of each time unit, keyed as in the bar chart race data.
+
+    :param encoding: one of `ENCODINGS`, see `Frames.to_records`, `Frames.to_compact`
+        and `Frames.to_delta`
+    :param precision: significant digits of the values in the compact format
+    :param plan: plans of the time units, which set their downsampling, see `plan_time_units`
+    :return: dictionary of `Series`, encoded as data with `Series.to_data` or as
+        JSON with `Series.iter_json`
+    """
+    steps = {u: plan[u].step if plan is not None else 1 for u in time_units}
+    frames = series_frames(bdf, time_units, encoding == "delta", steps)
+    return {
+        SERIES[time_unit]: Series(frames[time_unit], encoding, precision)
+        for time_unit in SERIES
+        if time_unit in frames
+    }
+
+
+def series_frames(bdf, time_units, segments, steps):
+    """
+    Frames of each time unit, loaded from the chart store when they were
+    already computed, else computed and saved to it.
+    """
+    frames = {}
+    with stage("chart_cache"):
+        for time_unit in time_units:
+            key = store.frames_key(time_unit, FRAME_BARS, segments, steps[time_unit])
+            saved = store.load_frames(bdf.digest, key)
+            if saved is not None:
+                frames[time_unit] = saved
+    missing = [u for u in time_units if u not in frames]
+    if missing:
+        computed = compute_frames(bdf.observations(), missing, FRAME_BARS, segments, steps)
+        if store.entry_path(bdf.digest) is not None:
+            with stage("chart_cache_save"):
+                for time_unit, f in computed.items():
+                    key = store.frames_key(time_unit, FRAME_BARS, segments, steps[time_unit])
+                    store.save_frames(bdf.digest, key, f)
+        frames.update(computed)
+    return {u: frames[u] for u in time_units}
+
+
+def process_bar_chart_race(df, granularity=None, on_prepared=None, encoding="records", precision=None):
+    """
+    :param granularity: one of `GRANULARITIES`, see `select_time_units`
+    :param on_prepared: called with the prepared BaseDf, to reuse it for other series
+    :param encoding: encoding of the series, see `bar_chart_race_series`
+    :param precision: significant digits of the values in the compact format
+    :return: dictionary with the bar chart race data, including the plan of
+        each series, see `plan_time_units`, or with a "failed" key
+    """
     try:
-        bdf.prepare()
+        bdf = prepared_base_df(df)
     except BaseDfException as e:
         return {"failed": e.message}
+    if on_prepared is not None:
+        on_prepared(bdf)
+    observations = bdf.observations()
+    with stage("plan"):
+        plan = plan_time_units(observations, encoding, FRAME_BARS)
+    if not available_time_units(plan):
+        return {"failed": "too many elements for a bar chart race"}
     proc = DfProcessor(bdf)
-    elements = proc.elements()
-    data = {"elements": elements}
-    run_daily = proc.year_count() <= 25
-    proc_monthly = DfProcessor(bdf, time_unit="month")
-    proc_daily = DfProcessor(bdf, time_unit="day")
-    with ThreadPoolExecutor() as executor:
-        t = executor.submit(proc.values_by_date)
-        t_monthly = executor.submit(proc_monthly.values_by_date)
-        if run_daily:
-            t_daily = executor.submit(proc_daily.values_by_date)
-        data["values_by_date"] = t.result()
-        data["values_by_date_monthly"] = t_monthly.result()
-        if run_daily:
-            data["values_by_date_daily"] = t_daily.result()
+    with stage("elements"):
+        data = {"elements": proc.elements()}
+    time_units = select_time_units(granularity, observations, plan)
+    data.update(bar_chart_race_series(bdf, time_units, encoding, precision, plan))
     data["original_time_units"] = proc.original_time_units()
+    data["time_units"] = available_time_units(plan)
+    data["plan"] = {time_unit: series.to_dict() for time_unit, series in plan.items()}
     return data
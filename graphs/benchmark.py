@@ -0,0 +1,401 @@
+"""
+Micro-benchmarks of the stages of the charts on synthetic query results.
+
+Each case is a synthetic result, see `synthetic_result`, given by name from
+`CASES` or as options such as "entities=500 years=30 per_year=12 category=1".
+Every stage is timed as the best of `repeat` runs, and run once more under
+tracemalloc for its peak memory, and the stages recorded inside
+`process_bar_chart_race` are kept as its breakdown, see `infographics.timing`.
+Reports are saved as JSON and compared with a baseline report, flagging the
+stages that got slower or use more memory beyond a threshold.
+
+Engines, functions of a prepared BaseDf and a time unit returning the frames
+as records, are checked on the same results against `reference_frames`, the
+pandas implementation the engine of `graphs.engine` replaced, which is kept
+here only as the reference.
+"""
+
+import re
+import time
+import tempfile
+import tracemalloc
+
+import pandas as pd
+from django.test.utils import override_settings
+
+from graphs import store
+from graphs.bar_chart_race import FRAME_BARS
+from graphs.bar_chart_race import BaseDf
+from graphs.bar_chart_race import DfProcessor
+from graphs.bar_chart_race import process_bar_chart_race
+from graphs.budget import COMPUTE
+from graphs.budget import SKIP
+from graphs.budget import plan_time_units
+from graphs.engine import ENGINE_VERSION
+from graphs.engine import Observations
+from graphs.synthetic import synthetic_result
+from graphs.table import Table
+from graphs.table import process_table
+from graphs.workers import compute_frames
+from infographics.timing import collect
+
+CASES = {
+    "small": {"entities": 20, "years": 10},
+    "yearly": {"entities": 2000, "years": 50, "category": True},
+    "monthly": {"entities": 300, "years": 20, "per_year": 12, "category": True},
+    "dense-daily": {"entities": 50, "years": 5, "per_year": 365},
+    "sparse-daily": {"entities": 500, "years": 5, "per_year": 365, "sparse": 0.9, "url": False},
+}
+CASE_OPTIONS = {
+    "entities": int,
+    "years": int,
+    "per_year": int,
+    "category": lambda v: v not in ("0", "false"),
+    "url": lambda v: v not in ("0", "false"),
+    "sparse": float,
+    "seed": int,
+}
+
+# Differences below these are noise, never regressions
+MIN_SECONDS = 0.005
+MIN_BYTES = 1024 * 1024
+
+
+def case_from_spec(spec):
+    """
+    Options of `synthetic_result` of a case, given by name or as options.
+
+    # Raises
+
+    - `ValueError` if the case is unknown or an option is invalid.
+    """
+    if spec in CASES:
+        return dict(CASES[spec])
+    options = {}
+    for name, value in re.findall(r"(\w+)=([\w.]+)", spec):
+        if name not in CASE_OPTIONS:
+            raise ValueError(f"unknown option {name}")
+        options[name] = CASE_OPTIONS[name](value)
+    if not options:
+        raise ValueError(f"unknown case {spec}")
+    return options
+
+
+def measure(function, repeat=3):
+    """
+    Best time of `repeat` runs of the function and its peak traced memory.
+    """
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    tracemalloc.start()
+    try:
+        current, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak - current}
+
+
+def fresh(observations):
+    """
+    The observations without the periods and masks cached by earlier runs.
+    """
+    return Observations(
+        observations.codes, observations.days, observations.values, observations.names, observations.categories
+    )
+
+
+def stages(df):
+    """
+    Stages of the charts of a query result, as a dictionary from name to a
+    function running the stage. Stages of time units are named as
+    "stage[time unit]", and only run for time units whose series are
+    computed, see `plan_time_units`.
+    """
+    bdf = BaseDf(df).prepare()
+    observations = bdf.observations()
+    plan = plan_time_units(observations, "records", FRAME_BARS)
+    result = {
+        "process_table": lambda: process_table(df),
+        "table_page": lambda: Table(df).page(limit=10, sort=df.columns[-2]),
+        "prepare": lambda: BaseDf(df).prepare(),
+        "observations": lambda: Observations.from_df(bdf.df),
+        "plan": lambda: plan_time_units(fresh(observations), "records", FRAME_BARS),
+    }
+    for time_unit, series in plan.items():
+        if series.decision == SKIP:
+            continue
+        if series.decision == COMPUTE:
+            result[f"interpolated_df[{time_unit}]"] = (
+                lambda u=time_unit: DfProcessor(bdf, u, fresh(observations)).interpolated_df()
+            )
+            result[f"values_by_date[{time_unit}]"] = (
+                lambda u=time_unit: DfProcessor(bdf, u, fresh(observations)).values_by_date()
+            )
+        result[f"frames[{time_unit}]"] = (
+            lambda u=time_unit, s=series.step: fresh(observations).frames(u, FRAME_BARS, step=s)
+        )
+    result["process_bar_chart_race"] = lambda: process_bar_chart_race(df)
+    return result
+
+
+DATE_FORMATS = {"year": "%Y-01-01", "month": "%Y-%m-01", "day": "%Y-%m-%d"}
+DATE_FREQUENCIES = {"year": "YS", "month": "MS", "day": "D"}
+
+
+def reference_frames(bdf, time_unit):
+    """
+    Frames as records of a time unit computed with pandas: the first
+    observation of each entity in each period, on a timeline interpolated
+    linearly and filled with 0, with the `FRAME_BARS` top entities of each
+    period and those leaving the top after it.
+
+    :param bdf: prepared BaseDf, with its frame
+    """
+    df = bdf.df.astype({column: object for column in BaseDf.IDENTIFIERS if column in bdf.df.columns})
+    dates = df["date"].dt.tz_localize(None) if df["date"].dt.tz is not None else df["date"]
+    periods = dates.dt.to_period(DATE_FREQUENCIES[time_unit][0]).dt.start_time
+    df = df.assign(date=periods.dt.strftime(DATE_FORMATS[time_unit]))
+    first, last = periods.min(), periods.max()
+    if time_unit == "month" and first.year == last.year:
+        last = last.replace(month=12)
+    time_units = pd.date_range(first, last, freq=DATE_FREQUENCIES[time_unit]).strftime(DATE_FORMATS[time_unit])
+    index = pd.MultiIndex.from_product([df["name"].unique(), time_units], names=["name", "date"])
+    ip = (
+        df.drop_duplicates(["name", "date"])
+        .set_index(["name", "date"])
+        .reindex(index)
+        .reset_index()
+        .pivot(index="date", columns=["name"], values="value")
+        .interpolate()
+        .melt(ignore_index=False)
+        .reset_index()
+    )
+    ip["value"] = ip["value"].fillna(0)
+    ip["rank"] = ip.groupby("date")["value"].rank(method="first", ascending=False)
+    if "category" in df.columns:
+        categories = df[["name", "category"]].drop_duplicates().set_index("name")["category"].to_dict()
+        ip["category"] = ip["name"].apply(lambda name: categories.get(name))
+    records = []
+    previous = None
+    for date, grouped in (
+        ip.sort_values(["date", "rank"], ascending=[False, True])
+        .groupby("date", sort=False)
+        .head(FRAME_BARS)
+        .groupby("date", sort=False)
+    ):
+        if previous is not None:
+            leaving = previous[~previous["name"].isin(grouped["name"])].copy()
+            if leaving.shape[0] > 0:
+                leaving["rank"] = (
+                    leaving["value"].rank(method="first", ascending=False)
+                    + grouped[grouped["value"] > 0]["rank"].max()
+                )
+                leaving["value"] = 0.0
+                grouped = pd.concat([grouped, leaving])
+        records.append({"date": date, "values": grouped.to_dict(orient="records")})
+        previous = grouped[grouped["value"] > 0]
+    records.reverse()
+    return records
+
+
+def decode_compact(compact):
+    """
+    Frames as records from the compact format, see `Frames.to_compact`.
+    """
+    records = []
+    categories = compact.get("categories")
+    for t, date in enumerate(compact["dates"]):
+        values = []
+        for j, (e, v, r) in enumerate(zip(compact["index"][t], compact["value"][t], compact["rank"][t])):
+            value = {"date": date if j < compact["n"] else compact["dates"][t + 1], "name": compact["names"][e]}
+            value.update({"value": v, "rank": r})
+            if categories is not None:
+                value["category"] = categories[e]
+            values.append(value)
+        records.append({"date": date, "values": values})
+    return records
+
+
+def decode_delta(delta):
+    """
+    Frames as records from the delta format, see `Frames.to_delta`.
+    """
+    records = []
+    categories = delta.get("categories")
+    order, known = None, {}
+    for t, (date, frame) in enumerate(zip(delta["dates"], delta["frames"])):
+        if "index" in frame:
+            order, known = list(frame["index"]), {}
+        for position, e in frame.get("moves", []):
+            order[position] = e
+        for e, start, value, slope in frame.get("segments", []):
+            known[e] = (start, value, slope)
+        values = [known[e][2] * (t - known[e][0]) + known[e][1] for e in order]
+        last = max((j + 1 for j, value in enumerate(values) if value > 0), default=0)
+        bars = [(date, e, float(value), float(j + 1)) for j, (e, value) in enumerate(zip(order, values))]
+        for j, e in enumerate(frame.get("exits", [])):
+            bars.append((delta["dates"][t + 1], e, 0.0, float(last + j + 1)))
+        values = []
+        for bar_date, e, value, rank in bars:
+            bar = {"date": bar_date, "name": delta["names"][e], "value": value, "rank": rank}
+            if categories is not None:
+                bar["category"] = categories[e]
+            values.append(bar)
+        records.append({"date": date, "values": values})
+    return records
+
+
+def backend_records(backend):
+    def records(bdf, time_unit):
+        with override_settings(CHART_EXECUTOR=backend):
+            frames = compute_frames(fresh(bdf.observations()), [time_unit], FRAME_BARS)
+        return frames[time_unit].to_records()
+
+    return records
+
+
+def store_records(bdf, time_unit):
+    frames = fresh(bdf.observations()).frames(time_unit, FRAME_BARS, segments=True)
+    with tempfile.TemporaryDirectory() as directory, override_settings(CHART_CACHE_DIR=directory):
+        store.save_frames("benchmark", "frames", frames)
+        return store.load_frames("benchmark", "frames").to_records()
+
+
+ENGINES = {
+    "records": lambda bdf, u: DfProcessor(bdf, u, fresh(bdf.observations())).values_by_date(),
+    "compact": lambda bdf, u: decode_compact(fresh(bdf.observations()).frames(u, FRAME_BARS).to_compact()),
+    "delta": lambda bdf, u: decode_delta(fresh(bdf.observations()).frames(u, FRAME_BARS, segments=True).to_delta()),
+    "thread": backend_records("thread"),
+    "process": backend_records("process"),
+    "store": store_records,
+}
+
+
+def difference(expected, records):
+    """
+    First difference between two lists of frames as records, or None.
+    """
+    if len(expected) != len(records):
+        return f"{len(records)} frames instead of {len(expected)}"
+    for t, (a, b) in enumerate(zip(expected, records)):
+        if a != b:
+            return f"frame {t} of {a['date']} differs"
+    return None
+
+
+def check_engines(df, engines):
+    """
+    Differences of the frames of each engine from `reference_frames`, for the
+    time units whose series are computed.
+
+    :param engines: dictionary from engine name to function of a prepared
+        BaseDf and a time unit returning its frames as records
+    :return: dictionary from engine name to a dictionary from time unit to the
+        first difference, None when the frames are the same
+    """
+    bdf = BaseDf(df).prepare()
+    plan = plan_time_units(bdf.observations(), "records", FRAME_BARS)
+    time_units = [u for u, series in plan.items() if series.decision == COMPUTE]
+    expected = {u: reference_frames(bdf, u) for u in time_units}
+    return {
+        name: {u: difference(expected[u], engine(bdf, u)) for u in time_units}
+        for name, engine in engines.items()
+    }
+
+
+class Benchmark:
+    def __init__(self, cases, repeat=3, engines=None):
+        """
+        :param cases: dictionary from case name to options of `synthetic_result`
+        :param engines: names of the `ENGINES` to check, all of them when None
+        """
+        self.cases = cases
+        self.repeat = repeat
+        self.engines = {name: ENGINES[name] for name in (ENGINES if engines is None else engines)}
+
+    def run(self):
+        """
+        Runs the stages of every case and returns the report.
+        """
+        report = {"engine_version": ENGINE_VERSION, "repeat": self.repeat, "cases": {}}
+        # processed charts are never loaded from disk while measured
+        with override_settings(CHART_CACHE_DIR=""):
+            for name, options in self.cases.items():
+                df = synthetic_result(**options)
+                case = {"options": options, "rows": len(df), "stages": {}}
+                for stage, function in stages(df).items():
+                    case["stages"][stage] = measure(function, self.repeat)
+                with collect() as timings:
+                    process_bar_chart_race(df)
+                case["breakdown"] = timings.summary()
+                if self.engines:
+                    case["equivalence"] = check_engines(df, self.engines)
+                report["cases"][name] = case
+        return report
+
+
+def compare(report, baseline, threshold=0.2):
+    """
+    Stages of the report slower or using more memory than in the baseline by
+    more than `threshold` times its value, and by more than `MIN_SECONDS` or
+    `MIN_BYTES`, when both have the same case.
+
+    :return: list of dictionaries with the case, stage, metric, and the
+        baseline and report values
+    """
+    regressions = []
+    noise = {"seconds": MIN_SECONDS, "peak_bytes": MIN_BYTES}
+    for name, case in report["cases"].items():
+        base = baseline["cases"].get(name)
+        if base is None or base["options"] != case["options"]:
+            continue
+        for stage, values in case["stages"].items():
+            if stage not in base["stages"]:
+                continue
+            for metric, minimum in noise.items():
+                before, after = base["stages"][stage][metric], values[metric]
+                if after - before > max(threshold * before, minimum):
+                    regressions.append(
+                        {"case": name, "stage": stage, "metric": metric, "baseline": before, "value": after}
+                    )
+    return regressions
+
+
+def differences(report):
+    """
+    Engines whose frames differ from `reference_frames` in the report,
+    as a list of (case, engine, time unit, difference).
+    """
+    return [
+        (name, engine, time_unit, difference)
+        for name, case in report["cases"].items()
+        for engine, time_units in case.get("equivalence", {}).items()
+        for time_unit, difference in time_units.items()
+        if difference is not None
+    ]
+
+
+def format_report(report, regressions=()):
+    lines = [f"engine version {report['engine_version']}, best of {report['repeat']}"]
+    flagged = {(r["case"], r["stage"], r["metric"]) for r in regressions}
+    for name, case in report["cases"].items():
+        lines.append(f"{name} ({case['rows']} rows)")
+        for stage, values in case["stages"].items():
+            slower = "!" if (name, stage, "seconds") in flagged else " "
+            larger = "!" if (name, stage, "peak_bytes") in flagged else " "
+            lines.append(
+                f"  {stage:<28}{values['seconds']:>10.4f}s{slower}"
+                f"{values['peak_bytes'] / 1024 / 1024:>10.1f}MiB{larger}"
+            )
+        for engine, time_units in case.get("equivalence", {}).items():
+            same = all(difference is None for difference in time_units.values())
+            lines.append(f"  {engine + ' engine':<28}{'same frames' if same else 'DIFFERENT frames'}")
+    for r in regressions:
+        lines.append(f"regression: {r['case']} {r['stage']} {r['metric']} {r['baseline']:.4g} -> {r['value']:.4g}")
+    return "\n".join(lines)
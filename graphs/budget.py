@@ -0,0 +1,95 @@
+"""
+Cost model of the bar chart race series.
+
+Building a series interpolates a dense matrix of the entities that can be
+visible × time units, so its memory grows with both, and its payload with the
+number of frames. Each series
+is planned within `CHART_CELL_BUDGET` cells and `CHART_PAYLOAD_BUDGET` bytes:
+it is computed when it fits, downsampled to one frame every few time units
+when that is enough to fit, and skipped otherwise.
+"""
+
+import logging
+import math
+
+from django.conf import settings
+
+logger = logging.getLogger("django")
+
+COMPUTE = "compute"
+DOWNSAMPLE = "downsample"
+SKIP = "skip"
+
+# Largest downsampling of each time unit, so that a series keeps at least two
+# frames per unit of the next coarser time unit, None for no limit
+MAX_STEPS = {"year": None, "month": 6, "day": 15}
+
+# Estimated payload of a frame of FRAME_BARS bars and of an entity listed by name
+FRAME_BYTES = {"records": 2800, "compact": 700, "delta": 60}
+ENTITY_BYTES = 40
+
+
+class SeriesPlan:
+    """
+    Decision for the series of a time unit, with the estimated cells and
+    payload bytes of what is computed, or of the whole series when skipped.
+    """
+
+    def __init__(self, time_unit, decision, step, cells, size):
+        self.time_unit = time_unit
+        self.decision = decision
+        self.step = step
+        self.cells = cells
+        self.size = size
+
+    def to_dict(self):
+        return {"decision": self.decision, "step": self.step, "cells": self.cells, "bytes": self.size}
+
+
+def estimate(observations, time_unit, step, encoding, head=None):
+    """
+    Cells and payload bytes of the series of a time unit with one frame every `step` units.
+
+    :param head: bars of each frame, to count only the entities that can be
+        visible, see `Observations.visible`, or None to count all of them
+    """
+    if head is None:
+        entities = len(observations.names)
+    else:
+        entities = int(observations.visible(time_unit, head).sum())
+    frames = observations.units(time_unit, step)
+    return frames * entities, frames * FRAME_BYTES[encoding] + entities * ENTITY_BYTES
+
+
+def plan_series(observations, time_unit, encoding="records", head=None):
+    """
+    Plans the series of a time unit within the budgets, with the smallest
+    step that fits, up to the `MAX_STEPS` of the time unit.
+
+    :param head: bars of each frame, see `estimate`
+    """
+    cells, size = estimate(observations, time_unit, 1, encoding, head)
+    cell_budget = settings.CHART_CELL_BUDGET
+    payload_budget = settings.CHART_PAYLOAD_BUDGET
+    if cells <= cell_budget and size <= payload_budget:
+        return SeriesPlan(time_unit, COMPUTE, 1, cells, size)
+    max_step = MAX_STEPS[time_unit] or observations.units(time_unit)
+    step = max(math.ceil(cells / cell_budget), math.ceil(size / payload_budget))
+    while step <= max_step:
+        step_cells, step_size = estimate(observations, time_unit, step, encoding, head)
+        if step_cells <= cell_budget and step_size <= payload_budget:
+            logger.info(f"downsampling {time_unit} series to one frame every {step} time units")
+            return SeriesPlan(time_unit, DOWNSAMPLE, step, step_cells, step_size)
+        step += 1
+    logger.info(f"skipping {time_unit} series of {cells} cells and {size} bytes")
+    return SeriesPlan(time_unit, SKIP, None, cells, size)
+
+
+def plan_time_units(observations, encoding="records", head=None):
+    """
+    Plans of the series of every time unit, from the coarsest to the finest.
+
+    :param head: bars of each frame, see `estimate`
+    :return: dictionary from time unit to SeriesPlan
+    """
+    return {u: plan_series(observations, u, encoding, head) for u in MAX_STEPS}
@@ -0,0 +1,677 @@
+import numpy as np
+import pandas as pd
+
+PERIODS = {"year": "datetime64[Y]", "month": "datetime64[M]", "day": "datetime64[D]"}
+# Version of the observations and frames computed here, and of what
+# `BaseDf.prepare` and `BaseDf.elements` in graphs/bar_chart_race.py make of a
+# query result, including the messages of the results it rejects. It keys the
+# charts saved on disk by `graphs.store`, so it must change whenever any of
+# them does.
+ENGINE_VERSION = 2
+KEYFRAME_INTERVAL = 100
+# Entities are pruned in blocks of rows, at most PRUNE_BLOCKS of them and at
+# most PRUNE_CELLS entities × blocks in all, for timelines of at least
+# PRUNE_MIN_RATIO cells per observation, below which pruning costs about as
+# much as interpolating every entity
+PRUNE_BLOCKS = 64
+PRUNE_CELLS = 2_000_000
+PRUNE_MIN_RATIO = 4
+
+
+class DenseTimeline:
+    """
+    Values of every entity over a time axis, as a time × entity float matrix.
+
+    Rows follow the time units, a sorted datetime64 array in the unit of the
+    timeline, and columns the sorted entity names. Categories are kept as one
+    value per entity instead of one per row.
+    """
+
+    def __init__(self, time_units, names, values, categories=None):
+        self.time_units = time_units
+        self.names = names
+        self.values = values
+        self.categories = categories
+        self.observed = values
+
+    def interpolate(self):
+        """
+        Fills the gaps of each entity linearly between its observations, repeats
+        its last observation until the end and leaves zeros before its first one.
+        The matrix of observations is kept in `observed`.
+        """
+        values = self.observed = self.values
+        rows = np.arange(values.shape[0])[:, None]
+        valid = ~np.isnan(values)
+        if valid.all():
+            return self
+        cols = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+        prev = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+        next = np.minimum.accumulate(
+            np.where(valid, rows, values.shape[0])[::-1], axis=0
+        )[::-1]
+        started = prev >= 0
+        ended = next >= values.shape[0]
+        prev_value = np.where(started, values[np.maximum(prev, 0), cols], np.nan)
+        next_value = np.where(ended, np.nan, values[np.minimum(next, values.shape[0] - 1), cols])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            slope = (next_value - prev_value) / (next - prev).astype(float)
+            between = slope * (rows - prev).astype(float) + prev_value
+        filled = np.where(ended, prev_value, between)
+        filled = np.where(valid, values, filled)
+        self.values = np.where(started, filled, 0.0)
+        return self
+
+    def segments(self, top):
+        """
+        Interpolation segment of the given entities in each time unit: the
+        index and value of its last observation and the slope towards the next
+        one, so that `interpolate` computes its value at t as
+        slope * (t - start) + start value. The slope is 0 after the last
+        observation, and the whole segment is 0 before the first one.
+
+        :param top: matrix of entity columns for each time unit
+        :return: matrices of starts, start values and slopes, shaped as top
+        """
+        observed = self.observed
+        count = observed.shape[0]
+        rows = np.arange(count)[:, None]
+        valid = ~np.isnan(observed)
+        prev = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+        next = np.minimum.accumulate(np.where(valid, rows, count)[::-1], axis=0)[::-1]
+        after = np.full(observed.shape, count)
+        after[:-1] = next[1:]
+        starts = np.take_along_axis(prev, top, axis=1)
+        started = starts >= 0
+        starts = np.where(started, starts, 0)
+        start_values = observed[starts, top]
+        ends = after[starts, top]
+        ended = ends >= count
+        end_values = observed[np.minimum(ends, count - 1), top]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            slopes = (end_values - start_values) / (ends - starts).astype(float)
+        slopes = np.where(started & ~ended, slopes, 0.0)
+        start_values = np.where(started, start_values, 0.0)
+        return starts, start_values, slopes
+
+    def ranks(self):
+        """
+        Rank of each entity in each time unit, by descending value with ties
+        broken by name order.
+        """
+        order = np.argsort(-self.values, axis=1, kind="stable")
+        ranks = np.empty(self.values.shape)
+        np.put_along_axis(ranks, order, np.arange(1, self.values.shape[1] + 1, dtype=float)[None, :], axis=1)
+        return ranks
+
+    def to_long_df(self):
+        """
+        DataFrame with one row per entity and time unit, ordered by name and date.
+        """
+        count = len(self.time_units)
+        df = pd.DataFrame(
+            {
+                "date": np.tile(format_dates(self.time_units), len(self.names)),
+                "name": np.repeat(self.names, count),
+                "value": self.values.T.ravel(),
+                "rank": self.ranks().T.ravel(),
+            }
+        )
+        if self.categories is not None:
+            df["category"] = np.repeat(self.categories, count)
+        return df
+
+
+class Observations:
+    """
+    Observations of a prepared DataFrame, coded once so that the timelines of
+    every time unit are built from the same entity codes, categories and dates.
+    """
+
+    def __init__(self, codes, days, values, names, categories=None):
+        self.codes = codes
+        self.days = days
+        self.values = values
+        self.names = names
+        self.categories = categories
+        self._visible = {}
+        self._periods = None
+
+    @classmethod
+    def from_df(cls, df):
+        """
+        :param df: DataFrame with name, value and date columns and an optional category column
+        """
+        if isinstance(df["name"].dtype, pd.CategoricalDtype):
+            codes, names = df["name"].cat.codes.to_numpy(dtype=np.int64), df["name"].cat.categories
+        else:
+            codes, names = pd.factorize(df["name"], sort=True)
+        dates = pd.DatetimeIndex(df["date"])
+        if dates.tz is not None:
+            dates = dates.tz_localize(None)
+        days = dates.to_numpy().astype("datetime64[D]")
+        keep = ~np.isnat(days)
+        names = np.asarray(names, dtype=object)
+        categories = None
+        if "category" in df.columns:
+            mapping = df[["name", "category"]].drop_duplicates().set_index("name")["category"].to_dict()
+            categories = pd.Series(names).apply(lambda name: mapping.get(name)).to_numpy()
+        values = df["value"].to_numpy(dtype=float)
+        return cls(codes[keep], days[keep], values[keep], names, categories)
+
+    def periods(self, time_unit):
+        """
+        Period of each observation, as an integer count of time units since 1970.
+        The periods of the last time unit are kept, since the timeline and its
+        span need them several times.
+        """
+        cached = self._periods
+        if cached is None or cached[0] != time_unit:
+            cached = self._periods = (time_unit, self.days.astype(PERIODS[time_unit]).astype(np.int64))
+        return cached[1]
+
+    def span(self, time_unit):
+        """
+        First and last periods of the timeline of the time unit. Monthly
+        timelines within a single year run until its December.
+        """
+        periods = self.periods(time_unit)
+        first, last = int(periods.min()), int(periods.max())
+        if time_unit == "month" and first // 12 == last // 12:
+            last = first // 12 * 12 + 11
+        return first, last
+
+    def observed(self, time_unit, step=1):
+        """
+        Rows, entity codes and values of the first observation of each entity
+        in each row of the timeline of the time unit, ordered by code and row.
+
+        :param step: time units per row, downsampling the timeline when above 1
+        """
+        periods = self.periods(time_unit)
+        first, last = self.span(time_unit)
+        known = self.codes >= 0
+        count = self.units(time_unit, step)
+        keys = self.codes[known] * count + (periods[known] - first) // step
+        keys, index = np.unique(keys, return_index=True)
+        return keys % count, keys // count, self.values[known][index]
+
+    def timeline(self, time_unit, step=1, entities=None):
+        """
+        Dense timeline over the span of the time unit, keeping the first
+        observation of each entity in each period.
+
+        :param step: time units per row, downsampling the timeline when above 1
+        :param entities: mask of the entities to keep, all of them when None
+        """
+        rows, codes, values = self.observed(time_unit, step)
+        names, categories = self.names, self.categories
+        if entities is not None and not entities.all():
+            kept = entities[codes]
+            rows, codes, values = rows[kept], (np.cumsum(entities) - 1)[codes[kept]], values[kept]
+            names = names[entities]
+            categories = None if categories is None else categories[entities]
+        first, last = self.span(time_unit)
+        matrix = np.full(((last - first) // step + 1, len(names)), np.nan)
+        matrix[rows, codes] = values
+        time_units = np.arange(first, last + 1, step).astype(PERIODS[time_unit])
+        return DenseTimeline(time_units, names, matrix, categories)
+
+    def visible(self, time_unit, head, step=1):
+        """
+        Mask of the entities that can be among the `head` top bars of some
+        frame of the time unit, see `visible_entities`.
+        """
+        key = (time_unit, head, step)
+        if key not in self._visible:
+            count = self.units(time_unit, step)
+            if count * len(self.names) < PRUNE_MIN_RATIO * len(self.codes):
+                visible = np.ones(len(self.names), dtype=bool)
+            else:
+                rows, codes, values = self.observed(time_unit, step)
+                visible = visible_entities(rows, codes, values, count, len(self.names), head)
+            self._visible[key] = visible
+        return self._visible[key]
+
+    def frames(self, time_unit, head, segments=False, step=1):
+        """
+        Frames of the interpolated timeline of the time unit, with `head` bars
+        each. Entities that are never visible are left out of the timeline.
+        """
+        timeline = self.timeline(time_unit, step, self.visible(time_unit, head, step))
+        return Frames.from_timeline(timeline.interpolate(), head, segments)
+
+    def units(self, time_unit, step=1):
+        """
+        Number of rows of the timeline of the time unit.
+        """
+        first, last = self.span(time_unit)
+        return (last - first) // step + 1
+
+    def original_time_units(self, time_unit):
+        """
+        Time units with observations, latest first in order of appearance.
+        """
+        units = format_dates(pd.unique(self.periods(time_unit)).astype(PERIODS[time_unit])).tolist()
+        units.reverse()
+        return units
+
+    def year_count(self):
+        years = self.periods("year")
+        return int(years.max() - years.min() + 1)
+
+    def resolution(self):
+        """
+        Coarsest time unit whose first days hold all observations.
+        """
+        for time_unit in ("year", "month"):
+            if (self.days == self.days.astype(PERIODS[time_unit]).astype(self.days.dtype)).all():
+                return time_unit
+        return "day"
+
+
+def format_dates(dates):
+    """
+    Formats datetime64 time units as their first day, as "YYYY-MM-DD".
+    """
+    return np.datetime_as_string(np.asarray(dates).astype("datetime64[D]"), unit="D")
+
+
+def top_k(values, k):
+    """
+    Columns of the k highest values of each row, ordered by descending value
+    with ties broken by column order, as `DenseTimeline.ranks` does.
+    """
+    rows, columns = values.shape
+    if columns <= k:
+        return np.argsort(-values, axis=1, kind="stable")
+    threshold = -np.partition(-values, k - 1, axis=1)[:, k - 1][:, None]
+    greater = values > threshold
+    equal = values == threshold
+    missing = k - greater.sum(axis=1)[:, None]
+    selected = greater | (equal & (np.cumsum(equal, axis=1) <= missing))
+    top = np.nonzero(selected)[1].reshape(rows, k)
+    order = np.argsort(-np.take_along_axis(values, top, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1)
+
+
+def visible_entities(rows, codes, values, count, entities, head):
+    """
+    Mask of the entities that can be among the `head` highest values of some
+    row of the interpolated timeline, from its observations only.
+
+    The rows are split in blocks. In each block an entity takes values between
+    its observations in the block and around it, or 0 before its first one,
+    since it is interpolated linearly between them. An entity whose highest
+    value in every block is below the `head` highest lowest values of the
+    others in the block is never visible. The mask is conservative: every
+    visible entity is kept, and some invisible ones may be kept too.
+
+    :param rows: row of each observation, ordered by entity code and row
+    :param codes: entity code of each observation
+    :param values: value of each observation
+    :param count: number of rows of the timeline
+    :param entities: number of entities
+    """
+    keep = np.ones(entities, dtype=bool)
+    valid = ~np.isnan(values)
+    if entities <= head or not np.isfinite(values[valid]).all():
+        return keep
+    if not valid.all():
+        rows, codes, values = rows[valid], codes[valid], values[valid]
+    blocks = max(1, min(count, PRUNE_BLOCKS, PRUNE_CELLS // entities))
+    size = -(-count // blocks)
+    blocks = -(-count // size)
+    block = rows // size
+    keys = codes * blocks + block
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+    run_codes, run_blocks = codes[starts], block[starts]
+    shape = (entities, blocks)
+    highest = np.full(shape, np.nan)
+    lowest = np.full(shape, np.nan)
+    first_row = np.full(shape, count)
+    first_value = np.full(shape, np.nan)
+    last_value = np.full(shape, np.nan)
+    if len(keys):
+        highest[run_codes, run_blocks] = np.maximum.reduceat(values, starts)
+        lowest[run_codes, run_blocks] = np.minimum.reduceat(values, starts)
+        first_row[run_codes, run_blocks] = rows[starts]
+        first_value[run_codes, run_blocks] = values[starts]
+        last_value[run_codes, run_blocks] = values[ends]
+    observed = ~np.isnan(highest)
+    columns = np.arange(blocks)
+    # last observation before each block and first one after it
+    before = np.maximum.accumulate(np.where(observed, columns, -1), axis=1)
+    before = np.c_[np.full(entities, -1), before[:, :-1]]
+    after = np.minimum.accumulate(np.where(observed, columns, blocks)[:, ::-1], axis=1)[:, ::-1]
+    after = np.c_[after[:, 1:], np.full(entities, blocks)]
+    lines = np.arange(entities)[:, None]
+    previous = np.where(before >= 0, last_value[lines, np.maximum(before, 0)], np.nan)
+    next = np.where(after < blocks, first_value[lines, np.minimum(after, blocks - 1)], np.nan)
+    next = np.where((before >= 0) | observed, next, np.nan)
+    zero = np.where((before < 0) & (first_row > columns * size), 0.0, np.nan)
+    for bound in (previous, next, zero):
+        highest = np.fmax(highest, bound)
+        lowest = np.fmin(lowest, bound)
+    threshold = -np.partition(-lowest, head - 1, axis=0)[head - 1]
+    keep = (highest >= threshold).any(axis=1)
+    return keep
+
+
+class Frames:
+    """
+    Bar chart race frames kept as arrays, with the datetime64 time units of
+    the timeline as dates, formatted only when the frames are encoded.
+
+    Each time unit has its top entities in rank order and the entities that
+    leave the top from it to the next time unit, which are shown with value 0
+    below the last positive bar so that they can transition out.
+    """
+
+    def __init__(
+        self,
+        dates,
+        names,
+        categories,
+        top,
+        top_values,
+        exit_offsets,
+        exit_entities,
+        exit_ranks,
+        segments=None,
+    ):
+        self.dates = dates
+        self.names = names
+        self.categories = categories
+        self.top = top
+        self.top_values = top_values
+        self.exit_offsets = exit_offsets
+        self.exit_entities = exit_entities
+        self.exit_ranks = exit_ranks
+        self.segments = segments
+        self._labels = None
+
+    @classmethod
+    def from_timeline(cls, timeline, head, segments=False):
+        """
+        :param segments: also keep the interpolation segments of the top bars, see `to_delta`
+        """
+        values = timeline.values
+        top = top_k(values, head)
+        top_values = np.take_along_axis(values, top, axis=1)
+        exit_offsets, exit_entities, exit_ranks = exits(top, top_values)
+        return cls(
+            timeline.time_units,
+            timeline.names,
+            timeline.categories,
+            top,
+            top_values,
+            exit_offsets,
+            exit_entities,
+            exit_ranks,
+            timeline.segments(top) if segments else None,
+        )
+
+    def __len__(self):
+        return len(self.dates)
+
+    def labels(self):
+        """
+        Names and categories of the entities as lists, converted once for all
+        the batches of frames encoded.
+        """
+        if self._labels is None:
+            categories = None if self.categories is None else self.categories.tolist()
+            self._labels = (self.names.tolist(), categories)
+        return self._labels
+
+    def exit_range(self, start, stop):
+        """
+        Offsets of the leaving bars of the frames from `start` to `stop`,
+        relative to the first one, and the slice of them in the exit arrays.
+        """
+        offsets = self.exit_offsets[start : stop + 1]
+        return offsets - offsets[0], slice(offsets[0], offsets[-1])
+
+    def to_records(self, start=0, stop=None):
+        """
+        List of frames, each with its date and a list of bars as dictionaries.
+
+        :param start: first frame of the list
+        :param stop: frame after the last one of the list, the end when None
+        """
+        start, stop = self.bounds(start, stop)
+        names, categories = self.labels()
+        dates = format_dates(self.dates[start : stop + 1]).tolist()
+        top = self.top[start:stop].tolist()
+        top_values = self.top_values[start:stop].tolist()
+        exit_offsets, exit_slice = self.exit_range(start, stop)
+        exit_offsets = exit_offsets.tolist()
+        exit_entities = self.exit_entities[exit_slice].tolist()
+        exit_ranks = self.exit_ranks[exit_slice].tolist()
+        frames = []
+        for t in range(stop - start):
+            date = dates[t]
+            bars = [(date, e, v, float(r)) for r, (e, v) in enumerate(zip(top[t], top_values[t]), 1)]
+            begin, end = exit_offsets[t], exit_offsets[t + 1]
+            if begin < end:
+                exit_date = dates[t + 1]
+                bars.extend(
+                    (exit_date, e, 0.0, r)
+                    for e, r in zip(exit_entities[begin:end], exit_ranks[begin:end])
+                )
+            if categories is None:
+                values = [
+                    {"date": d, "name": names[e], "value": v, "rank": r} for d, e, v, r in bars
+                ]
+            else:
+                values = [
+                    {"date": d, "name": names[e], "value": v, "rank": r, "category": categories[e]}
+                    for d, e, v, r in bars
+                ]
+            frames.append({"date": date, "values": values})
+        return frames
+
+    def to_compact(self, precision=None):
+        """
+        Frames in the compact format. Names, and categories, are listed once
+        and each frame has parallel lists of entity indexes, values and ranks.
+        The first `n` bars of a frame are its top bars, the others are leaving
+        bars with value 0 and the date of the next frame.
+
+        :param precision: significant digits kept in the values, all when None
+        """
+        compact = self.compact_header()
+        compact.update(
+            {
+                "index": self.compact_indexes(),
+                "value": self.compact_values(precision),
+                "rank": self.compact_ranks(),
+            }
+        )
+        return compact
+
+    def compact_header(self):
+        """
+        The compact format without the lists of indexes, values and ranks.
+        """
+        names, categories = self.labels()
+        compact = {"format": "compact", "names": names}
+        if categories is not None:
+            compact["categories"] = categories
+        compact.update({"dates": format_dates(self.dates).tolist(), "n": self.top.shape[1]})
+        return compact
+
+    def compact_indexes(self, start=0, stop=None):
+        """
+        Entity indexes of the frames from `start` to `stop` in the compact format.
+        """
+        offsets, exit_slice = self.exit_range(*self.bounds(start, stop))
+        return compact_rows(self.top[start:stop], offsets, self.exit_entities[exit_slice])
+
+    def compact_values(self, precision=None, start=0, stop=None):
+        """
+        Values of the frames from `start` to `stop` in the compact format.
+        """
+        values = self.top_values[start:stop]
+        if precision is not None:
+            values = round_significant(values, precision)
+        offsets, exit_slice = self.exit_range(*self.bounds(start, stop))
+        exit_values = np.zeros(offsets[-1], dtype=np.int64)
+        return compact_rows(as_integers(values), offsets, exit_values)
+
+    def compact_ranks(self, start=0, stop=None):
+        """
+        Ranks of the frames from `start` to `stop` in the compact format.
+        """
+        count, n = self.top[start:stop].shape
+        top_ranks = np.broadcast_to(np.arange(1, n + 1), (count, n))
+        offsets, exit_slice = self.exit_range(*self.bounds(start, stop))
+        return compact_rows(top_ranks, offsets, as_integers(self.exit_ranks[exit_slice]))
+
+    def bounds(self, start, stop):
+        """
+        The frames from `start` to `stop` as a range of existing frames.
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        return min(start, stop), stop
+
+    def to_delta(self, keyframe_interval=KEYFRAME_INTERVAL):
+        """
+        Frames in the delta format, which needs the frames built with segments.
+
+        Names, and categories, are listed once as in the compact format. Every
+        `keyframe_interval` frames a keyframe has the entity indexes of its top
+        bars in "index". Other frames only have the positions whose entity
+        changed since the previous frame in "moves", as [position, entity].
+
+        Values are sent as interpolation segments [entity, start, start value,
+        slope] in "segments", only when the segment of a top entity is not
+        already known since the last keyframe. The value of a bar at frame t is
+        slope * (t - start) + start value, which gives the same floats as the
+        server. Leaving bars are listed in "exits", with value 0 and ranked
+        after the last positive bar.
+        """
+        delta = self.delta_header(keyframe_interval)
+        delta["frames"] = list(self.delta_frames(keyframe_interval))
+        return delta
+
+    def delta_header(self, keyframe_interval=KEYFRAME_INTERVAL):
+        """
+        The delta format without the list of frames.
+        """
+        names, categories = self.labels()
+        delta = {"format": "delta", "names": names}
+        if categories is not None:
+            delta["categories"] = categories
+        delta.update(
+            {
+                "dates": format_dates(self.dates).tolist(),
+                "n": self.top.shape[1],
+                "keyframe_interval": keyframe_interval,
+            }
+        )
+        return delta
+
+    def delta_frames(self, keyframe_interval=KEYFRAME_INTERVAL):
+        """
+        Generator of the frames of the delta format, in order.
+        """
+        top = self.top.tolist()
+        starts, start_values, slopes = self.segments
+        starts = starts.tolist()
+        start_values = start_values.tolist()
+        slopes = slopes.tolist()
+        exit_offsets = self.exit_offsets.tolist()
+        exit_entities = self.exit_entities.tolist()
+        known = {}
+        for t in range(len(top)):
+            frame = {}
+            if t % keyframe_interval == 0:
+                known = {}
+                frame["index"] = top[t]
+            else:
+                moves = [[j, e] for j, (e, before) in enumerate(zip(top[t], top[t - 1])) if e != before]
+                if moves:
+                    frame["moves"] = moves
+            segments = []
+            for e, start, value, slope in zip(top[t], starts[t], start_values[t], slopes[t]):
+                if known.get(e) != start:
+                    known[e] = start
+                    segments.append([e, start, as_integer(value), as_integer(slope)])
+            if segments:
+                frame["segments"] = segments
+            start, end = exit_offsets[t], exit_offsets[t + 1]
+            if start < end:
+                frame["exits"] = exit_entities[start:end]
+            yield frame
+
+
+def compact_rows(rows, offsets, exits):
+    """
+    Lists of the `rows` of consecutive frames, each followed by the `exits` of
+    its frame, from `offsets[t]` to `offsets[t + 1]`.
+    """
+    rows = rows.tolist()
+    offsets = offsets.tolist()
+    exits = exits.tolist()
+    for t, row in enumerate(rows):
+        row.extend(exits[offsets[t] : offsets[t + 1]])
+    return rows
+
+
+def round_significant(values, digits):
+    """
+    Rounds each value to the number of significant digits.
+    """
+    values = np.array(values, dtype=float)
+    nonzero = np.isfinite(values) & (values != 0)
+    decimals = np.zeros(values.shape, dtype=np.int64)
+    decimals[nonzero] = digits - 1 - np.floor(np.log10(np.abs(values[nonzero]))).astype(np.int64)
+    for d in np.unique(decimals[nonzero]):
+        selected = nonzero & (decimals == d)
+        values[selected] = np.round(values[selected], d)
+    return values
+
+
+def as_integer(value):
+    """
+    The value as an integer when it is one, so that it is encoded without decimals.
+    """
+    if value.is_integer() and abs(value) < 2**53:
+        return int(value)
+    return value
+
+
+def as_integers(values):
+    """
+    The values as integers when all of them are, so that they are encoded without decimals.
+    """
+    if np.isfinite(values).all() and (values == np.trunc(values)).all() and (np.abs(values) < 2**53).all():
+        return values.astype(np.int64)
+    return values
+
+
+def exits(top, top_values):
+    """
+    Entities with a positive value in the top of the next time unit that are
+    not in the top of the current one, ranked after its last positive bar.
+
+    :return: offsets of each time unit in the flat arrays of entities and ranks
+    """
+    count, k = top.shape
+    positive = top_values > 0
+    leaving = np.zeros((count, k), dtype=bool)
+    if count > 1:
+        kept = (top[1:, :, None] == top[:-1, None, :]).any(axis=2)
+        leaving[:-1] = positive[1:] & ~kept
+    positions = np.arange(1, k + 1, dtype=float)
+    last_positive = np.where(positive, positions, 0).max(axis=1)
+    last_positive[last_positive == 0] = np.nan
+    ranks = np.cumsum(leaving, axis=1) + last_positive[:, None]
+    next_top = np.zeros_like(top)
+    next_top[:-1] = top[1:]
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(leaving.sum(axis=1), out=offsets[1:])
+    return offsets, next_top[leaving], ranks[leaving]
@@ -0,0 +1,61 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from graphs.benchmark import Benchmark
+from graphs.benchmark import case_from_spec
+from graphs.benchmark import CASES
+from graphs.benchmark import compare
+from graphs.benchmark import differences
+from graphs.benchmark import ENGINES
+from graphs.benchmark import format_report
+
+
+class Command(BaseCommand):
+    help = (
+        "Times each stage of the charts on synthetic query results, with its peak "
+        "memory, and checks alternative engines against DfProcessor."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--case",
+            action="append",
+            help=f"one of {', '.join(CASES)} or options such as "
+            "'entities=500 years=30 per_year=12 category=1', can be repeated, defaults to all",
+        )
+        parser.add_argument("--repeat", type=int, default=3, help="runs of each stage, the best is kept")
+        parser.add_argument(
+            "--engine",
+            action="append",
+            choices=list(ENGINES),
+            help="can be repeated, defaults to all",
+        )
+        parser.add_argument("--no-engines", action="store_true", help="skip the engine checks")
+        parser.add_argument("--baseline", help="compare with the JSON report in this file")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2, help="relative increase flagged as a regression"
+        )
+        parser.add_argument("--output", help="also write the report as JSON to this file")
+
+    def handle(self, *args, **options):
+        try:
+            cases = {spec: case_from_spec(spec) for spec in options["case"] or CASES}
+        except ValueError as e:
+            raise CommandError(e)
+        engines = [] if options["no_engines"] else options["engine"]
+        report = Benchmark(cases, options["repeat"], engines).run()
+        regressions = []
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                regressions = compare(report, json.load(f), options["threshold"])
+        self.stdout.write(format_report(report, regressions))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        different = differences(report)
+        for case, engine, time_unit, difference in different:
+            self.stderr.write(f"{engine} engine differs from DfProcessor in {case} {time_unit}: {difference}")
+        if regressions or different:
+            raise CommandError(f"{len(regressions)} regressions, {len(different)} different engines")
@@ -0,0 +1,107 @@
+"""
+Chart types built from query results.
+
+Each chart type has a `check` that tells from the columns and first rows of a
+result whether the chart can be built, without building it, an estimated
+`cost` and a `build` function. `build_charts` builds only the charts whose
+check passes, concurrently, so a chart type adds no latency to the queries it
+doesn't apply to. Chart types are added with `register`.
+"""
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from graphs.bar_chart_race import check_bar_chart_race
+from graphs.bar_chart_race import process_bar_chart_race
+from graphs.table import Table
+from infographics.timing import stage
+
+
+class Chart:
+    """
+    A chart type.
+
+    :param build: function of the query result and the options of
+        `build_charts` returning the chart data
+    :param check: function of the query result returning why the chart can't be
+        built, or None when it can, always None when not given
+    :param cost: function of the query result estimating the work of building
+        the chart, in rows, used to start the most expensive charts first
+    """
+
+    def __init__(self, name, build, check=None, cost=None):
+        self.name = name
+        self.build = build
+        self.check = check or (lambda df: None)
+        self.cost = cost or len
+
+
+CHARTS = {}
+
+
+def register(chart):
+    CHARTS[chart.name] = chart
+    return chart
+
+
+def build_charts(df, names=None, **options):
+    """
+    Builds the charts of a query result. Charts whose check fails are built as
+    {"failed": reason}. The others are built concurrently, the cheapest one in
+    the calling thread.
+
+    # Raises
+
+    - `ValueError` if a name is not a registered chart.
+
+    :param names: charts to build, all registered ones when None
+    :param options: keyword arguments passed to every builder
+    :return: dictionary from chart name to its data, in the order of `names`
+    """
+    names = list(CHARTS) if names is None else names
+    unknown = [name for name in names if name not in CHARTS]
+    if unknown:
+        raise ValueError(f"unknown charts {', '.join(unknown)}")
+    charts = {}
+    builds = []
+    for name in names:
+        reason = CHARTS[name].check(df)
+        if reason is None:
+            builds.append(CHARTS[name])
+        else:
+            charts[name] = {"failed": reason}
+    builds.sort(key=lambda chart: chart.cost(df), reverse=True)
+    if len(builds) == 1:
+        charts[builds[0].name] = timed_build(builds[0], df, options)
+    elif builds:
+        *others, cheapest = builds
+        with ThreadPoolExecutor(max_workers=len(others)) as executor:
+            futures = {
+                chart.name: executor.submit(contextvars.copy_context().run, timed_build, chart, df, options)
+                for chart in others
+            }
+            charts[cheapest.name] = timed_build(cheapest, df, options)
+            charts.update({name: future.result() for name, future in futures.items()})
+    return {name: charts[name] for name in names}
+
+
+def timed_build(chart, df, options):
+    """
+    Data of a chart, recorded as the "chart.<name>" stage.
+    """
+    with stage(f"chart.{chart.name}", rows=df.shape[0]):
+        return chart.build(df, **options)
+
+
+def build_table(df, **options):
+    return Table(df).page(limit=settings.TABLE_PAGE_SIZE)
+
+
+def build_bar_chart_race(df, granularity=None, on_prepared=None, encoding="records", precision=None, **options):
+    return process_bar_chart_race(df, granularity, on_prepared, encoding, precision)
+
+
+register(Chart("table", build_table, cost=lambda df: settings.TABLE_PAGE_SIZE))
+register(Chart("bar_chart_race", build_bar_chart_race, check_bar_chart_race))
@@ -0,0 +1,240 @@
+"""
+Processed bar chart race data saved on local disk.
+
+Preparing a query result with pandas and computing the frames of each time
+unit is paid again on every view of a chart, in every worker. The coded
+observations, elements and frames of a chart are saved under
+`CHART_CACHE_DIR`, keyed by `ENGINE_VERSION` and the digest of the content of
+the query result, so a result that changes is saved anew and entries of other
+versions are never read.
+
+Arrays are saved as .npy files and loaded memory mapped, and lists of names,
+categories and elements as JSON, so loading a chart does not unpickle anything
+nor use pandas. Entries are written to a temporary directory and renamed into
+place, so readers never see half written ones. Above `CHART_CACHE_MAX_BYTES`
+the least recently used entries are removed, which is checked after each
+worker saves another `1 / CULL_FRACTION` of it, rather than on every save.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from graphs.engine import ENGINE_VERSION
+from graphs.engine import Frames
+from graphs.engine import Observations
+
+logger = logging.getLogger("django")
+
+OBSERVATIONS = ("codes", "days", "values")
+FRAMES = ("dates", "top", "top_values", "exit_offsets", "exit_entities", "exit_ranks")
+SEGMENTS = ("starts", "start_values", "slopes")
+
+# Each worker removes the least recently used entries after saving this
+# fraction of CHART_CACHE_MAX_BYTES, so the cache grows beyond it by at most
+# that much per worker.
+CULL_FRACTION = 16
+
+_lock = threading.Lock()
+# bytes saved by this worker since the last cull, and the version it culled
+_saved = 0
+_culled_version = None
+
+
+def frames_key(time_unit, head, segments=False, step=1):
+    """
+    Name of the frames of a time unit in an entry, see `Observations.frames`.
+    """
+    return f"{time_unit}-{head}-{step}" + ("-segments" if segments else "")
+
+
+def entry_path(digest):
+    """
+    Directory of the entry of a query result, None when the cache is disabled
+    or the result has no digest.
+    """
+    if not settings.CHART_CACHE_DIR or not digest:
+        return None
+    return Path(settings.CHART_CACHE_DIR) / f"v{ENGINE_VERSION}" / digest
+
+
+def save_prepared(digest, observations=None, elements=None, failed=None):
+    """
+    Saves the observations and elements of a prepared query result, or the
+    message of why it can't be a bar chart race.
+    """
+    meta = {"failed": failed}
+    if failed is None:
+        meta.update(
+            {
+                "names": observations.names.tolist(),
+                "categories": None if observations.categories is None else observations.categories.tolist(),
+                "elements": elements,
+            }
+        )
+        arrays = {name: getattr(observations, name) for name in OBSERVATIONS}
+    else:
+        arrays = {}
+    save(digest, "prepared", meta, arrays)
+
+
+def load_prepared(digest):
+    """
+    :return: dictionary with the "observations" and "elements" of the query
+        result, or with a "failed" message, or None when it was not saved
+    """
+    loaded = load(digest, "prepared")
+    if loaded is None:
+        return None
+    meta, arrays = loaded
+    if meta["failed"] is not None:
+        return {"failed": meta["failed"]}
+    observations = Observations(
+        arrays["codes"],
+        arrays["days"],
+        arrays["values"],
+        object_array(meta["names"]),
+        object_array(meta["categories"]),
+    )
+    return {"observations": observations, "elements": meta["elements"]}
+
+
+def save_frames(digest, key, frames):
+    """
+    Saves the frames of a time unit, see `frames_key`.
+    """
+    meta = {
+        "names": frames.names.tolist(),
+        "categories": None if frames.categories is None else frames.categories.tolist(),
+    }
+    arrays = {name: getattr(frames, name) for name in FRAMES}
+    if frames.segments is not None:
+        arrays.update(zip(SEGMENTS, frames.segments))
+    save(digest, f"frames-{key}", meta, arrays)
+
+
+def load_frames(digest, key):
+    """
+    :return: the Frames saved with the key, or None
+    """
+    loaded = load(digest, f"frames-{key}")
+    if loaded is None:
+        return None
+    meta, arrays = loaded
+    segments = None
+    if all(name in arrays for name in SEGMENTS):
+        segments = tuple(arrays[name] for name in SEGMENTS)
+    return Frames(
+        arrays["dates"],
+        object_array(meta["names"]),
+        object_array(meta["categories"]),
+        arrays["top"],
+        arrays["top_values"],
+        arrays["exit_offsets"],
+        arrays["exit_entities"],
+        arrays["exit_ranks"],
+        segments,
+    )
+
+
+def object_array(values):
+    return None if values is None else np.array(values, dtype=object)
+
+
+def save(digest, name, meta, arrays):
+    entry = entry_path(digest)
+    if entry is None:
+        return
+    try:
+        text = json.dumps({**meta, "arrays": list(arrays)}, ensure_ascii=False)
+    except (TypeError, ValueError):
+        logger.info(f"chart {digest[:8]} has values that can't be saved as JSON")
+        return
+    try:
+        entry.mkdir(parents=True, exist_ok=True)
+        temporary = Path(tempfile.mkdtemp(dir=entry, prefix=".tmp-"))
+        try:
+            size = len(text)
+            for array_name, array in arrays.items():
+                np.save(temporary / f"{array_name}.npy", np.ascontiguousarray(array), allow_pickle=False)
+                size += array.nbytes
+            (temporary / "meta.json").write_text(text, encoding="utf-8")
+            os.rename(temporary, entry / name)
+        except OSError:
+            # the same data saved at the same time by another worker
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not (entry / name).exists():
+                raise
+    except OSError:
+        logger.exception(f"failed to save chart {digest[:8]} {name}")
+        return
+    saved(size)
+
+
+def saved(size):
+    """
+    Counts the bytes saved by this worker, culling the cache once they reach
+    `1 / CULL_FRACTION` of `CHART_CACHE_MAX_BYTES`, and on the first save of
+    each version of the engine.
+    """
+    global _saved, _culled_version
+    with _lock:
+        _saved += size
+        if _culled_version == ENGINE_VERSION and _saved < settings.CHART_CACHE_MAX_BYTES / CULL_FRACTION:
+            return
+        _saved = 0
+        _culled_version = ENGINE_VERSION
+    cull()
+
+
+def load(digest, name):
+    """
+    :return: the JSON metadata and the memory mapped arrays saved with the
+        name, or None when they are missing or can't be read
+    """
+    entry = entry_path(digest)
+    if entry is None or not (entry / name).is_dir():
+        return None
+    try:
+        meta = json.loads((entry / name / "meta.json").read_text(encoding="utf-8"))
+        arrays = {
+            array_name: np.asarray(np.load(entry / name / f"{array_name}.npy", mmap_mode="r"))
+            for array_name in meta["arrays"]
+        }
+        os.utime(entry)
+    except (OSError, ValueError):
+        # removed by `cull` while being read
+        logger.warning(f"failed to load chart {digest[:8]} {name}", exc_info=True)
+        return None
+    return meta, arrays
+
+
+def cull():
+    """
+    Removes the entries of other versions of the engine and the least recently
+    used entries above `CHART_CACHE_MAX_BYTES`.
+    """
+    root = Path(settings.CHART_CACHE_DIR)
+    current = root / f"v{ENGINE_VERSION}"
+    for version in root.iterdir():
+        if version != current and version.name.startswith("v"):
+            shutil.rmtree(version, ignore_errors=True)
+    entries = []
+    for entry in current.iterdir():
+        try:
+            size = sum(path.stat().st_size for path in entry.rglob("*") if path.is_file())
+            entries.append((entry.stat().st_mtime, size, entry))
+        except OSError:
+            continue
+    total = 0
+    for _, size, entry in sorted(entries, reverse=True):
+        total += size
+        if total > settings.CHART_CACHE_MAX_BYTES:
+            shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+
+def synthetic_result(
+    entities=10,
+    years=10,
+    per_year=1,
+    category=False,
+    url=True,
+    sparse=0.0,
+    start_year=2000,
+    seed=0,
+):
+    """
+    Generates a DataFrame shaped like the result of a population-style query,
+    with the string values `df_from_query` returns.
+
+    :param entities: number of distinct items
+    :param years: number of years covered
+    :param per_year: observations per item in each year, spread over the year
+    :param category: add a category label column, with one category per 10 items
+    :param url: add the item url column
+    :param sparse: fraction of observations randomly left out
+    :param start_year: first year of the observations
+    :param seed: seed of the random generator
+    :return: DataFrame with [item], itemLabel, [categoryLabel], value and date columns
+    """
+    rng = np.random.default_rng(seed)
+    entity = np.repeat(np.arange(entities), years * per_year)
+    step = np.tile(np.arange(years * per_year), entities)
+    base = rng.uniform(1_000, 1_000_000, entities)
+    growth = rng.uniform(0.95, 1.10, entities)
+    value = np.round(base[entity] * growth[entity] ** (step / per_year))
+    days = (step % per_year) * (365 // per_year)
+    dates = (
+        pd.to_datetime((start_year + step // per_year).astype(str), format="%Y")
+        + pd.to_timedelta(days, unit="D")
+    )
+    columns = {}
+    if url:
+        columns["item"] = [f"http://www.wikidata.org/entity/Q{i + 1}" for i in entity]
+    columns["itemLabel"] = [f"Item {i + 1}" for i in entity]
+    if category:
+        columns["categoryLabel"] = [f"Category {i // 10 + 1}" for i in entity]
+    columns["value"] = value.astype(np.int64).astype(str)
+    columns["date"] = dates.strftime("%Y-%m-%dT00:00:00Z")
+    df = pd.DataFrame(columns)
+    if sparse > 0:
+        df = df[rng.random(df.shape[0]) >= sparse].reset_index(drop=True)
+    return df.astype(object)
@@ -1,3 +1,7 @@
+import numpy as np
+import pandas as pd
+
+
 def process_table(data):
     """
     Process data for table visualization.
@@ -13,4 +17,118 @@ def process_table(data):
     result["columns"] = columns_list
     result["data"] = data.to_dict(orient='records')
 
-    return result
\ No newline at end of file
+    return result
+
+
+class Table:
+    """
+    Query result served as pages of rows, sorted, filtered and projected on
+    the server.
+
+    The sort order of a column and the lowercase text searched in it are
+    computed the first time they are needed and kept with the table, which
+    is cached between requests and must not be modified.
+    """
+
+    ORDERS = ("asc", "desc")
+
+    def __init__(self, df):
+        self.df = df
+        self._orders = {}
+        self._text = {}
+
+    def page(self, offset=0, limit=None, sort=None, order="asc", search=None, columns=None):
+        """
+        Rows from `offset` of the sorted and filtered table, column-oriented.
+
+        # Raises
+
+        - `ValueError` if a column or the order is unknown.
+
+        :param limit: rows of the page, all of them when None
+        :param sort: column to sort by, in the query order when None
+        :param order: "asc" or "desc"
+        :param search: text to look for in any column, case insensitive
+        :param columns: columns of the page, all of them when None
+        :return: dictionary with all the "columns", the "total" rows, the
+            "filtered" rows that match the search and the "data" of the page,
+            as a list of values for each of its columns
+        """
+        columns = self.columns(columns)
+        rows = self.rows(sort, order, search)
+        stop = None if limit is None else offset + limit
+        page = rows[offset:stop]
+        return {
+            "columns": list(self.df.columns),
+            "total": len(self.df),
+            "filtered": len(rows),
+            "offset": offset,
+            "sort": sort,
+            "order": order,
+            "data": {column: self.df[column].iloc[page].tolist() for column in columns},
+        }
+
+    def to_csv(self, sort=None, order="asc", search=None, columns=None):
+        """
+        CSV text of all the sorted and filtered rows, see `page`.
+        """
+        columns = self.columns(columns)
+        return self.df[columns].iloc[self.rows(sort, order, search)].to_csv(index=False)
+
+    def columns(self, columns):
+        if columns is None:
+            return list(self.df.columns)
+        unknown = set(columns) - set(self.df.columns)
+        if unknown:
+            raise ValueError(f"unknown columns {', '.join(sorted(unknown))}")
+        return list(columns)
+
+    def rows(self, sort=None, order="asc", search=None):
+        """
+        Positions of the rows matching the search, in the sort order.
+        """
+        if order not in self.ORDERS:
+            raise ValueError(f"unknown order {order}")
+        if sort is None:
+            rows = np.arange(len(self.df))
+        else:
+            rows = self.order(self.columns([sort])[0], order == "desc")
+        if search:
+            rows = rows[self.matches(search)[rows]]
+        return rows
+
+    def order(self, column, descending=False):
+        """
+        Stable sort order of a column, as numbers when all of its values are
+        numbers and else as text. Ties keep the query order in both directions
+        and missing values come last.
+        """
+        key = (column, descending)
+        if key not in self._orders:
+            values = self.df[column]
+            missing = values.isna().to_numpy()
+            present = np.flatnonzero(~missing)
+            values = values[~missing]
+            numbers = pd.to_numeric(values, errors="coerce")
+            if not numbers.isna().any():
+                keys = numbers.to_numpy(dtype=float)
+            else:
+                keys = values.astype(str).to_numpy()
+            if descending:
+                order = len(keys) - 1 - np.argsort(keys[::-1], kind="stable")[::-1]
+            else:
+                order = np.argsort(keys, kind="stable")
+            self._orders[key] = np.concatenate([present[order], np.flatnonzero(missing)])
+        return self._orders[key]
+
+    def matches(self, search):
+        """
+        Mask of the rows with the search text in any column, case insensitive.
+        """
+        search = search.lower()
+        mask = np.zeros(len(self.df), dtype=bool)
+        for column in self.df.columns:
+            if column not in self._text:
+                self._text[column] = self.df[column].fillna("").astype(str).str.lower()
+            mask |= self._text[column].str.contains(search, regex=False).to_numpy(dtype=bool)
+        return mask
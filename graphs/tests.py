@@ -1,12 +1,44 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from django.test import TestCase
+from django.test import override_settings
 from django.utils.timezone import now
 
 from graphs.table import process_table
+from graphs.table import Table
 from graphs.bar_chart_race import process_bar_chart_race
 from graphs.bar_chart_race import BaseDf
 from graphs.bar_chart_race import DfProcessor
+from graphs.bar_chart_race import Series
+from graphs import store
+from graphs.benchmark import Benchmark
+from graphs.benchmark import case_from_spec
+from graphs.benchmark import check_engines
+from graphs.benchmark import compare
+from graphs.benchmark import differences
+from graphs.benchmark import ENGINES
+from graphs.budget import plan_time_units
+from graphs.registry import build_charts
+from graphs.registry import Chart
+from graphs.registry import CHARTS
+from graphs.engine import DenseTimeline
+from graphs.engine import Frames
+from graphs.engine import format_dates
+from graphs.engine import Observations
+from graphs.engine import top_k
+from graphs.engine import visible_entities
+from graphs.synthetic import synthetic_result
+from graphs import workers
+from graphs.workers import compute_frames
+from infographics.timing import collect
 
 
 class TestHelper:
@@ -70,6 +102,23 @@ class QueryTests(TestCase):
             ],
         )
 
+    def test_table_page(self):
+        df = pd.DataFrame({"name": ["b", "a", "c", "a"], "value": ["10", "9", None, "10"]})
+        table = Table(df)
+        page = table.page(limit=2)
+        self.assertEqual((page["total"], page["filtered"]), (4, 4))
+        self.assertEqual(page["data"], {"name": ["b", "a"], "value": ["10", "9"]})
+        # numbers are sorted as numbers and ties keep the query order
+        self.assertEqual(table.page(sort="value")["data"]["name"], ["a", "b", "a", "c"])
+        self.assertEqual(table.page(sort="value", order="desc")["data"]["name"], ["b", "a", "a", "c"])
+        page = table.page(offset=1, sort="name", search="A", columns=["value"])
+        self.assertEqual((page["filtered"], page["data"]), (2, {"value": ["10"]}))
+        self.assertEqual(table.to_csv(search="c", columns=["name"]), "name\nc\n")
+        with self.assertRaises(ValueError):
+            table.page(sort="label")
+        with self.assertRaises(ValueError):
+            table.page(order="up")
+
     def test_bcr_base_errors(self):
         df = TestHelper.mock_df_table()
         msg = process_bar_chart_race(df)["failed"]
@@ -115,10 +164,50 @@ class QueryTests(TestCase):
         res = process_bar_chart_race(df)
         self.assertNotIn("failed", res)
 
+        for column in ["date", "itemLabel"]:
+            df = TestHelper.mock_df_bcr()
+            df[column] = None
+            msg = process_bar_chart_race(df)["failed"]
+            self.assertEqual(msg, "there should be at least one value with a name and a date")
+
     def test_base_df(self):
         df = TestHelper.mock_df_bcr()
-        BaseDf(df).prepare()
-        self.assertEqual(set(df.columns), set(("name", "url", "value", "date")))
+        df.loc[3] = ["http://www.wikidata.org/.well-known/genid/1", "Recife", 1, "2022-01-01"]
+        df.loc[4] = df.loc[0]
+        bdf = BaseDf(df).prepare()
+        self.assertEqual(list(bdf.df.columns), ["url", "name", "value", "date"])
+        self.assertEqual(list(bdf.df["name"]), ["Porto Alegre", "Fortaleza", "São Paulo"])
+        self.assertEqual(bdf.df["name"].dtype, "category")
+        self.assertEqual(bdf.df["url"].dtype, "category")
+        self.assertEqual(list(df.columns), ["item", "itemLabel", "population", "date"])
+        self.assertEqual(len(df), 5)
+
+    def test_registry(self):
+        df = TestHelper.mock_df_table()
+        with mock.patch("graphs.registry.process_bar_chart_race") as process:
+            charts = build_charts(df)
+        process.assert_not_called()
+        self.assertEqual(list(charts), ["table", "bar_chart_race"])
+        self.assertEqual(charts["bar_chart_race"], {"failed": "number of columns must be between 3 and 5"})
+
+        df = TestHelper.mock_df_bcr()
+        charts = build_charts(df, ["bar_chart_race", "table"])
+        self.assertEqual(list(charts), ["bar_chart_race", "table"])
+        self.assertEqual(
+            json.dumps(charts["bar_chart_race"], default=Series.to_data),
+            json.dumps(process_bar_chart_race(df), default=Series.to_data),
+        )
+        with mock.patch.dict(CHARTS, {"count": Chart("count", lambda df, **options: len(df), cost=lambda df: 0)}):
+            self.assertEqual(build_charts(df, ["count"]), {"count": 3})
+            self.assertEqual(build_charts(df)["count"], 3)
+        with self.assertRaises(ValueError):
+            build_charts(df, ["pie"])
+        # dates are checked in the first rows, skipping unknown values
+        df.loc[0, "date"] = "http://www.wikidata.org/.well-known/genid/123"
+        self.assertNotIn("failed", build_charts(df, ["bar_chart_race"])["bar_chart_race"])
+        df.loc[1, "date"] = "2022"
+        df.loc[2, "date"] = "yesterday"
+        self.assertEqual(build_charts(df)["bar_chart_race"], {"failed": "last column must be a date column"})
 
     def test_df_processor(self):
         df = TestHelper.mock_df_bcr()
@@ -192,3 +281,308 @@ class QueryTests(TestCase):
         self.assertEqual(original, ["2020-01-01", "2022-01-01"])
         original = DfProcessor(bdf, time_unit="day").original_time_units()
         self.assertEqual(original, ["2020-07-01", "2022-01-01"])
+
+
+class EngineTests(TestCase):
+    def test_interpolate(self):
+        nan = float("nan")
+        values = np.array(
+            [
+                [nan, 1.0, 5.0],
+                [2.0, nan, 5.0],
+                [nan, nan, 5.0],
+                [8.0, 4.0, 5.0],
+                [nan, nan, 5.0],
+            ]
+        )
+        names = np.array(["a", "b", "c"], dtype=object)
+        timeline = DenseTimeline(list("12345"), names, values).interpolate()
+        np.testing.assert_array_equal(
+            timeline.values,
+            [
+                [0.0, 1.0, 5.0],
+                [2.0, 2.0, 5.0],
+                [5.0, 3.0, 5.0],
+                [8.0, 4.0, 5.0],
+                [8.0, 4.0, 5.0],
+            ],
+        )
+        np.testing.assert_array_equal(
+            timeline.ranks(),
+            [
+                [3, 2, 1],
+                [2, 3, 1],
+                [1, 3, 2],
+                [1, 3, 2],
+                [1, 3, 2],
+            ],
+        )
+
+    def test_long_df(self):
+        df = TestHelper.mock_df_bcr()
+        df["state"] = ["RS", "CE", "SP"]
+        df = df[["item", "itemLabel", "state", "population", "date"]]
+        bdf = BaseDf(df).prepare()
+        ip = DfProcessor(bdf).interpolated_df()
+        self.assertEqual(list(ip.columns), ["date", "name", "value", "rank", "category"])
+        self.assertEqual(list(ip["name"].unique()), ["Fortaleza", "Porto Alegre", "São Paulo"])
+        self.assertEqual(list(ip["date"][:3]), ["2020-01-01", "2021-01-01", "2022-01-01"])
+        self.assertEqual(list(ip["rank"][-3:]), [1.0, 1.0, 1.0])
+        self.assertEqual(list(ip["category"].unique()), ["CE", "RS", "SP"])
+
+    def test_top_k(self):
+        values = np.array([[1.0, 3.0, 3.0, 2.0, 3.0], [0.0, 0.0, 0.0, 0.0, 1.0]])
+        np.testing.assert_array_equal(top_k(values, 2), [[1, 2], [4, 0]])
+        np.testing.assert_array_equal(top_k(values, 3), [[1, 2, 4], [4, 0, 1]])
+
+    def test_frames_exits(self):
+        values = np.array([[3.0, 0.0, 1.0], [1.0, 0.0, 3.0], [0.0, 2.0, 1.0]])
+        names = np.array(["a", "b", "c"], dtype=object)
+        timeline = DenseTimeline(np.arange(31, 34).astype("datetime64[Y]"), names, values)
+        frames = Frames.from_timeline(timeline, 2).to_records()
+        self.assertEqual([frame["date"] for frame in frames], ["2001-01-01", "2002-01-01", "2003-01-01"])
+        self.assertEqual(
+            [(bar["date"], bar["name"], bar["value"], bar["rank"]) for bar in frames[1]["values"]],
+            [
+                ("2002-01-01", "c", 3.0, 1.0),
+                ("2002-01-01", "a", 1.0, 2.0),
+                ("2003-01-01", "b", 0.0, 3.0),
+            ],
+        )
+        self.assertEqual(len(frames[2]["values"]), 2)
+
+    def test_observations(self):
+        df = TestHelper.mock_df_bcr()
+        bdf = BaseDf(df).prepare()
+        observations = Observations.from_df(bdf.df)
+        self.assertEqual(observations.year_count(), 3)
+        timeline = observations.timeline("month")
+        self.assertEqual(timeline.values.shape, (19, 3))
+        self.assertEqual(timeline.time_units.dtype, np.dtype("datetime64[M]"))
+        self.assertEqual(list(format_dates(timeline.time_units[:2])), ["2020-07-01", "2020-08-01"])
+        self.assertEqual(timeline.time_units[-1], np.datetime64("2022-01"))
+        years = observations.timeline("year").time_units
+        self.assertEqual(list(format_dates(years)), ["2020-01-01", "2021-01-01", "2022-01-01"])
+
+    def test_visible_entities(self):
+        rows = np.array([0, 3, 0, 2, 0, 1, 3])
+        codes = np.array([0, 0, 1, 1, 2, 3, 3])
+        values = np.array([10.0, 10.0, 1.0, 20.0, 5.0, 2.0, 3.0])
+        np.testing.assert_array_equal(visible_entities(rows, codes, values, 4, 4, 2), [True, True, True, False])
+        df = synthetic_result(60, 3, 1, category=True, sparse=0.3)
+        observations = Observations.from_df(BaseDf(df).prepare().df)
+        visible = observations.visible("day", 5)
+        self.assertLess(visible.sum(), 60)
+        frames = observations.frames("day", 5, segments=True)
+        full = Frames.from_timeline(observations.timeline("day").interpolate(), 5, segments=True)
+        self.assertEqual(list(frames.names), list(full.names[visible]))
+        self.assertEqual(frames.to_records(), full.to_records())
+
+    def test_plan(self):
+        df = synthetic_result(40, 30, 12)
+        observations = Observations.from_df(BaseDf(df).prepare().df)
+        plan = plan_time_units(observations)
+        self.assertEqual([series.decision for series in plan.values()], ["compute"] * 3)
+        with override_settings(CHART_CELL_BUDGET=100_000):
+            plan = plan_time_units(observations)
+            self.assertEqual(plan["month"].decision, "compute")
+            self.assertEqual((plan["day"].decision, plan["day"].step), ("downsample", 5))
+            self.assertLessEqual(plan["day"].cells, 100_000)
+            frames = observations.frames("day", 24, step=plan["day"].step)
+            self.assertEqual(len(frames), observations.units("day", 5))
+            self.assertEqual(frames.to_records()[1]["date"], "2000-01-06")
+        with override_settings(CHART_CELL_BUDGET=10_000):
+            plan = plan_time_units(observations, "delta")
+            self.assertEqual(plan["month"].step, 2)
+            self.assertEqual(plan["day"].decision, "skip")
+        with override_settings(CHART_PAYLOAD_BUDGET=4_000_000):
+            res = process_bar_chart_race(df.copy())
+            self.assertEqual(res["time_units"], ["year", "month", "day"])
+            self.assertEqual(res["plan"]["day"]["decision"], "downsample")
+            self.assertLessEqual(res["plan"]["day"]["bytes"], 4_000_000)
+        with override_settings(CHART_CELL_BUDGET=20):
+            self.assertIn("failed", process_bar_chart_race(df.copy()))
+
+    def test_compute_frames_backends(self):
+        df = synthetic_result(30, 3, 4, category=True, sparse=0.3)
+        observations = Observations.from_df(BaseDf(df).prepare().df)
+        time_units = ["year", "month", "day"]
+        results = {}
+        for backend in ["inline", "thread", "process"]:
+            with override_settings(CHART_EXECUTOR=backend):
+                frames = compute_frames(observations, time_units, 24)
+            results[backend] = {u: frames[u].to_records() for u in time_units}
+        self.assertEqual(results["thread"], results["inline"])
+        self.assertEqual(results["process"], results["inline"])
+
+    def test_broken_process_pool(self):
+        df = synthetic_result(10, 2)
+        observations = Observations.from_df(BaseDf(df).prepare().df)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            pools = set(executor.map(lambda _: id(workers.get_process_pool()), range(8)))
+        self.assertEqual(len(pools), 1)
+        pool = workers.get_process_pool()
+        with (
+            override_settings(CHART_EXECUTOR="process"),
+            mock.patch("graphs.workers.frames_in_processes", side_effect=BrokenProcessPool),
+            mock.patch.object(pool, "shutdown") as shutdown,
+            self.assertLogs("django", "ERROR"),
+        ):
+            frames = compute_frames(observations, ["year"], 4)
+        self.assertEqual(len(frames["year"]), 2)
+        shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        self.assertIsNot(workers.get_process_pool(), pool)
+        pool.shutdown()
+
+    def test_store(self):
+        df = synthetic_result(30, 3, 4, category=True, sparse=0.3)
+        df.attrs["digest"] = "abc"
+        with tempfile.TemporaryDirectory() as directory, override_settings(CHART_CACHE_DIR=directory):
+            cold = process_bar_chart_race(df, "all", encoding="delta")
+            entry = store.entry_path("abc")
+            self.assertTrue((entry / "prepared").is_dir())
+            self.assertTrue((entry / f"frames-{store.frames_key('day', 24, segments=True)}").is_dir())
+            with mock.patch.object(BaseDf, "prepare", side_effect=AssertionError):
+                warm = process_bar_chart_race(df, "all", encoding="delta")
+            self.assertEqual(json.dumps(warm, default=Series.to_data), json.dumps(cold, default=Series.to_data))
+            self.assertIsInstance(store.load_prepared("abc")["observations"].values.base, np.memmap)
+
+            df.attrs["digest"] = "def"
+            self.assertIn("failed", process_bar_chart_race(df.iloc[:, :2]))
+            self.assertEqual(process_bar_chart_race(df.iloc[:, :2]), store.load_prepared("def"))
+
+            version = store.ENGINE_VERSION + 1
+            with mock.patch("graphs.store.ENGINE_VERSION", version):
+                self.assertIsNone(store.load_prepared("abc"))
+                process_bar_chart_race(df)
+            self.assertEqual([path.name for path in Path(directory).iterdir()], [f"v{version}"])
+            with override_settings(CHART_CACHE_MAX_BYTES=0), mock.patch("graphs.store.ENGINE_VERSION", version):
+                store.cull()
+                self.assertEqual(list((Path(directory) / f"v{version}").iterdir()), [])
+
+            # the cache is culled once enough has been saved since the last time
+            with (
+                override_settings(CHART_CACHE_MAX_BYTES=16 * 1000),
+                mock.patch("graphs.store._saved", 0),
+                mock.patch("graphs.store._culled_version", store.ENGINE_VERSION),
+                mock.patch("graphs.store.cull") as cull,
+            ):
+                for i in range(4):
+                    store.saved(400)
+                self.assertEqual(cull.call_count, 1)
+
+    def test_timings(self):
+        df = synthetic_result(30, 3, 4, category=True)
+        with collect() as timings:
+            process_bar_chart_race(df)
+        stages = timings.summary()
+        self.assertEqual(stages["prepare"]["rows"], 360)
+        self.assertIn("plan", stages)
+        self.assertEqual(stages["frames.year"]["rows"], 3)
+        self.assertEqual(stages["frames.month"]["rows"], 34)  # until October of the last year
+        self.assertGreater(stages["frames.day"]["cpu"], 0)
+        observations = Observations.from_df(BaseDf(df).prepare().df)
+        for backend in ["thread", "process"]:
+            with override_settings(CHART_EXECUTOR=backend), collect() as timings:
+                compute_frames(observations, ["year", "month"], 24)
+            self.assertEqual(set(timings.summary()), {"frames.year", "frames.month"})
+        self.assertIn('frames.month;dur=', timings.header())
+
+    def test_compact(self):
+        df = synthetic_result(30, 3, 4, category=True, sparse=0.3)
+        frames = Observations.from_df(BaseDf(df).prepare().df).frames("month", 24)
+        records = frames.to_records()
+        compact = frames.to_compact()
+        decoded = []
+        for t, date in enumerate(compact["dates"]):
+            values = []
+            for j, (e, v, r) in enumerate(zip(compact["index"][t], compact["value"][t], compact["rank"][t])):
+                bar_date = date if j < compact["n"] else compact["dates"][t + 1]
+                name, category = compact["names"][e], compact["categories"][e]
+                values.append({"date": bar_date, "name": name, "value": v, "rank": r, "category": category})
+            decoded.append({"date": date, "values": values})
+        self.assertEqual(decoded, records)
+        self.assertLess(len(json.dumps(compact)), len(json.dumps(records)) / 3)
+        rounded = frames.to_compact(precision=2)
+        self.assertEqual(rounded["value"][-1][0], float(f"{records[-1]['values'][0]['value']:.2g}"))
+
+    def test_delta(self):
+        df = synthetic_result(30, 3, 4, category=True, sparse=0.3)
+        frames = Observations.from_df(BaseDf(df).prepare().df).frames("day", 24, segments=True)
+        delta = frames.to_delta(keyframe_interval=50)
+        self.assertIn("index", delta["frames"][50])
+        self.assertNotIn("index", delta["frames"][51])
+        decoded = []
+        order, known = None, {}
+        for t, (date, frame) in enumerate(zip(delta["dates"], delta["frames"])):
+            if "index" in frame:
+                order, known = list(frame["index"]), {}
+            for position, e in frame.get("moves", []):
+                order[position] = e
+            for e, start, value, slope in frame.get("segments", []):
+                known[e] = (start, value, slope)
+            values = []
+            for e in order:
+                start, value, slope = known[e]
+                values.append(slope * (t - start) + value)
+            last = max(j + 1 for j, value in enumerate(values) if value > 0)
+            bars = [(date, e, float(value), float(j + 1)) for j, (e, value) in enumerate(zip(order, values))]
+            for j, e in enumerate(frame.get("exits", [])):
+                bars.append((delta["dates"][t + 1], e, 0.0, float(last + j + 1)))
+            values = [
+                {"date": d, "name": delta["names"][e], "value": v, "rank": r, "category": delta["categories"][e]}
+                for d, e, v, r in bars
+            ]
+            decoded.append({"date": date, "values": values})
+        self.assertEqual(decoded, frames.to_records())
+        self.assertLess(len(json.dumps(delta)), len(json.dumps(frames.to_compact())) / 3)
+
+
+class BenchmarkTests(TestCase):
+    def test_case_from_spec(self):
+        self.assertEqual(case_from_spec("small"), {"entities": 20, "years": 10})
+        self.assertEqual(
+            case_from_spec("entities=5 years=3 per_year=12 category=1 sparse=0.5"),
+            {"entities": 5, "years": 3, "per_year": 12, "category": True, "sparse": 0.5},
+        )
+        with self.assertRaises(ValueError):
+            case_from_spec("huge")
+        with self.assertRaises(ValueError):
+            case_from_spec("rows=5")
+
+    def test_benchmark(self):
+        cases = {"tiny": {"entities": 5, "years": 3, "per_year": 4, "category": True}}
+        report = Benchmark(cases, repeat=1, engines=["compact", "delta", "store"]).run()
+        case = report["cases"]["tiny"]
+        self.assertEqual(case["rows"], 60)
+        self.assertIn("frames[day]", case["stages"])
+        self.assertGreater(case["stages"]["prepare"]["peak_bytes"], 0)
+        self.assertEqual(differences(report), [])
+        self.assertEqual(compare(report, report), [])
+
+        baseline = json.loads(json.dumps(report))
+        baseline["cases"]["tiny"]["stages"]["prepare"]["seconds"] = case["stages"]["prepare"]["seconds"] / 10 - 1
+        [regression] = compare(report, baseline)
+        self.assertEqual((regression["stage"], regression["metric"]), ("prepare", "seconds"))
+        baseline["cases"]["tiny"]["options"]["entities"] = 6
+        self.assertEqual(compare(report, baseline), [])
+
+    def test_check_engines(self):
+        df = synthetic_result(5, 3)
+        engines = {"first": lambda bdf, u: ENGINES["compact"](bdf, u)[:1], "compact": ENGINES["compact"]}
+        checks = check_engines(df, engines)
+        self.assertEqual(checks["first"]["year"], "1 frames instead of 3")
+        self.assertEqual(set(checks["compact"].values()), {None})
+
+    def test_reference_frames(self):
+        # more entities than bars, so that some leave the top
+        df = synthetic_result(40, 3, 4, category=True, sparse=0.3)
+
+        def shifted(bdf, u):
+            records = ENGINES["records"](bdf, u)
+            records[-1]["values"][0]["value"] += 1
+            return records
+
+        checks = check_engines(df, {"records": ENGINES["records"], "shifted": shifted})
+        self.assertEqual(set(checks["records"].values()), {None})
+        self.assertIn("differs", checks["shifted"]["year"])
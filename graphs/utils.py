@@ -1,16 +1,24 @@
-from graphs.bar_chart_race import process_bar_chart_race
-from graphs.table import process_table
+from graphs.registry import build_charts
 
 
-def charts_from_df(df):
+def charts_from_df(df, granularity=None, on_prepared=None, encoding="records", precision=None, names=None):
     """
     Determine the available chart types based on the processed data
     and generate the corresponding data for each chart type.
 
     :param df: DataFrame containing the processed data
+    :param granularity: time units of the bar chart race series, see `process_bar_chart_race`
+    :param on_prepared: called with the prepared data of the bar chart race
+    :param encoding: encoding of the bar chart race series, see `bar_chart_race_series`
+    :param precision: significant digits of the values in the compact format
+    :param names: chart types to build, all of them when None, see `graphs.registry`
     :return: dictionary with chart types as keys and processed data as values
     """
-    charts = {}
-    charts["table"] = process_table(df)
-    charts["bar_chart_race"] = process_bar_chart_race(df)
-    return charts
+    return build_charts(
+        df,
+        names,
+        granularity=granularity,
+        on_prepared=on_prepared,
+        encoding=encoding,
+        precision=precision,
+    )
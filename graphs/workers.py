@@ -0,0 +1,166 @@
+"""
+Execution backends for the bar chart race time units.
+
+The numeric work of each time unit (dense timeline, interpolation, top bars and
+exiting bars) can run in a persistent process pool. The coded observations are
+handed to the workers through a shared memory block and the workers send the
+frames back as arrays, so no DataFrame is pickled either way.
+"""
+
+import contextvars
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+from django.conf import settings
+
+from graphs.engine import Observations
+from infographics.timing import add_stage
+from infographics.timing import stage
+
+logger = logging.getLogger("django")
+
+BACKENDS = ("auto", "process", "thread", "inline")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=settings.CHART_WORKERS, mp_context=context)
+        return _pool
+
+
+def discard_process_pool(pool):
+    """
+    Shuts down a broken pool, so that the next request starts a new one. A
+    pool already replaced by another thread is left as it is.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def choose_backend(observations, time_units, steps=None):
+    """
+    Backend set in `CHART_EXECUTOR`. With "auto" the process pool is used for
+    several time units with at least `CHART_PROCESS_MIN_CELLS` entities × time
+    units in total, threads for smaller ones and no executor for a single one.
+    """
+    backend = settings.CHART_EXECUTOR
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown chart executor {backend}")
+    if backend != "auto":
+        return backend
+    if len(time_units) < 2:
+        return "inline"
+    steps = steps or {}
+    cells = 0
+    for time_unit in time_units:
+        cells += observations.units(time_unit, steps.get(time_unit, 1)) * len(observations.names)
+    return "process" if cells >= settings.CHART_PROCESS_MIN_CELLS else "thread"
+
+
+def compute_frames(observations, time_units, head, segments=False, steps=None):
+    """
+    Frames of each time unit, computed with the backend of `choose_backend`.
+
+    :param segments: keep the interpolation segments of the top bars, see `Frames.to_delta`
+    :param steps: time units per frame of the downsampled time units, see `plan_series`
+
+    :return: dictionary from time unit to Frames
+    """
+    steps = {u: (steps or {}).get(u, 1) for u in time_units}
+    backend = choose_backend(observations, time_units, steps)
+    if backend == "process":
+        pool = get_process_pool()
+        try:
+            return frames_in_processes(pool, observations, time_units, head, segments, steps)
+        except BrokenProcessPool:
+            logger.exception("chart process pool broke, computing in threads")
+            discard_process_pool(pool)
+            backend = "thread"
+    if backend == "thread":
+        with ThreadPoolExecutor() as executor:
+            futures = {
+                u: executor.submit(
+                    contextvars.copy_context().run, timed_frames, observations, u, head, segments, steps[u]
+                )
+                for u in time_units
+            }
+            return {u: future.result() for u, future in futures.items()}
+    return {u: timed_frames(observations, u, head, segments, steps[u]) for u in time_units}
+
+
+def timed_frames(observations, time_unit, head, segments, step):
+    """
+    Frames of a time unit, recorded as the "frames.<time unit>" stage.
+    """
+    with stage(f"frames.{time_unit}") as record:
+        frames = observations.frames(time_unit, head, segments, step)
+        record["rows"] = len(frames)
+    return frames
+
+
+def frames_in_processes(pool, observations, time_units, head, segments, steps):
+    count = len(observations.codes)
+    block = shared_memory.SharedMemory(create=True, size=max(1, 3 * count * 8))
+    try:
+        arrays = np.ndarray((3, count), dtype=np.int64, buffer=block.buf)
+        arrays[0] = observations.codes
+        arrays[1] = observations.days.view(np.int64)
+        arrays[2] = observations.values.view(np.int64)
+        del arrays
+        futures = {
+            u: pool.submit(
+                frames_worker, block.name, count, observations.names, u, head, segments, steps[u]
+            )
+            for u in time_units
+        }
+        results = {u: future.result() for u, future in futures.items()}
+    finally:
+        block.close()
+        block.unlink()
+    frames = {}
+    for u, (f, visible, wall, cpu) in results.items():
+        if observations.categories is not None:
+            f.categories = observations.categories[visible]
+        add_stage(f"frames.{u}", wall, cpu, rows=len(f))
+        frames[u] = f
+    return frames
+
+
+def frames_worker(name, count, names, time_unit, head, segments, step):
+    """
+    Frames and visible entities of a time unit, with the wall and CPU seconds
+    spent on them in the worker.
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        frames, visible = shared_frames(block, count, names, time_unit, head, segments, step)
+    finally:
+        block.close()
+    return frames, visible, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def shared_frames(block, count, names, time_unit, head, segments, step):
+    arrays = np.ndarray((3, count), dtype=np.int64, buffer=block.buf)
+    observations = Observations(
+        arrays[0], arrays[1].view("datetime64[D]"), arrays[2].view(np.float64), names
+    )
+    frames = observations.frames(time_unit, head, segments, step)
+    return frames, observations.visible(time_unit, head, step)
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 import os
 import subprocess
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -59,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'infographics.timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -193,3 +195,87 @@ def check_external_software():
         subprocess.run(commands, check=True, capture_output=True)
 
 # check_external_software()
+
+# SPARQL query results are cached in the database, shared by all workers.
+# Results older than QUERY_CACHE_TTL seconds are served for QUERY_CACHE_STALE
+# more seconds while being refreshed in the background. The access time used to
+# evict the least recently used results is updated at most once per
+# QUERY_CACHE_TOUCH_INTERVAL seconds, so cache hits rarely write.
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", 60 * 60))
+QUERY_CACHE_STALE = int(os.environ.get("QUERY_CACHE_STALE", 24 * 60 * 60))
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+QUERY_CACHE_TOUCH_INTERVAL = int(os.environ.get("QUERY_CACHE_TOUCH_INTERVAL", 5 * 60))
+
+# Query results above these limits are rejected while being downloaded
+QUERY_MAX_ROWS = int(os.environ.get("QUERY_MAX_ROWS", 1_000_000))
+QUERY_MAX_BYTES = int(os.environ.get("QUERY_MAX_BYTES", 256 * 1024 * 1024))
+
+# Format requested from the query service: json, tsv or csv
+QUERY_TRANSPORT = os.environ.get("QUERY_TRANSPORT", "json")
+
+# Connection to the SPARQL endpoint. Requests that are rate limited or fail to
+# connect are retried with backoff, and after SPARQL_CIRCUIT_THRESHOLD failures
+# in a row queries fail fast for SPARQL_CIRCUIT_COOLDOWN seconds.
+SPARQL_ENDPOINT = os.environ.get("SPARQL_ENDPOINT", "https://query.wikidata.org/sparql")
+SPARQL_POOL_SIZE = int(os.environ.get("SPARQL_POOL_SIZE", 10))
+SPARQL_CONNECT_TIMEOUT = float(os.environ.get("SPARQL_CONNECT_TIMEOUT", 5))
+SPARQL_READ_TIMEOUT = float(os.environ.get("SPARQL_READ_TIMEOUT", 65))
+SPARQL_RETRIES = int(os.environ.get("SPARQL_RETRIES", 2))
+SPARQL_BACKOFF = float(os.environ.get("SPARQL_BACKOFF", 1))
+SPARQL_MAX_BACKOFF = float(os.environ.get("SPARQL_MAX_BACKOFF", 10))
+SPARQL_CIRCUIT_THRESHOLD = int(os.environ.get("SPARQL_CIRCUIT_THRESHOLD", 5))
+SPARQL_CIRCUIT_COOLDOWN = float(os.environ.get("SPARQL_CIRCUIT_COOLDOWN", 30))
+
+# Lock files used by workers to run identical queries only once at a time
+QUERY_LOCK_DIR = os.environ.get("QUERY_LOCK_DIR", os.path.join(tempfile.gettempdir(), "infographics-locks"))
+QUERY_LOCK_TIMEOUT = float(os.environ.get("QUERY_LOCK_TIMEOUT", 90))
+# Queries share this many lock files, so the directory doesn't grow with them
+QUERY_LOCK_SLOTS = int(os.environ.get("QUERY_LOCK_SLOTS", 256))
+
+# Background query jobs. With 0 workers jobs run inside the submitting request.
+QUERY_JOB_WORKERS = int(os.environ.get("QUERY_JOB_WORKERS", 2))
+QUERY_JOB_RETENTION = int(os.environ.get("QUERY_JOB_RETENTION", 24 * 60 * 60))
+# Jobs without progress for this many seconds are failed, since the worker
+# running them was restarted
+QUERY_JOB_TIMEOUT = int(os.environ.get("QUERY_JOB_TIMEOUT", 10 * 60))
+
+# Queries are fetched in pages of this many rows when set and the request gives
+# the order_by variable of the pages, unless it asks for another chunk_size.
+# 0 fetches them in a single request.
+QUERY_CHUNK_SIZE = int(os.environ.get("QUERY_CHUNK_SIZE", 0))
+
+# Bar chart race time units are computed in a pool of CHART_WORKERS processes
+# ("process"), in threads ("thread") or one after the other ("inline"). With
+# "auto" the pool is used once a chart has CHART_PROCESS_MIN_CELLS entities ×
+# time units, below which starting the work in other processes costs more.
+CHART_EXECUTOR = os.environ.get("CHART_EXECUTOR", "auto")
+CHART_WORKERS = int(os.environ.get("CHART_WORKERS", min(3, os.cpu_count() or 1)))
+CHART_PROCESS_MIN_CELLS = int(os.environ.get("CHART_PROCESS_MIN_CELLS", 1_000_000))
+
+# Prepared bar chart race data of this many queries is kept in memory by each
+# worker, to build the series of other granularities without fetching again.
+CHART_PREPARED_CACHE_SIZE = int(os.environ.get("CHART_PREPARED_CACHE_SIZE", 16))
+
+# Each bar chart race series is computed within CHART_CELL_BUDGET entities ×
+# time units and an estimated CHART_PAYLOAD_BUDGET bytes, downsampled to fewer
+# frames when needed to fit, or skipped.
+CHART_CELL_BUDGET = int(os.environ.get("CHART_CELL_BUDGET", 5_000_000))
+CHART_PAYLOAD_BUDGET = int(os.environ.get("CHART_PAYLOAD_BUDGET", 32 * 1024 * 1024))
+
+# Query results are sent as tables of TABLE_PAGE_SIZE rows, with the other
+# pages requested by key, up to TABLE_MAX_PAGE_SIZE rows each. Each worker keeps
+# the tables of TABLE_CACHE_SIZE queries in memory.
+TABLE_PAGE_SIZE = int(os.environ.get("TABLE_PAGE_SIZE", 10))
+TABLE_MAX_PAGE_SIZE = int(os.environ.get("TABLE_MAX_PAGE_SIZE", 1000))
+TABLE_CACHE_SIZE = int(os.environ.get("TABLE_CACHE_SIZE", 16))
+
+# Processed bar chart race data is saved in CHART_CACHE_DIR, up to
+# CHART_CACHE_MAX_BYTES, to serve charts of results already processed by any
+# worker without preparing them again. An empty directory disables it.
+CHART_CACHE_DIR = os.environ.get("CHART_CACHE_DIR", os.path.join(tempfile.gettempdir(), "infographics-charts"))
+CHART_CACHE_MAX_BYTES = int(os.environ.get("CHART_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+# Time spent in each stage of a request is always logged. It is also sent in the
+# Server-Timing header when SERVER_TIMING is "True", since it tells anyone
+# about cache hits and the sizes of results.
+SERVER_TIMING = os.environ.get("SERVER_TIMING") == "True"
@@ -0,0 +1,185 @@
+"""
+Timing of the stages of the work done for a request.
+
+Code on the hot path wraps its stages in `stage`, which records their wall
+and CPU time, and the rows and bytes they handled, in the `Timings` collected
+in the current context, if any. `ServerTimingMiddleware` collects the stages
+of each request, sends them in the Server-Timing header and logs them as a
+line of JSON. Tests and tools collect the stages of any code with `collect`.
+
+Stages run in other threads are recorded when the thread runs in a copy of
+the context, see `contextvars.copy_context`. The CPU time is that of the
+thread running the stage, so work done in other threads or processes is only
+counted by their own stages.
+"""
+
+import contextvars
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger("infographics")
+
+current = contextvars.ContextVar("timings", default=None)
+
+
+class Timings:
+    """
+    Stages recorded while collecting, each a dictionary with its "name",
+    "wall" and "cpu" seconds, and "rows" and "bytes" when known.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stages = []
+
+    def add(self, record):
+        with self.lock:
+            self.stages.append(record)
+
+    def summary(self):
+        """
+        Stages by name, in order of first appearance, with the times, rows
+        and bytes of the stages of the same name added up.
+        """
+        summary = {}
+        with self.lock:
+            stages = list(self.stages)
+        for record in stages:
+            total = summary.setdefault(
+                record["name"], {"count": 0, "wall": 0.0, "cpu": 0.0, "rows": None, "bytes": None}
+            )
+            total["count"] += 1
+            total["wall"] += record["wall"]
+            total["cpu"] += record["cpu"]
+            for key in ("rows", "bytes"):
+                if record.get(key) is not None:
+                    total[key] = (total[key] or 0) + record[key]
+        return summary
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """
+        Value of the Server-Timing header, with the durations in milliseconds.
+        """
+        parts = []
+        for name, total in self.summary().items():
+            desc = [f"cpu={total['cpu'] * 1000:.1f}ms"]
+            desc.extend(f"{key}={total[key]}" for key in ("rows", "bytes") if total[key] is not None)
+            parts.append(f'{name};dur={total["wall"] * 1000:.1f};desc="{" ".join(desc)}"')
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+    def to_dict(self):
+        return {"total": self.elapsed(), "stages": self.summary()}
+
+
+@contextmanager
+def collect():
+    """
+    Collects the stages run in the block, in the current context.
+
+    :return: the Timings, as the value of the `with` statement
+    """
+    timings = Timings()
+    token = current.set(timings)
+    try:
+        yield timings
+    finally:
+        current.reset(token)
+
+
+@contextmanager
+def stage(name, rows=None, bytes=None):
+    """
+    Records the block as a stage when collecting. The block can set the "rows"
+    and "bytes" of the record given as the value of the `with` statement.
+    """
+    record = {"name": name, "rows": rows, "bytes": bytes}
+    timings = current.get()
+    if timings is None:
+        yield record
+        return
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record["wall"] = time.perf_counter() - wall
+        record["cpu"] = time.thread_time() - cpu
+        timings.add(record)
+
+
+def add_stage(name, wall, cpu, rows=None, bytes=None):
+    """
+    Records a stage timed somewhere else, such as in another process.
+    """
+    timings = current.get()
+    if timings is not None:
+        timings.add({"name": name, "wall": wall, "cpu": cpu, "rows": rows, "bytes": bytes})
+
+
+def counted(chunks, record):
+    """
+    Generator of the chunks, adding up their length in the "bytes" of the record.
+    """
+    record["bytes"] = record["bytes"] or 0
+    for chunk in chunks:
+        record["bytes"] += len(chunk)
+        yield chunk
+
+
+def log_timings(timings, **context):
+    logger.info(f"timings {json.dumps({**context, **timings.to_dict()})}")
+
+
+class ServerTimingMiddleware:
+    """
+    Collects the stages of each request. When there are any they are sent in
+    the Server-Timing header, when `SERVER_TIMING` is set, and logged. The
+    Timings are also set as the `timings` attribute of the response.
+
+    A streamed response is encoded while it is sent, after the header: the
+    encoding is recorded as the "encode" stage and logged at the end.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with collect() as timings:
+            response = self.get_response(request)
+        response.timings = timings
+        if not timings.stages:
+            return response
+        if settings.SERVER_TIMING:
+            response["Server-Timing"] = timings.header()
+        context = {"method": request.method, "path": request.path, "status": response.status_code}
+        if response.streaming:
+            response.streaming_content = timed_stream(response.streaming_content, timings, context)
+        else:
+            log_timings(timings, **context)
+        return response
+
+
+def timed_stream(chunks, timings, context):
+    record = {"name": "encode", "rows": None, "bytes": 0, "wall": 0.0, "cpu": 0.0}
+    try:
+        while True:
+            wall, cpu = time.perf_counter(), time.thread_time()
+            chunk = next(chunks, None)
+            record["wall"] += time.perf_counter() - wall
+            record["cpu"] += time.thread_time() - cpu
+            if chunk is None:
+                break
+            record["bytes"] += len(chunk)
+            yield chunk
+    finally:
+        timings.add(record)
+        log_timings(timings, **context)
@@ -1,7 +1,7 @@
 /* eslint-disable react/prop-types */
 import { useRef, useState, useEffect, useContext } from "react";
 import { Alert } from "flowbite-react";
-import { initializeChart, updateChart } from "./barChartRaceUtils";
+import { decodeSeries, initializeChart, updateChart } from "./barChartRaceUtils";
 import * as d3 from "d3";
 import "./barChartRace.css";
 import 'font-awesome/css/font-awesome.min.css';
@@ -44,6 +44,7 @@ const BarChartRace = ({ title, speed, colorPalette, timeUnit, barRaceData, isDow
         } else if (timeUnit === "month") {
           data_to_use = barRaceData.values_by_date_monthly;
         };
+        data_to_use = decodeSeries(data_to_use);
 
         var original_time_units = new Set(barRaceData.original_time_units);
         if (onlyOriginalTimeUnits) {
@@ -12,6 +12,112 @@ export let color;
 let updateBars, updateAxis, updateLabels, updateTicker, x;
 let dateFormatter;
 
+/**
+ * Reads a values by date series sent in the delta format, frame by frame.
+ *
+ * Keyframes have the entity indexes of their top bars in `index`, and other
+ * frames only the positions that changed in `moves`. Values come from the
+ * interpolation segments [entity, start, start value, slope] known since the
+ * last keyframe, so any frame is decoded from the keyframe before it.
+ *
+ * @param {Object} series - Series in the delta format.
+ * @returns {Object} The number of frames and `frameAt(t)`, which returns frame t.
+ */
+export const deltaSeries = (series) => {
+  const { names, categories, dates, keyframe_interval, frames } = series;
+  let current = -1;
+  let order = [];
+  let segments = new Map();
+
+  const apply = (t) => {
+    const frame = frames[t];
+    if (frame.index) {
+      order = frame.index.slice();
+      segments = new Map();
+    }
+    for (const [position, entity] of frame.moves || []) {
+      order[position] = entity;
+    }
+    for (const [entity, start, value, slope] of frame.segments || []) {
+      segments.set(entity, [start, value, slope]);
+    }
+    current = t;
+  };
+
+  const bar = (date, entity, value, rank) => {
+    const bar = { date, name: names[entity], value, rank };
+    if (categories) {
+      bar.category = categories[entity];
+    }
+    return bar;
+  };
+
+  const frameAt = (t) => {
+    if (t !== current) {
+      const keyframe = t - t % keyframe_interval;
+      const from = t > current && current >= keyframe ? current + 1 : keyframe;
+      for (let i = from; i <= t; i++) {
+        apply(i);
+      }
+    }
+    const values = order.map((entity) => {
+      const [start, value, slope] = segments.get(entity);
+      return slope * (t - start) + value;
+    });
+    let lastPositive = NaN;
+    values.forEach((value, j) => {
+      if (value > 0) {
+        lastPositive = j + 1;
+      }
+    });
+    const bars = order.map((entity, j) => bar(dates[t], entity, values[j], j + 1));
+    (frames[t].exits || []).forEach((entity, j) => {
+      bars.push(bar(dates[t + 1], entity, 0, lastPositive + j + 1));
+    });
+    return { date: dates[t], values: bars };
+  };
+
+  return { length: dates.length, frameAt };
+};
+
+/**
+ * Decodes a values by date series sent in the compact or delta formats into
+ * frames with one object per bar. Series in the records format are returned
+ * as they are.
+ *
+ * In the compact format names and categories are listed once and each frame
+ * has parallel lists of entity indexes, values and ranks. Bars after the first
+ * `n` of a frame are leaving bars, dated as the next frame.
+ *
+ * @param {Object|Array} series - Series of a time unit.
+ * @returns {Array} List of frames with their date and bars.
+ */
+export const decodeSeries = (series) => {
+  if (series?.format === "delta") {
+    const delta = deltaSeries(series);
+    return Array.from({ length: delta.length }, (_, t) => delta.frameAt(t));
+  }
+  if (!series || series.format !== "compact") {
+    return series;
+  }
+  const { names, categories, dates, n } = series;
+  return dates.map((date, t) => ({
+    date,
+    values: series.index[t].map((entity, j) => {
+      const bar = {
+        date: j < n ? date : dates[t + 1],
+        name: names[entity],
+        value: series.value[t][j],
+        rank: series.rank[t][j],
+      };
+      if (categories) {
+        bar.category = categories[entity];
+      }
+      return bar;
+    }),
+  }));
+};
+
 // Function to initialize the chart
 export const initializeChart = (svgRef, dataset, width, maxHeight, title, colorPaletteArray, timeUnit, locale) => {
   const chartMarginTop = 30;
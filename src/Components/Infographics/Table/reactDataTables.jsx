@@ -3,6 +3,8 @@ import { useState, useEffect, useContext } from 'react';
 import DataTable from 'react-data-table-component';
 import { DarkModeContext } from "../../../context/DarkModeContext";
 import { LanguageContext } from "../../../context/LanguageContext";
+import { rowsFromColumns } from "./tableUtils";
+import api from "../../../api/axios";
 
 
 /**
@@ -31,17 +33,28 @@ const FilterComponent = ({ filterText, onFilter, onClear }) => {
 
 /**
  * DataTables component for React using react-data-table-component.
+ *
+ * Tables with a `key` are paginated, sorted and searched on the server, a page
+ * at a time, others (like the first rows of a query still running) locally.
  * @param {Object} props - The props for the DataTables component.
  * @returns {JSX.Element} The DataTables component.
  */
-export function ReactDataTables({ columns, data, headers }) {
+export function ReactDataTables({ columns, table, headers }) {
   const [filterText, setFilterText] = useState('');
   const [resetPaginationToggle, setResetPaginationToggle] = useState(false);
-  const [filteredData, setFilteredData] = useState(data);
+  const [filteredData, setFilteredData] = useState(() => rowsFromColumns(table.data));
+  const [totalRows, setTotalRows] = useState(table.total);
+  const [page, setPage] = useState(1);
+  const [perPage, setPerPage] = useState(10);
+  const [sort, setSort] = useState({ field: null, order: 'asc' });
+  const [loading, setLoading] = useState(false);
   const {darkMode} = useContext(DarkModeContext);
   const { getContent } = useContext(LanguageContext);
+  const server = Boolean(table.key);
 
   useEffect(() => {
+    if (server) return;
+    const data = rowsFromColumns(table.data);
     const filtered = data.filter(item => {
       return headers.some(column => {
         const cellData = item[column] || '';  // Use the column name directly as key
@@ -49,7 +62,38 @@ export function ReactDataTables({ columns, data, headers }) {
       });
     });
     setFilteredData(filtered);
-  }, [filterText, data, columns, headers]);
+  }, [server, filterText, table, columns, headers]);
+
+  useEffect(() => {
+    if (!server) return;
+    const first = page === 1 && !sort.field && !filterText;
+    if (first && headers.length && perPage <= table.data[headers[0]].length) {
+      setFilteredData(rowsFromColumns(table.data).slice(0, perPage));
+      setTotalRows(table.total);
+      setLoading(false);
+      return;
+    }
+    let cancelled = false;
+    const params = {
+      key: table.key,
+      offset: (page - 1) * perPage,
+      limit: perPage,
+      order: sort.order,
+    };
+    if (sort.field) params.sort = sort.field;
+    if (filterText) params.search = filterText;
+    setLoading(true);
+    api.get('/query/table/', { params })
+      .then(response => {
+        if (cancelled) return;
+        const result = response.data.data;
+        setFilteredData(rowsFromColumns(result.data));
+        setTotalRows(result.filtered);
+      })
+      .catch(error => console.error("An error occurred while fetching the table:", error))
+      .finally(() => !cancelled && setLoading(false));
+    return () => { cancelled = true; };
+  }, [server, table, page, perPage, sort, filterText]);
 
   // fix for the svg("v") element in the pagination displaying twice
   useEffect(() => {
@@ -63,10 +107,14 @@ export function ReactDataTables({ columns, data, headers }) {
   const subHeaderComponent = (
     <FilterComponent
       filterText={filterText}
-      onFilter={e => setFilterText(e.target.value)}
+      onFilter={e => {
+        setPage(1);
+        setFilterText(e.target.value);
+      }}
       onClear={() => {
         if (filterText) {
           setResetPaginationToggle(!resetPaginationToggle);
+          setPage(1);
           setFilterText('');
         }
       }}
@@ -80,6 +128,24 @@ export function ReactDataTables({ columns, data, headers }) {
   };
   const noDataComponent = getContent("table-no-data");
 
+  // https://react-data-table-component.netlify.app/?path=/docs/examples-remote-pagination--docs
+  const serverProps = server ? {
+    paginationServer: true,
+    paginationTotalRows: totalRows,
+    onChangePage: setPage,
+    onChangeRowsPerPage: (rows, page) => {
+      setPerPage(rows);
+      setPage(page);
+    },
+    sortServer: true,
+    onSort: (column, direction) => {
+      setPage(1);
+      setSort({ field: column.name, order: direction });
+    },
+    progressPending: loading,
+    persistTableHead: true,
+  } : {};
+
   return (
     <DataTable
       columns={columns}
@@ -95,6 +161,7 @@ export function ReactDataTables({ columns, data, headers }) {
       subHeaderComponent={subHeaderComponent}
       paginationComponentOptions={paginationComponentOptions}
       noDataComponent={noDataComponent}
+      {...serverProps}
     />
   );
 }
@@ -9,7 +9,8 @@ import { LanguageContext } from "../../../context/LanguageContext";
 
 /**
  * ChartTable component for displaying data in a DataTable.
- * @param {Object} tableData - The data to be displayed in the table, with `columns` and `data` properties.
+ * @param {Object} tableData - The first page of the table, with `columns`, `total` and column-oriented
+ *   `data`, and the `key` of the table on the server when the rest of it can be fetched from there.
  * @returns {JSX.Element} The ChartTable component.
  */
 export function ChartTable({ tableData }) {
@@ -38,7 +39,7 @@ export function ChartTable({ tableData }) {
 
   return (
     <div className="container mx-auto px-4 sm:px-6 lg:px-8 py-8">
-      <ReactDataTables columns={columns} data={tableData.data} headers={headers}/>
+      <ReactDataTables columns={columns} table={tableData} headers={headers}/>
     </div>
   );
 }
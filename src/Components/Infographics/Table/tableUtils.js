@@ -28,39 +28,66 @@ export function formatDate(dateString, locale) {
 
 
 /**
- * Downloads data as a CSV file
+ * Converts the column-oriented data of a table page into a list of rows
+ *
+ * @param {Object} data - Object from each column name to the list of its values
+ * @returns {Array<Object>} The rows, as objects from column name to value
+ *
+ * @example
+ * rowsFromColumns({ state: ['Q43783', 'Q43783'], year: ['2000', '2010'] });
+ * // [{ state: 'Q43783', year: '2000' }, { state: 'Q43783', year: '2010' }]
+ */
+export function rowsFromColumns(data) {
+  const columns = Object.keys(data);
+  const length = columns.length ? data[columns[0]].length : 0;
+  return Array.from({ length }, (_, i) =>
+    Object.fromEntries(columns.map(col => [col, data[col][i]]))
+  );
+}
+
+
+/**
+ * Downloads a table as a CSV file. Tables kept on the server, with a `key`,
+ * are downloaded whole from it, others are built from the rows at hand.
  * 
- * @param {Object} data - The data object containing `columns` (array) and `data` (array of objects)
+ * @param {Object} table - The table object containing `columns` (array), `data` (object from
+ *   column to array of values) and optionally the `key` of the table on the server
  * 
  * @example
- * const data = {
+ * const table = {
  *   columns: ['state', 'capitalLabel', 'population', 'year'],
- *   data: [
- *     { state: 'http://www.wikidata.org/entity/Q43783', capitalLabel: 'Aracaju', population: '461534', year: '2000' },
- *     { state: 'http://www.wikidata.org/entity/Q43783', capitalLabel: 'Aracaju', population: '571149', year: '2010' },
- *     { state: 'http://www.wikidata.org/entity/Q43783', capitalLabel: 'Aracaju', population: '632744', year: '2020' }
- *   ]
+ *   data: {
+ *     state: ['http://www.wikidata.org/entity/Q43783', 'http://www.wikidata.org/entity/Q43783'],
+ *     capitalLabel: ['Aracaju', 'Aracaju'],
+ *     population: ['461534', '571149'],
+ *     year: ['2000', '2010']
+ *   }
  * };
- * downloadCSV(data);
+ * downloadCSV(table);
  */
-export function downloadCSV(data) {
+export function downloadCSV(table) {
   try {
-    const columns = data.columns;
-    const rows = data.data;
+    let href;
+    if (table.key) {
+      href = `/api/query/table/?${new URLSearchParams({ key: table.key, format: "csv" })}`;
+    } else {
+      const columns = table.columns;
+      const rows = rowsFromColumns(table.data);
 
-    // Create CSV string
-    let csvContent = "data:text/csv;charset=utf-8,";
-    csvContent += columns.join(",") + "\n";
+      // Create CSV string
+      let csvContent = "data:text/csv;charset=utf-8,";
+      csvContent += columns.join(",") + "\n";
 
-    rows.forEach(row => {
-      let rowContent = columns.map(col => row[col] || '').join(",");
-      csvContent += rowContent + "\n";
-    });
+      rows.forEach(row => {
+        let rowContent = columns.map(col => row[col] || '').join(",");
+        csvContent += rowContent + "\n";
+      });
+      href = encodeURI(csvContent);
+    }
 
-    // Encode URI and create a link to trigger download
-    const encodedUri = encodeURI(csvContent);
+    // Create a link to trigger download
     const link = document.createElement('a');
-    link.setAttribute('href', encodedUri);
+    link.setAttribute('href', href);
     link.setAttribute('download', 'data.csv');
     document.body.appendChild(link);
     link.click();
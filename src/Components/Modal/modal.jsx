@@ -50,6 +50,11 @@ export function InfoModal({ barRaceData, currState, onCloseModal, handleChartDis
     handleChartDisplay("Bar chart race");
   }
 
+  // Series of other time units are fetched when selected
+  const hasTimeUnit = (timeUnit) => {
+    return barRaceData?.time_units?.includes(timeUnit) || barRaceData?.hasOwnProperty(timeUnit === "day" ? "values_by_date_daily" : "values_by_date_monthly");
+  }
+
   return (
     <>
       <Modal show={openModal} size="sm" onClose={() => { setOpenModal(false); onCloseModal() }}>
@@ -70,8 +75,8 @@ export function InfoModal({ barRaceData, currState, onCloseModal, handleChartDis
               </div>
               <Select id="chartUnit" value={chartTimeUnit} onChange={handleTimeUnitChange} required>
                 <option value="year">{getContent("bar-chart-race-setup-speed-unit-years")}</option>
-                {barRaceData?.hasOwnProperty("values_by_date_monthly") && <option value="month">{getContent("bar-chart-race-setup-speed-unit-months")}</option>}
-                {barRaceData?.hasOwnProperty("values_by_date_daily") && <option value="day">{getContent("bar-chart-race-setup-speed-unit-days")}</option>}
+                {hasTimeUnit("month") && <option value="month">{getContent("bar-chart-race-setup-speed-unit-months")}</option>}
+                {hasTimeUnit("day") && <option value="day">{getContent("bar-chart-race-setup-speed-unit-days")}</option>}
               </Select>
             </div>
 
@@ -12,6 +12,10 @@ import { downloadCSV } from '../Components/Infographics/Table/tableUtils';
 import { InfoModal } from '../Components/Modal/modal';
 import { LanguageContext } from "../context/LanguageContext";
 
+const JOB_POLL_INTERVAL = 1000;
+// a bit longer than QUERY_JOB_TIMEOUT on the server, which fails lost jobs
+const JOB_MAX_WAIT = 11 * 60 * 1000;
+const SERIES = { year: "values_by_date", month: "values_by_date_monthly", day: "values_by_date_daily" };
 
 /**
  * Infographics component for displaying data visualization.
@@ -27,7 +31,9 @@ import { LanguageContext } from "../context/LanguageContext";
 const Infographics = () => {
   const [chartData, setChartData] = useState({});
   const [code, setCode] = useState("");
+  const [chartQuery, setChartQuery] = useState(""); // query of chartData, the editor may have changed since
   const [isLoading, setIsLoading] = useState(false);
+  const [isPartial, setIsPartial] = useState(false);
   const [error, setError] = useState("");
   const [username, _] = useState("");
   const [isDownloadingCsv, setIsDownloadingCsv] = useState(false);
@@ -64,17 +70,50 @@ const Infographics = () => {
   };
 
 
+  /**
+   * Polls the result of a query job until it is finished.
+   * While the query is fetched in chunks, the table of the first chunk is shown.
+   * Gives up with a timeout error after JOB_MAX_WAIT milliseconds.
+   *
+   * @param {string} id - The id of the query job.
+   * @returns {Promise<Object>} The response with the result of the job.
+   */
+  const waitForQueryJob = async (id) => {
+    let shownPartial = false;
+    const deadline = Date.now() + JOB_MAX_WAIT;
+    while (Date.now() < deadline) {
+      const response = await api.get(`/jobs/${id}/result/`);
+      if (response.status === 200) {
+        return response;
+      }
+      if (response.data.partial && !shownPartial) {
+        shownPartial = true;
+        setIsPartial(true);
+        setChartData({ table: response.data.partial.table, bar_chart_race: { failed: "partial" } });
+        setChartType("Table");
+      }
+      await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+    }
+    const error = new Error(`query job ${id} did not finish`);
+    error.response = { data: { error: "preview-error-timeout" } };
+    throw error;
+  };
+
+
   /**
    * Fetches chart data based on the SPARQL query from the code state.
+   * The query runs as a background job on the server, which is polled until done.
    * Sets the chart data and handles loading state.
    */
   const getChartData = async () => {
+    const query = code;
     try {
       setIsLoading(true);
-      const sparql_query = encodeURIComponent(code);
-      const response = await api.get(`/query/?query=${sparql_query}`) //GET request is required for better line error response
+      const job = await api.postForm('/jobs/', { query, granularity: "year", format: "delta" });
+      const response = await waitForQueryJob(job.data.id);
       handleClearError();
       setChartData(response.data.data);
+      setChartQuery(query);
       setChartType("Table");
       setChartTimeUnit("year");
       setChartOnlyOriginalTimeUnits(false);
@@ -82,9 +121,11 @@ const Infographics = () => {
       handleClearError()
       setError(error?.response?.data?.error || "preview-error-fetching-data")
       setChartData({})
+      setChartQuery("");
       console.error(error?.response?.data?.error || error);
     } finally {
       setIsLoading(false);
+      setIsPartial(false);
     }
   };
 
@@ -122,7 +163,32 @@ const Infographics = () => {
     setChartColorPalette(colorPalette);
   }
 
-  const handleChartTimeUnit = (timeUnit) => {
+  /**
+   * Changes the time unit of the bar chart race, fetching its series first
+   * when it was not part of the query response, for the query of the chart
+   * rather than the one in the editor.
+   *
+   * @param {string} timeUnit - year, month or day.
+   */
+  const handleChartTimeUnit = async (timeUnit) => {
+    const barRaceData = chartData.bar_chart_race;
+    if (barRaceData && !barRaceData.hasOwnProperty(SERIES[timeUnit])) {
+      try {
+        setIsLoading(true);
+        const response = await api.get('/query/series/', { params: { query: chartQuery, granularity: timeUnit, format: "delta" } });
+        const { plan, ...series } = response.data.data;
+        setChartData(data => ({
+          ...data,
+          bar_chart_race: { ...data.bar_chart_race, ...series, plan: { ...data.bar_chart_race.plan, ...plan } },
+        }));
+      } catch (error) {
+        setError(error?.response?.data?.error || "preview-error-fetching-data");
+        console.error(error?.response?.data?.error || error);
+        return;
+      } finally {
+        setIsLoading(false);
+      }
+    }
     setChartTimeUnit(timeUnit);
   }
 
@@ -145,7 +211,7 @@ const Infographics = () => {
             <CodeEditor onCodeChange={handleCodeChange} handleFetchChartData={getChartData} isLoading={isLoading} errorMessage={error}/>
           </div>
           <div id="graphicsPanel" style={{minHeight: "82vh", minWidth: "50%" }} className="flex-1 border dark:border-gray-800 relative overflow-x-auto bg-white dark:bg-gray-600">
-            {isLoading && <Overlay />}
+            {isLoading && !isPartial && <Overlay />}
             {error && <div className="flex items-center justify-center mt-7"><ErrorAlert alertText={getContent(error) || error} /></div>}
             {Object.keys(chartData).length < 1 && !error && <div className="flex items-center justify-center mt-7"><InfoAlert alertText={getContent("preview-no-data")} /></div>}
             {chartData.table && <div className="flex justify-between items-center h-12 border-b-4 dark:border-gray-700 px-4 py-1">
@@ -153,7 +219,7 @@ const Infographics = () => {
               <DownloadButtons handleDownloadCsv={handleDownloadCsv} isDownloadingCsv={isDownloadingCsv} handleDownloadVideo={handleDownloadVideo} isDownloadingVideo={isDownloadingVideo} chartType={chartType}/>
             </div>}
             <InfoModal barRaceData={chartData.bar_chart_race} currState={openModal} onCloseModal={onCloseModal} handleChartDisplay={handleChartDisplay} handleChartTitle={handleChartTitle} handleChartSpeed={handleChartSpeed} handleChartColorPalette={handleChartColorPalette} handleChartTimeUnit={handleChartTimeUnit} handleChartOnlyOriginalTimeUnits={handleChartOnlyOriginalTimeUnits} />
-            {chartData.table && chartType == "Table" && <ChartTable tableData={chartData.table} />}
+            {chartData.table && chartType == "Table" && <ChartTable key={chartData.table.key} tableData={chartData.table} />}
             {chartType == "Bar chart race" && !error && Object.keys(chartData).length > 0 && <BarChartRace title={chartTitle} speed={chartSpeed} colorPalette={chartColorPalette} timeUnit={chartTimeUnit} barRaceData={chartData.bar_chart_race} isDownloadingVideo={isDownloadingVideo} setIsDownloadingVideo={setIsDownloadingVideo} onlyOriginalTimeUnits={chartOnlyOriginalTimeUnits} />}
           </div>
         </div>